@@ -9,6 +9,8 @@ import logging
 import copy
 import subprocess
 import pickle
+import time
+from concurrent.futures import ThreadPoolExecutor
 import tkinter as tk
 import nibabel as nb
 from nibabel.processing import resample_from_to,resample_to_output
@@ -36,6 +38,11 @@ import SimpleITK as sitk
 from dicom2nifti import convert_siemens,convert_philips
 from dicom2nifti import common
 
+from txcache import TxCache
+from histquantile import batch_quantiles
+import discovery
+import brainbox
+
 # convenience items
 def cp(item):
     return copy.deepcopy(item)
@@ -49,6 +56,22 @@ class RegistrationError(Exception):
         return self.message or "ANTS registration error"
 
 
+# MNI reference volumes, loaded once per process and keyed by datadir. a server
+# can call load_reference() before forking workers so they share one copy
+_reference = {}
+
+def load_reference(datadir):
+    if datadir not in _reference:
+        mnidir = os.path.join(datadir,'mni152')
+        s = Study(None,mnidir)
+        d,affine = s.loadnifti('mni_icbm152_t1_tal_nlin_sym_09a.nii',type='uint16',rai=False)
+        mask,_ = s.loadnifti('mni_icbm152_t1_tal_nlin_sym_09a_mask.nii',rai=False)
+        d *= mask
+        # brain bounding box that the stages after registration are cropped to
+        _reference[datadir] = {'d':d,'affine':affine,'mask':mask,'bbox':brainbox.bbox_from_mask(mask)}
+    return _reference[datadir]
+
+
 # Classes and methods for loading a collection of multiple dicom studies as a case
 # and pre-processing to produce nifti output files which are then loaded into the
 # viewer.
@@ -71,10 +94,10 @@ class Case():
 
         self.unzip()
 
-        _,dcmdirs = self.get_imagedirs()
-        dcmdirs = self.group_dcmdirs(dcmdirs)
-        assert(len(sorted(list(dcmdirs.keys())))==1) 
-        self.studydirs = dcmdirs[self.case]
+        # one pass over the upload tree gives case -> study -> series
+        self.records,_ = discovery.scan(self.casedir,self.casedir_prefix)
+        assert(len(sorted(list(self.records.keys())))==1) 
+        self.studydirs = list(self.records[self.case].keys())
             
         self.studies = []
         self.debug_study = None # tag for identifying a study to debug from current case eg '04_23' for date. depends on 
@@ -100,18 +123,9 @@ class Case():
     # because of the casedir prefix, raw accession numbers are not yet supported
     def group_dcmdirs(self,dcmdirs):
         dcm_casedirs = {}
-        casedirs = []
-        for i,d in enumerate(dcmdirs):
-            casedirs.append([s for s in re.split('\/|\\\\',d) if s.startswith(self.casedir_prefix)][0])
-        if len(casedirs) == len(dcmdirs):
-            casedir_keys = set(casedirs)
-            dcm_casedirs = {c:[] for c in casedir_keys}
-            for r,d in zip(casedirs,dcmdirs):
-                dcm_casedirs[r].append(d)
-            return dcm_casedirs
-
-        else:
-            raise ValueError('Not all directories match a case prefix')
+        for d in dcmdirs:
+            dcm_casedirs.setdefault(discovery.get_casename(d,self.casedir_prefix),[]).append(d)
+        return dcm_casedirs
 
     # get list of all image directories under the selected directory
     # in the case of dcmdirs, if given a single dicom case dir it will return the studydirs.
@@ -119,24 +133,8 @@ class Case():
     def get_imagedirs(self,dir=None):
         if dir is None:
             dir = self.casedir
-        dcmdirs = []
-        niftidirs = []
-        for root,dirs,files in os.walk(dir,topdown=True):
-            if len(files):
-                dcmfiles = [f for f in files if re.match('.*\.dcm',f.lower())]
-                niftifiles = [f for f in files if re.match('.*(t1|t2|flair).*\.(nii|nii\.gz)',f.lower())]
-                if len(dcmfiles):
-                    # for now assume that the parent of this dir is a series dir, and will take 
-                    # the dicomdir as the parent of the series dir
-                    # but for exported sunnybrook dicoms at least the more recognizeable dir might 
-                    # be two levels above at the date.
-                    dcmdirs.append(os.path.split(root)[0])
-                if len(niftifiles):
-                    niftidirs.append(os.path.join(root))
-
-        # due to the intermediate seriesdirs, the above walk generates duplicates
-        dcmdirs = list(set(dcmdirs))
-
+        records,niftidirs = discovery.scan(dir,self.casedir_prefix)
+        dcmdirs = [sd for c in records.values() for sd in c.keys()]
         return niftidirs,dcmdirs
 
 
@@ -349,6 +347,9 @@ class Case():
                             dstr = dt+'_processed.nii'
                         s.writenifti(s.dset[dc][dt]['d'],os.path.join(self.dir['flask_nifti'],dstr),
                                                     type='float',affine=affine)
+            # the volumes are written on the full grid, later stages crop them on loading
+            ref = load_reference(self.dir['data'])
+            brainbox.write_bbox(self.dir['flask_nifti'],ref['bbox'],np.shape(ref['mask']))
         print('Case {} nifti files written'.format(self.case))
 
     # run nnunet segmentation                
@@ -486,30 +487,23 @@ class Study():
         # hard-coded points on the cumulative density
         slims = (.2,.8)
 
-        for dt in dtag:
-            if self.dset['raw'][dt]['ex']:
-                norm_vals = {dt:{}}
-                region_of_support = np.where((self.dset['raw'][dt]['d'] > 0))
-                background = np.where((self.dset['raw'][dt]['d'] == 0))
-                # 'counts' is (uniquevals, counts)
-                norm_vals[dt]['counts'] = np.unique(np.round(self.dset['raw'][dt]['d'][region_of_support]).reshape(-1),
-                                                                return_counts=True)
-                # calculate normalized quantiles for each array
-                norm_vals[dt]['q'] = np.cumsum(norm_vals[dt]['counts'][1]) / len(region_of_support[0])
-                # smoothing spline
-                spl = splrep(norm_vals[dt]['counts'][0],norm_vals[dt]['q'],s=0.01)
-                norm_vals[dt]['spl_q'] = splev(norm_vals[dt]['counts'][0],spl)
-                # take 20th,80th quantiles for normalization
-                norm_vals[dt]['slim'] = np.array([np.argmin(norm_vals[dt]['spl_q'] < slims[0]),np.argmin(norm_vals[dt]['spl_q'] < slims[1])])
-                self.dset['raw'][dt]['d_norm'] = np.copy(self.dset['raw'][dt]['d'])
-                self.dset['raw'][dt]['d_norm'] -= norm_vals[dt]['counts'][0][norm_vals[dt]['slim'][0]]
-                self.dset['raw'][dt]['d_norm'] /= (norm_vals[dt]['counts'][0][norm_vals[dt]['slim'][1]] - norm_vals[dt]['counts'][0][norm_vals[dt]['slim'][0]])
-                if False:
-                    self.dset[dt]['d_norm'] *= self.dset[dt]['mask']
-                else:
-                    self.dset['raw'][dt]['d_norm'][background] = 0
-                if False:
-                    writenifti(dset['raw'][dt][d+'_norm'],os.path.join(datadir,'t0',dt+'_bet_norm.nii'),affine=dset['t0']['affine'],type=float)
+        # one pass histogram of the foreground of each channel instead of np.unique
+        arrs = {dt:self.dset['raw'][dt]['d'] for dt in dtag if self.dset['raw'][dt]['ex']}
+        qvals = batch_quantiles(arrs,slims)
+
+        for dt in arrs.keys():
+            background = np.where((self.dset['raw'][dt]['d'] == 0))
+            # take 20th,80th quantiles for normalization
+            qlo,qhi = qvals[dt]
+            self.dset['raw'][dt]['d_norm'] = np.copy(self.dset['raw'][dt]['d'])
+            self.dset['raw'][dt]['d_norm'] -= qlo
+            self.dset['raw'][dt]['d_norm'] /= (qhi - qlo)
+            if False:
+                self.dset[dt]['d_norm'] *= self.dset[dt]['mask']
+            else:
+                self.dset['raw'][dt]['d_norm'][background] = 0
+            if False:
+                writenifti(dset['raw'][dt][d+'_norm'],os.path.join(datadir,'t0',dt+'_bet_norm.nii'),affine=dset['t0']['affine'],type=float)
 
         return
 
@@ -625,12 +619,12 @@ class DcmStudy(Study):
         # params for z-score
         self.params = {dt:{'mean':0,'std':0} for dt in ['t1','t1+','flair','flair+']}
         # reference for talairach coords
-        self.dset['ref']['d'],self.dset['ref']['affine'] = self.loadnifti('mni_icbm152_t1_tal_nlin_sym_09a.nii',
-                                                                          dir=os.path.join(self.dir['data'],'mni152'),
-                                                                          type='uint16',rai=False)
-        mask,_ = self.loadnifti('mni_icbm152_t1_tal_nlin_sym_09a_mask.nii',dir=os.path.join(self.dir['data'],'mni152'),rai=False)
-        self.dset['ref']['d'] *= mask
+        ref = load_reference(self.dir['data'])
+        self.dset['ref']['d'] = np.copy(ref['d'])
+        self.dset['ref']['affine'] = np.copy(ref['affine'])
         # self.dset['ref']['d'] = self.rescale(self.dset['ref']['d'])
+        # persistent store of registration transforms, shared by all studies under datadir
+        self.txcache = TxCache(os.path.join(self.dir['data'],'txcache'))
         return
     
     # load up multiple series directories in the provided study directory
@@ -1009,10 +1003,10 @@ class DcmStudy(Study):
         # self.dbias = {} # working data for calculating z-scores
         # TODO: use viewer mode designation here
         if False:
-            for dt in self.channels.values():
-                if self.dset['raw'][dt]['ex']:   
-                    self.dset['z'][dt]['d'] = np.copy(self.n4bias(self.dset['raw'][dt]['d']))
-                    self.dset['z'][dt]['ex'] = True
+            n4 = self.n4bias_study([dt for dt in self.channels.values() if self.dset['raw'][dt]['ex']])
+            for dt in n4.keys():
+                self.dset['z'][dt]['d'] = n4[dt]
+                self.dset['z'][dt]['ex'] = True
 
             # if necessary clip any negative values introduced by the processing
             for dt in self.channels.values():
@@ -1028,17 +1022,21 @@ class DcmStudy(Study):
 
     # calculate stats to create z-score images
     # duplicates normalslice_callback code in main viewer, should be combined
-    def normalstats(self,event=None):
+    # fast - fit MiniBatchKMeans on a sample of nsample voxels and then label all voxels,
+    #        otherwise fit full KMeans on every foreground voxel
+    # plot - write the diagnostic 2d histogram to scatterplot_normal.png
+    def normalstats(self,event=None,fast=True,nsample=100000,plot=False):
         print('normal stats')
         # do kmeans
         # Creates a matrix of voxels for normal brain slice
 
         X={}
         vset = {}
+        backgrounds = {}
         for dt2 in [('flair','t1+'),('flair','t2')]:
             if self.dset['z'][dt2[0]]['ex'] and self.dset['z'][dt2[1]]['ex']:
                 region_of_support = np.where(self.dset['raw'][dt2[0]]['d']*self.dset['raw'][dt2[1]]['d'] >0)
-                background = np.where(self.dset['raw'][dt2[0]]['d']*self.dset['raw'][dt2[1]]['d'] == 0)
+                backgrounds[dt2] = np.where(self.dset['raw'][dt2[0]]['d']*self.dset['raw'][dt2[1]]['d'] == 0)
                 # vset = np.zeros_like(region_of_support,dtype='float')
                 for dt in dt2:
                     vset[dt] = np.ravel(self.dset['z'][dt]['d'][region_of_support])
@@ -1046,31 +1044,47 @@ class DcmStudy(Study):
                 X[dt2] = np.column_stack((vset[dt2[0]],vset[dt2[1]]))
 
         np.random.seed(1)
+        if plot:
+            plt.figure(7),plt.clf()
         for i,layer in enumerate(X.keys()):
-            kmeans = KMeans(n_clusters=2,n_init='auto').fit(X[layer])
+            if fast and len(X[layer]) > nsample:
+                # systematic sample with random offset. the foreground voxels are in raster
+                # order so this is stratified by slice and by position within slice
+                step = len(X[layer]) / nsample
+                sidx = (np.random.uniform(0,step) + step*np.arange(nsample)).astype(int)
+                kmeans = MiniBatchKMeans(n_clusters=2,n_init='auto',batch_size=4096,random_state=1).fit(X[layer][sidx])
+                # vectorised nearest-centre assignment for all voxels
+                labels = kmeans.predict(X[layer])
+            else:
+                kmeans = KMeans(n_clusters=2,n_init='auto').fit(X[layer])
+                labels = kmeans.labels_
             background_cluster = np.argmax(np.power(kmeans.cluster_centers_[:,0],2)+np.power(kmeans.cluster_centers_[:,1],2))
 
             # Calculate stats for brain cluster
             for ii,dt in enumerate(layer):
-                self.params[dt]['std'] = np.std(X[layer][kmeans.labels_==background_cluster,ii])
-                self.params[dt]['mean'] = np.mean(X[layer][kmeans.labels_==background_cluster,ii])
-
-                plt.figure(7),plt.clf()
-                ax = plt.subplot(1,2,i+1)
-                plt.scatter(X[layer][kmeans.labels_==1-background_cluster,0],X[layer][kmeans.labels_==1-background_cluster,1],c='b',s=1)
-                plt.scatter(X[layer][kmeans.labels_==background_cluster,0],X[layer][kmeans.labels_==background_cluster,1],c='r',s=1)
-                ax.set_aspect('equal')
-                # ax.set_xlim(left=0,right=1.0)
-                # ax.set_ylim(bottom=0,top=1.0)
-                # plt.text(0,1.02,'{:.3f},{:.3f}'.format(self.params[layer]['mean'],self.params[layer]['std']))
-                if False:
-                    plt.show(block=False)
+                self.params[dt]['std'] = np.std(X[layer][labels==background_cluster,ii])
+                self.params[dt]['mean'] = np.mean(X[layer][labels==background_cluster,ii])
 
                 self.dset['z'][dt]['d'] = ( self.dset['z'][dt]['d'] - self.params[dt]['mean']) / self.params[dt]['std']
-                self.dset['z'][dt]['d'][background] = 0
+                self.dset['z'][dt]['d'][backgrounds[layer]] = 0
                 if False:
                     self.writenifti(self.dset['z'][dt]['d'],os.path.join(self.localstudydir,'z'+dt+'.nii'),affine=self.dset['raw'][dt]['affine'])
-        plt.savefig(os.path.join(self.localcasedir,'scatterplot_normal.png'))
+
+            if plot:
+                # log-density 2d histogram of a subsample, in place of a scatter of every voxel
+                pidx = slice(None,None,max(1,len(X[layer])//nsample))
+                ax = plt.subplot(1,2,i+1)
+                h,xe,ye = np.histogram2d(X[layer][pidx,0],X[layer][pidx,1],bins=128)
+                ax.imshow(np.log1p(h.T),origin='lower',extent=(xe[0],xe[-1],ye[0],ye[-1]),aspect='auto',cmap='gray')
+                c = kmeans.cluster_centers_
+                ax.plot(c[background_cluster,0],c[background_cluster,1],'r+')
+                ax.plot(c[1-background_cluster,0],c[1-background_cluster,1],'b+')
+                ax.set_xlabel(layer[0])
+                ax.set_ylabel(layer[1])
+                if False:
+                    plt.show(block=False)
+        if plot:
+            plt.savefig(os.path.join(self.localcasedir,'scatterplot_normal.png'))
 
         return
 
@@ -1217,6 +1231,39 @@ class DcmStudy(Study):
         img_arr_n4 = dataImage_n4.numpy()
         return img_arr_n4
 
+    # N4 bias correction of several channels of this study. the channels are all resampled
+    # to the t1 reference matrix by now so one mask is built and shared. the bias field is fit
+    # on a copy downsampled by shrinkFactor and the upsampled field is applied with a single multiply.
+    # channels run concurrently in threads, returns dict of corrected arrays keyed by channel
+    def n4bias_study(self,dtags,shrinkFactor=4,mask=None,nthreads=None):
+        print('N4 bias correction, {} channels'.format(len(dtags)))
+        if mask is None:
+            mask = np.zeros_like(self.dset['raw'][dtags[0]]['d'],dtype=float)
+            for dt in dtags:
+                mask[self.dset['raw'][dt]['d'] > 0] = 1
+        maskImage = ants.from_numpy(mask.astype(float))
+        shrink = (shrinkFactor,)*mask.ndim
+        maskImage_lo = ants.resample_image(maskImage,shrink,use_voxels=False,interp_type=1)
+
+        def n4(dt):
+            t0 = time.time()
+            dataImage = ants.from_numpy(self.dset['raw'][dt]['d'].astype(float))
+            dataImage_lo = ants.resample_image(dataImage,shrink,use_voxels=False,interp_type=0)
+            bias_lo = ants.n4_bias_field_correction(dataImage_lo,mask=maskImage_lo,shrink_factor=1,
+                                                    return_bias_field=True)
+            bias = ants.resample_image_to_target(bias_lo,dataImage,interp_type='linear').numpy()
+            # outside the mask the field is undefined, leave those voxels uncorrected
+            rbias = np.where((mask > 0) & (bias > 0),1/np.where(bias > 0,bias,1),1)
+            img_arr_n4 = self.dset['raw'][dt]['d'] * rbias
+            print('N4 {}: {:.1f} sec'.format(dt,time.time()-t0))
+            return img_arr_n4
+
+        if nthreads is None:
+            nthreads = len(dtags)
+        with ThreadPoolExecutor(max_workers=max(1,nthreads)) as ex:
+            res = dict(zip(dtags,ex.map(n4,dtags)))
+        return res
+
     # ants registration
     def register(self,img_arr_fixed,img_arr_moving,transform='Affine'):
         print('register fixed, moving')
@@ -1224,6 +1271,14 @@ class DcmStudy(Study):
         if (img_arr_fixed is None or img_arr_moving is None):
             raise RegistrationError
 
+        # check for a previous registration of the identical pair
+        txkey = self.txcache.key(img_arr_fixed,img_arr_moving,transform)
+        txfiles = self.txcache.get(txkey)
+        if txfiles is not None:
+            print('using cached transform {}'.format(txkey))
+            img_arr_reg = self.tx(img_arr_fixed,img_arr_moving,txfiles)
+            return img_arr_reg,txfiles
+
         fixed_ants = ants.from_numpy(img_arr_fixed)
         moving_ants = ants.from_numpy(img_arr_moving)
         try:
@@ -1232,9 +1287,10 @@ class DcmStudy(Study):
             print(e)
             raise RegistrationError
         img_arr_reg = mytx['warpedmovout'].numpy()
-        a=1
+        # persist the .mat files out of the ants temp dir
+        txfiles = self.txcache.put(txkey,mytx['fwdtransforms'])
 
-        return img_arr_reg,mytx['fwdtransforms']
+        return img_arr_reg,txfiles
 
     # apply registration transform to another volume
     def tx(self,img_arr_fixed,img_arr_moving,tx):
@@ -0,0 +1,109 @@
+# admission control for the heavy pipeline endpoints. each /run or /preprocess
+# request holds leases against per-resource budgets: concurrent cases, estimated RAM
+# and GPU slots. a request that doesn't fit waits in a FIFO queue and gets a 429 with its
+# queue position instead of being started, and a full queue is refused outright.
+#
+# leases live in the job store so the budgets are shared by all workers on the host,
+# through the JobStore interface. they carry an expiry so a crashed worker can't hold
+# resources forever.
+
+import time
+import numpy as np
+
+
+class AdmissionControl():
+
+    # jobs - JobStore
+    # max_cases - concurrent cases in the pipeline
+    # max_ram - bytes of estimated RAM for all running cases
+    # gpu_slots - concurrent prediction stages
+    # max_queue - waiting requests beyond which new ones are refused
+    # lease_ttl - seconds after which a lease is treated as abandoned
+    # queue_ttl - seconds a queued request is kept without the client retrying
+    def __init__(self,jobs,max_cases=1,max_ram=32e9,gpu_slots=1,max_queue=8,lease_ttl=6*3600,queue_ttl=300):
+        self.jobs = jobs
+        self.budget = {'case':max_cases,'ram':max_ram,'gpu':gpu_slots}
+        self.max_queue = max_queue
+        self.lease_ttl = lease_ttl
+        self.queue_ttl = queue_ttl
+
+    # heuristic RAM for one case. every channel of every study is resampled onto
+    # the MNI matrix as float64, with a few working copies during registration, on top
+    # of the dicom arrays themselves which are roughly the size of the upload
+    def estimate_ram(self,datadir,upload_bytes=0,ncases=1,nchannels=6,ncopies=3):
+        # DcmCase pulls in the imaging stack, which the lease bookkeeping doesn't need
+        from DcmCase import load_reference
+        try:
+            nvox = np.prod(np.shape(load_reference(datadir)['d']))
+        except (IOError,FileNotFoundError,TypeError):
+            nvox = 197*233*189 # mni_icbm152 09a
+        return float(ncases*nchannels*ncopies*8*nvox + 4*upload_bytes)
+
+    # admit a queued job if the case and ram budgets allow, and it is at the head of
+    # the queue. a batch job holds ncases case leases. returns (admitted,queue_position)
+    def admit(self,job_id,ram,ncases=1):
+        now = time.time()
+        with self.jobs.transaction():
+            # requests whose client stopped retrying give up their place
+            self.jobs.expire(now,now-self.queue_ttl)
+            self.jobs.update_job(job_id)
+            queue = self.jobs.queued_jobs()
+            # only a queued job can be admitted. one that just expired above, or is already
+            # running or finished, gets no leases. a retry with its id creates a new job
+            if job_id not in queue:
+                return False,len(queue)+1
+            pos = queue.index(job_id)
+            used = self._used()
+            # a request larger than the whole budget is still let through on an idle server
+            if pos == 0 and (used['case'] == 0 or (used['case'] + ncases <= self.budget['case'] and
+                                                   used['ram'] + ram <= self.budget['ram'])):
+                self.jobs.add_leases(job_id,{'case':ncases,'ram':ram},now+self.lease_ttl)
+                self.jobs.update_job(job_id,state='running')
+                return True,0
+        return False,pos+1
+
+    # True if another waiting request can be accepted into the queue
+    def can_queue(self):
+        return self.queue_depth() < self.max_queue
+
+    # take a gpu slot, waiting for one to free up. yields the seconds waited so far
+    # so a streaming caller can report it
+    def acquire_gpu(self,job_id,poll=2.0):
+        t0 = time.time()
+        while True:
+            now = time.time()
+            with self.jobs.transaction():
+                self.jobs.expire(now,now-self.queue_ttl)
+                if self._used()['gpu'] + 1 <= self.budget['gpu']:
+                    self.jobs.add_leases(job_id,{'gpu':1},now+self.lease_ttl)
+                    return
+            yield now - t0
+            time.sleep(poll)
+
+    def release_gpu(self,job_id):
+        self.jobs.release_leases(job_id,'gpu')
+
+    # drop all leases held by a job
+    def release(self,job_id):
+        self.jobs.release_leases(job_id)
+
+    def queue_depth(self):
+        return len(self.jobs.queued_jobs())
+
+    def _used(self):
+        used = {r:0 for r in self.budget.keys()}
+        used.update(self.jobs.lease_usage())
+        return used
+
+    # current usage in prometheus text format
+    def metrics(self):
+        with self.jobs.transaction():
+            used = self._used()
+            depth = self.queue_depth()
+        lines = ['# TYPE flaskdemo_queue_depth gauge','flaskdemo_queue_depth {}'.format(depth)]
+        for r in self.budget.keys():
+            lines.append('# TYPE flaskdemo_{}_used gauge'.format(r))
+            lines.append('flaskdemo_{}_used {}'.format(r,used[r]))
+            lines.append('# TYPE flaskdemo_{}_budget gauge'.format(r))
+            lines.append('flaskdemo_{}_budget {}'.format(r,self.budget[r]))
+        return '\n'.join(lines) + '\n'
@@ -3,47 +3,113 @@ import os
 import numpy as np
 import argparse
 import matplotlib.pyplot as plt
-import subprocess
 import sys
 import shutil
+import time
 
-from flask import Flask, jsonify, request, session, Response
+from flask import Flask, Blueprint, current_app, jsonify, request, session, Response
 from flask_cors import CORS
 
-from DcmCase import Case,RegistrationError
-
-
-parser = argparse.ArgumentParser()
-parser.add_argument("--host", type=str, default="localhost")
-parser.add_argument("--port", type=int, default=5000)
-parser.add_argument("--checkpoint", type=str, default="/media/jbishop/WD4/brainmets/sam_models/psam")
-parser.add_argument("--uploaddir", type=str, default="/media/jbishop/WD4/brainmets/sunnybrook/radnec2/dicom_upload")
-parser.add_argument("--downloaddir", type=str, default="/home/jbishop/Downloads")
-parser.add_argument("--niftidir", type=str, default="/media/jbishop/WD4/brainmets/sunnybrook/radnec2/dicom2nifti_upload")
-parser.add_argument("--datadir", type=str, default="/media/jbishop/WD4/brainmets/sunnybrook/radnec2/")
-
-args = parser.parse_args()
-
-# run in demo dir with app.app
-# run in pointsam dir with what path? have to chdir instead
-if True:
-    os.chdir('/home/src/flaskdemo/demo')
-os.environ['FLASK_APP'] = 'app.app'
-
-
-# Flask Backend
-app = Flask(__name__, static_folder="static")
-CORS(
-    app, origins=f"{args.host}:{args.port}", allow_headers="Access-Control-Allow-Origin"
-)
-app.secret_key = 'test'
-
-@app.route("/")
+from DcmCase import Case,RegistrationError,load_reference
+from progress import ProgressStream,StageTimings
+from jobstore import open_jobstore
+from admission import AdmissionControl
+import batch
+import fusion
+
+
+# default configuration. overridden by create_app(config), and by environment
+# variables with a FLASKDEMO_ prefix, eg FLASKDEMO_DATADIR=/data/radnec2/
+class Config():
+    HOST = "localhost"
+    PORT = 5000
+    CHECKPOINT = "/media/jbishop/WD4/brainmets/sam_models/psam"
+    UPLOADDIR = "/media/jbishop/WD4/brainmets/sunnybrook/radnec2/dicom_upload"
+    DOWNLOADDIR = "/home/jbishop/Downloads"
+    NIFTIDIR = "/media/jbishop/WD4/brainmets/sunnybrook/radnec2/dicom2nifti_upload"
+    DATADIR = "/media/jbishop/WD4/brainmets/sunnybrook/radnec2/"
+    SECRET_KEY = "test"
+    # which endpoints this process serves: 'all', or 'light' (index, upload, download)
+    # or 'heavy' (preprocess, run) so the two can be served by separately sized worker pools
+    ROLE = "all"
+    LIGHT_WORKERS = 4
+    HEAVY_WORKERS = 1
+    # load shared reference data at app creation, ie before a pre-forking server forks
+    PRELOAD = True
+    # uploads and job states shared by all workers. 'sqlite:///path' or a path,
+    # default is jobs.db in DATADIR
+    JOBSTORE = None
+    # admission budgets for the heavy endpoints, shared by all workers through the job store.
+    # the /run and /preprocess scripts share the imagesTs, prediction and results directories
+    # under DATADIR and clear them on start, so only one case can be in the pipeline at a time
+    MAX_CASES = 1
+    MAX_RAM_GB = 32
+    GPU_SLOTS = 1
+    MAX_QUEUE = 8
+    # seconds a client is asked to wait before retrying a queued request
+    RETRY_AFTER = 10
+    # in-process predictor for /run_batch, loaded on first use in each worker
+    NNUNET_DATASET = "139"
+    BATCH_SIZE = 256
+    # 3d full resolution model, selected per request with 'configuration': '3d_fullres'
+    NNUNET_DATASET_3D = "137"
+    TILE_STEP_SIZE = 0.5
+    PATCH_BATCH_SIZE = 4
+    PREPROCESS_WORKERS = 4
+    # overlap preprocessing, prediction and writing of successive cases in /run_batch
+    PIPELINED = True
+
+
+# directory of this module. the pipeline scripts are run from here
+demodir = os.path.dirname(os.path.abspath(__file__))
+
+light = Blueprint("light", __name__)
+heavy = Blueprint("heavy", __name__)
+
+
+def create_app(config=None):
+    app = Flask(__name__, static_folder="static")
+    app.config.from_object(Config)
+    app.config.from_prefixed_env("FLASKDEMO")
+    if config is not None:
+        app.config.update(config)
+
+    CORS(
+        app, origins=f"{app.config['HOST']}:{app.config['PORT']}", allow_headers="Access-Control-Allow-Origin"
+    )
+
+    app.extensions["jobstore"] = open_jobstore(app.config["JOBSTORE"] or os.path.join(app.config["DATADIR"], "jobs.db"))
+    app.extensions["admission"] = AdmissionControl(app.extensions["jobstore"], max_cases=app.config["MAX_CASES"],
+                                                   max_ram=app.config["MAX_RAM_GB"]*1e9, gpu_slots=app.config["GPU_SLOTS"],
+                                                   max_queue=app.config["MAX_QUEUE"])
+
+    if app.config["ROLE"] in ("all", "light"):
+        app.register_blueprint(light)
+    if app.config["ROLE"] in ("all", "heavy"):
+        app.register_blueprint(heavy)
+        # historical stage durations for progress ETA
+        app.extensions["stage_timings"] = StageTimings(os.path.join(app.config["DATADIR"], "stage_timings.json"))
+        if app.config["PRELOAD"]:
+            preload(app)
+
+    return app
+
+
+# anything large and read-only that every worker would otherwise load for itself.
+# under gunicorn with preload_app this runs once in the master and is shared copy-on-write
+def preload(app):
+    try:
+        load_reference(app.config["DATADIR"])
+    except (IOError, FileNotFoundError, TypeError) as e:
+        app.logger.warning("MNI reference not preloaded: {}".format(e))
+
+
+@light.route("/")
 def index():
-    return app.send_static_file("index.html")
+    return current_app.send_static_file("index.html")
 
 
-@app.route('/upload_dicom', methods=['POST'])
+@light.route('/upload_dicom', methods=['POST'])
 def upload_dicom():
     # data = request.get_json()
     file = request.files['file']
@@ -55,19 +121,20 @@ def upload_dicom():
 
     session['filename'] = filename
     # save the upload
-    file_path = os.path.join(args.uploaddir, filename)
+    file_path = os.path.join(current_app.config['UPLOADDIR'], filename)
     file.save(file_path)
+    current_app.extensions['jobstore'].add_upload(filename, file_path)
 
     return jsonify({"message": f"upload complete with file: {filename}"}),200
 
-@app.route('/preprocess', methods=['GET','POST'])
+@heavy.route('/preprocess', methods=['GET','POST'])
 def preprocess():
 
     data = request.get_json()
     filename = data.get('filename', None)
     if not filename:
         return jsonify({"error": "No filename received"}), 400
-    
+
     if False: # if using query_string and GET
         filename = request.args.get('filename')
         if not filename:
@@ -75,33 +142,35 @@ def preprocess():
 
             if not filename:
                 return jsonify({"error": "No filename received"}), 400
-        
-    if True:
-        c = filename.split('.')[0]
-        try:
-            case = Case(c,args.uploaddir,args.niftidir,args.datadir)
-        except RegistrationError:
-            print('Registration failure, case {}\n\n'.format(c))
+
+    cfg = current_app.config
+    c = filename.split('.')[0]
+    jobs = current_app.extensions['jobstore']
+    adm = current_app.extensions['admission']
+    job_id, busy = admit_job(c, filename, data.get('job_id'))
+    if busy is not None:
+        return busy
+    stream = ProgressStream(['case','preprocess'], current_app.extensions['stage_timings'],
+                            fmt=request.args.get('format', 'sse'), listener=job_listener(jobs, job_id))
 
     def generate():
-        result = subprocess.Popen(["python","-m","nnunet2d_predict_preprocess"],
-                                  stdout=subprocess.PIPE,
-                                  stderr=subprocess.STDOUT,
-                                  text=True,
-                                  bufsize=1)
-        for line in iter(result.stdout.readline,""):
-            print(line,end="")
-            result.stdout.flush()
-            yield line.strip() + '\n'
-        result.stdout.close()
-        result.wait()
+        try:
+            try:
+                yield from stream.run_callable('case', Case, c, cfg['UPLOADDIR'], cfg['NIFTIDIR'], cfg['DATADIR'])
+            except RegistrationError:
+                print('Registration failure, case {}\n\n'.format(c))
+            yield from stream.run_stage('preprocess', [sys.executable, "-m", "nnunet2d_predict_preprocess",
+                                                       "--datadir", cfg['DATADIR']], cwd=demodir)
+            yield stream.event('done', ok=stream.returncode == 0)
+        finally:
+            close_job(jobs, adm, job_id)
 
     # return jsonify({"message": f"preprocess complete with file: {filename}"})
-    return Response(generate(), mimetype="text/plain")
+    return Response(generate(), mimetype=stream.mimetype)
 
 
 
-@app.route("/run", methods=['GET','POST'])
+@heavy.route("/run", methods=['GET','POST'])
 def run():
     filename = request.args.get('filename')
     if not filename:
@@ -109,118 +178,270 @@ def run():
         if not filename:
             return jsonify({"error": "No filename received"}), 400
 
+    cfg = current_app.config
     case = filename.split('.')[0]
-    output_zip = os.path.join(args.datadir, 'nnUNet_predictions', 'flask', f'{case}_inference.zip')
-    
-    # Store necessary data before starting subprocesses
+    output_zip = os.path.join(cfg['DATADIR'], 'nnUNet_predictions', 'flask', f'{case}_inference.zip')
+
+    # job state is kept server-side so that any worker can answer /status and /download.
+    # the session only carries the job id
+    jobs = current_app.extensions['jobstore']
+    adm = current_app.extensions['admission']
+    job_id, busy = admit_job(case, filename, request.args.get('job_id'), output=output_zip)
+    if busy is not None:
+        return busy
+    session['job_id'] = job_id
     session['output_zip'] = output_zip
-    
+
+    # stage events with progress and ETA, log output coalesced to a bounded rate
+    stream = ProgressStream(['case', 'preprocess', 'predict', 'postprocess'], current_app.extensions['stage_timings'],
+                            fmt=request.args.get('format', 'sse'), listener=job_listener(jobs, job_id))
+
     def generate():
+        yield stream.event('job', job_id=job_id)
         try:
             # First do the Case instantiation
-            yield "Initializing case...\n"
             try:
-                case_obj = Case(case, args.uploaddir, args.niftidir, args.datadir)
-                yield "Case initialized successfully\n"
+                yield from stream.run_callable('case', Case, case, cfg['UPLOADDIR'], cfg['NIFTIDIR'], cfg['DATADIR'])
             except RegistrationError:
-                yield f"Registration failure, case {case}\n"
-                return
-            
-            # Then run preprocessing
-            yield "Starting preprocessing...\n"
-            preprocess = subprocess.Popen(
-                [sys.executable, "-m", "nnunet2d_predict_preprocess"],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                text=True,
-                bufsize=1
-            )
-            
-            # Read and yield preprocessing output
-            for line in iter(preprocess.stdout.readline, ""):
-                print(line, end='', flush=True)
-                yield line.strip() + '\n'
-                
-            preprocess.stdout.close()
-            preprocess.wait()
-            
-            if preprocess.returncode != 0:
-                yield f"Preprocessing exited with code {preprocess.returncode}\n"
+                yield stream.event('done', ok=False, message=f"Registration failure, case {case}")
                 return
-                
-            yield "Preprocessing completed successfully\n"
-            
-            # Then run the nnUNet process
-            yield "Starting nnUNet process...\n"
-            process = subprocess.Popen(
-                [sys.executable, "-m", "nnunet2d_predict_wrapper"],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                text=True,
-                bufsize=1
-            )
-            
-            # Read and yield output in real-time
-            for line in iter(process.stdout.readline, ""):
-                print(line, end='', flush=True)
-                yield line.strip() + '\n'
-                
-            process.stdout.close()
-            process.wait()
-            
-            if process.returncode != 0:
-                yield f"Process exited with code {process.returncode}\n"
-                return
-                
-            yield "nnUNet process completed successfully\n"
-            
-            # Finally run postprocessing
-            yield "Starting postprocessing...\n"
-            postprocess_cmd = [
-                "python", "nnunet2d_predict_postprocess.py",
-                "--datadir", args.datadir
-            ]
-            postprocess_process = subprocess.Popen(
-                postprocess_cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True,
-                bufsize=1
-            )
-            
-            while True:
-                line = postprocess_process.stdout.readline()
-                if not line and postprocess_process.poll() is not None:
-                    break
-                if line:
-                    yield line
-                    sys.stdout.flush()
-            
-            postprocess_process.stdout.close()
-            postprocess_process.wait()
-            
-            if postprocess_process.returncode != 0:
-                stderr = postprocess_process.stderr.read()
-                yield f"Error in postprocessing: {stderr}\n"
-                return
-            
-            yield "Postprocessing completed successfully.\n"
-            sys.stdout.flush()
-            yield f"Output file ready for download: {os.path.basename(output_zip)}\n"
-            sys.stdout.flush()
-                
+
+            # Then run preprocessing, the nnUNet process and postprocessing
+            for stage, cmd in [
+                ('preprocess', [sys.executable, "-m", "nnunet2d_predict_preprocess", "--datadir", cfg['DATADIR']]),
+                ('predict', [sys.executable, "-m", "nnunet2d_predict_wrapper", "--datadir", cfg['DATADIR']]),
+                ('postprocess', [sys.executable, "nnunet2d_predict_postprocess.py", "--datadir", cfg['DATADIR']]),
+            ]:
+                if stage == 'predict':
+                    for waited in adm.acquire_gpu(job_id):
+                        yield stream.event('waiting', resource='gpu', waited=round(waited, 1))
+                yield from stream.run_stage(stage, cmd, cwd=demodir)
+                if stage == 'predict':
+                    adm.release_gpu(job_id)
+                if stream.returncode != 0:
+                    yield stream.event('done', ok=False)
+                    return
+
+            yield stream.event('done', ok=True, output=os.path.basename(output_zip))
+
         except Exception as e:
-            yield f"Error during processing: {str(e)}\n"
+            yield stream.event('error', message=f"Error during processing: {str(e)}")
+            jobs.update_job(job_id, state='failed')
             raise
+        finally:
+            close_job(jobs, adm, job_id)
 
-    return Response(generate(), mimetype='text/plain')
+    return Response(generate(), mimetype=stream.mimetype)
 
 
 
-@app.route('/download', methods=['POST'])
+# warm nnU-Net predictor of this worker. loaded lazily, CUDA can't be initialized before a fork
+def get_predictor(configuration='2d'):
+    key = 'predictor_' + configuration
+    if key not in current_app.extensions:
+        from predictor import WarmPredictor
+        cfg = current_app.config
+        if configuration == '2d':
+            current_app.extensions[key] = WarmPredictor(dataset=cfg['NNUNET_DATASET'], configuration=configuration,
+                                                        batch_size=cfg['BATCH_SIZE'])
+        else:
+            current_app.extensions[key] = WarmPredictor(dataset=cfg['NNUNET_DATASET_3D'], configuration=configuration,
+                                                        tile_step_size=cfg['TILE_STEP_SIZE'],
+                                                        patch_batch_size=cfg['PATCH_BATCH_SIZE'])
+    return current_app.extensions[key]
+
+
+# several uploaded cases in one request. preprocessing runs in parallel and all slices go
+# through one warm predictor, with a separate archive and job record per case
+@heavy.route("/run_batch", methods=['POST'])
+def run_batch():
+    data = request.get_json()
+    filenames = data.get('filenames', None)
+    if not filenames:
+        return jsonify({"error": "No filenames received"}), 400
+
+    # orientations, mirroring and fusion per request, to trade accuracy for latency.
+    # probmaps adds the quantized class probabilities of each study to the archive
+    opts = {'orients': data.get('orients', list(fusion.orientations)), 'mirror': data.get('mirror', None),
+            'fusion': data.get('fusion', 'or'), 'probmaps': bool(data.get('probmaps', False))}
+    if opts['fusion'] not in fusion.methods or not opts['orients'] or \
+            not set(opts['orients']) <= set(fusion.orientations):
+        return jsonify({"error": "Invalid fusion options"}), 400
+    configuration = data.get('configuration', '2d')
+    if configuration not in ('2d', '3d_fullres'):
+        return jsonify({"error": "Invalid configuration"}), 400
+
+    cfg = current_app.config
+    cases = [f.split('.')[0] for f in filenames]
+    jobs = current_app.extensions['jobstore']
+    adm = current_app.extensions['admission']
+    # the model is loaded before any leases are taken, a failure here holds nothing
+    predictor = get_predictor(configuration)
+    job_id, busy = admit_job('batch', ','.join(filenames), data.get('job_id'), ncases=len(cases))
+    if busy is not None:
+        return busy
+    # from here the leases are held, and are only released by close_job. until the generator
+    # takes over, an error has to release them here
+    case_jobs = {}
+    try:
+        # per-case records so that /status and /download work for each case of the batch
+        for c, f in zip(cases, filenames):
+            case_jobs[c] = jobs.create_job(c, filename=f)
+            jobs.update_job(case_jobs[c], state='running')
+        stream = ProgressStream(['case', 'predict', 'postprocess'], current_app.extensions['stage_timings'],
+                                fmt=request.args.get('format', 'sse'), listener=job_listener(jobs, job_id))
+    except BaseException:
+        close_job(jobs, adm, job_id, case_jobs.values())
+        raise
+
+    # cases are reported one at a time as they come out of the pipeline
+    def generate_pipelined():
+        yield stream.event('job', job_id=job_id, case_jobs=case_jobs)
+        t0 = time.time()
+        outputs = {}
+        try:
+            # the gpu slot is held for the whole batch since predictions are interleaved with the other stages
+            for waited in adm.acquire_gpu(job_id):
+                yield stream.event('waiting', resource='gpu', waited=round(waited, 1))
+            for c, res in batch.run_pipelined(predictor, cases, cfg['UPLOADDIR'], cfg['NIFTIDIR'], cfg['DATADIR'],
+                                              nworkers=cfg['PREPROCESS_WORKERS'], **opts):
+                if isinstance(res, str):
+                    outputs[c] = res
+                    jobs.update_job(case_jobs[c], state='done', output=res)
+                    yield stream.event('case_done', case=c, ok=True, output=os.path.basename(res),
+                                       completed=len(outputs))
+                else:
+                    jobs.update_job(case_jobs[c], state='failed', error='{} failed: {}'.format(res.stage, res.error))
+                    yield stream.event('case_done', case=c, ok=False, message=str(res))
+            rate = 3600 * len(outputs) / (time.time() - t0)
+            yield stream.event('done', ok=True, outputs={c: os.path.basename(o) for c, o in outputs.items()},
+                               cases_per_hour=round(rate, 2))
+        finally:
+            close_job(jobs, adm, job_id, case_jobs.values())
+
+    def generate():
+        yield stream.event('job', job_id=job_id, case_jobs=case_jobs)
+        t0 = time.time()
+        ok = []
+        try:
+            yield from stream.run_callable('case', batch.preprocess_cases, cases, cfg['UPLOADDIR'], cfg['NIFTIDIR'],
+                                           cfg['DATADIR'], nworkers=cfg['PREPROCESS_WORKERS'])
+            ok = stream.result
+            for waited in adm.acquire_gpu(job_id):
+                yield stream.event('waiting', resource='gpu', waited=round(waited, 1))
+            yield from stream.run_callable('predict', batch.predict_cases, predictor, cfg['NIFTIDIR'], ok, **opts)
+            adm.release_gpu(job_id)
+            vols, preds, probs = stream.result
+            yield from stream.run_callable('postprocess', batch.write_results, cfg['DATADIR'], cfg['NIFTIDIR'],
+                                           vols, preds, probs, opts['fusion'], opts['probmaps'])
+            outputs = stream.result
+            for c, j in case_jobs.items():
+                if c in outputs:
+                    jobs.update_job(j, state='done', output=outputs[c])
+                else:
+                    jobs.update_job(j, state='failed', error='preprocessing failed')
+            rate = 3600 * len(outputs) / (time.time() - t0)
+            yield stream.event('done', ok=True, outputs={c: os.path.basename(o) for c, o in outputs.items()},
+                               cases_per_hour=round(rate, 2))
+        except Exception as e:
+            for c, j in case_jobs.items():
+                jobs.update_job(j, state='failed', error=str(e))
+            yield stream.event('done', ok=False, message=str(e))
+            raise
+        finally:
+            close_job(jobs, adm, job_id, case_jobs.values())
+
+    if cfg['PIPELINED']:
+        return Response(generate_pipelined(), mimetype=stream.mimetype)
+    return Response(generate(), mimetype=stream.mimetype)
+
+
+# create a job, or take up a queued one again on retry, and try to admit it against
+# the resource budgets. returns (job_id,None) if admitted, otherwise (job_id,response)
+# with a 429 carrying the queue position
+def admit_job(case, filename, job_id=None, output=None, ncases=1):
+    cfg = current_app.config
+    jobs = current_app.extensions['jobstore']
+    adm = current_app.extensions['admission']
+    job = jobs.get_job(job_id) if job_id else None
+    if job is None or job['state'] != 'queued':
+        if not adm.can_queue():
+            return None, (jsonify({"error": "Server busy, queue is full"}), 429, {"Retry-After": str(cfg['RETRY_AFTER'])})
+        job_id = jobs.create_job(case, filename=filename, output=output)
+
+    upload_bytes = 0
+    for f in filename.split(','):
+        upload = jobs.get_upload(f)
+        upload_bytes += os.path.getsize(upload['path']) if upload and os.path.exists(upload['path']) else 0
+    ram = adm.estimate_ram(cfg['DATADIR'], upload_bytes, ncases=ncases)
+    admitted, pos = adm.admit(job_id, ram, ncases=ncases)
+    if not admitted:
+        return job_id, (jsonify({"job_id": job_id, "queue_position": pos, "retry_after": cfg['RETRY_AFTER']}),
+                        429, {"Retry-After": str(cfg['RETRY_AFTER'])})
+    return job_id, None
+
+
+@light.route('/metrics')
+def metrics():
+    return Response(current_app.extensions['admission'].metrics(), mimetype='text/plain')
+
+
+# end of a streamed job. a generator left before its 'done' event, by an exception or by
+# the client disconnecting (GeneratorExit, which 'except Exception' doesn't see), would
+# otherwise leave the job running forever and /download refusing it
+def close_job(jobs, adm, job_id, case_jobs=()):
+    for j in (job_id, *case_jobs):
+        jobs.fail_unfinished(j, error='interrupted')
+    adm.release(job_id)
+
+
+# record stage progress of a streamed job in the job store
+def job_listener(jobs, job_id):
+    def listener(ev):
+        if ev['event'] == 'stage_start':
+            jobs.update_job(job_id, state='running', stage=ev['stage'])
+        elif ev['event'] == 'stage_end':
+            jobs.update_job(job_id, timings={ev['stage']: ev['duration']})
+        elif ev['event'] == 'error':
+            jobs.update_job(job_id, error=ev.get('message'))
+        elif ev['event'] == 'done':
+            jobs.update_job(job_id, state='done' if ev['ok'] else 'failed', stage=None)
+    return listener
+
+
+# look up the job from an explicit job_id or filename in the request, falling back to the session
+def find_job():
+    jobs = current_app.extensions['jobstore']
+    data = request.get_json(silent=True) or {}
+    job_id = request.args.get('job_id') or data.get('job_id')
+    filename = request.args.get('filename') or data.get('filename')
+    if job_id:
+        return jobs.get_job(job_id)
+    if filename:
+        return jobs.latest_job(filename.split('.')[0])
+    if session.get('job_id'):
+        return jobs.get_job(session['job_id'])
+    return None
+
+
+@light.route('/status', methods=['GET','POST'])
+def status():
+    job = find_job()
+    if job is None:
+        return jsonify({"error": "No job found"}), 404
+    return jsonify(job), 200
+
+
+@light.route('/download', methods=['POST'])
 def download_inference():
-    # Get the output zip path from session
-    output_zip = session.get('output_zip')
+    # Get the output zip path from the job store, or the session for a job run before the store existed
+    job = find_job()
+    if job is not None:
+        if job['state'] != 'done':
+            return jsonify({"error": f"Job is {job['state']}", "job_id": job['job_id']}), 409
+        output_zip = job['output']
+    else:
+        output_zip = session.get('output_zip')
     if not output_zip:
         return jsonify({"error": "No output file found"}), 404
 
@@ -231,7 +452,7 @@ def download_inference():
     filename = os.path.basename(output_zip)
 
     # Copy the file to the download directory
-    download_path = os.path.join(args.downloaddir, filename)
+    download_path = os.path.join(current_app.config['DOWNLOADDIR'], filename)
     shutil.copy2(output_zip, download_path)
 
     return jsonify({"message": f"Downloaded: {filename}"}), 200
@@ -239,6 +460,20 @@ def download_inference():
 
 if __name__ == "__main__":
 
+    # development server. for production use wsgi.py with gunicorn, see gunicorn.conf.py
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default=Config.HOST)
+    parser.add_argument("--port", type=int, default=Config.PORT)
+    parser.add_argument("--checkpoint", type=str, default=Config.CHECKPOINT)
+    parser.add_argument("--uploaddir", type=str, default=Config.UPLOADDIR)
+    parser.add_argument("--downloaddir", type=str, default=Config.DOWNLOADDIR)
+    parser.add_argument("--niftidir", type=str, default=Config.NIFTIDIR)
+    parser.add_argument("--datadir", type=str, default=Config.DATADIR)
+    parser.add_argument("--reload", action="store_true")
+    args = parser.parse_args()
+
+    app = create_app({k.upper():v for k,v in vars(args).items() if k != 'reload'})
+
     # something about a hot reloader when in debug mode, which double-allocates tensors on the gpu
-    # can optionally force it not to use the reloader if short of gpu memory
-    app.run(host=f"{args.host}", port=f"{args.port}", debug=True, use_reloader=True)
+    # so the reloader is now off unless requested
+    app.run(host=f"{args.host}", port=f"{args.port}", debug=True, use_reloader=args.reload)
@@ -0,0 +1,289 @@
+# batch inference for several uploaded cases at once. the CPU preprocessing (dicom
+# conversion, registration, resampling) of the cases runs in parallel processes, then
+# the slices of all cases are fed through one warm predictor in large batches per
+# orientation, and each case gets its own composite volume and result archive.
+#
+#   python -m batch --cases M00001 M00002 M00003 --datadir /data/radnec2/
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+from nnunet2d_predict_preprocess import load_case_volumes,get_slices,olist
+from nnunet2d_predict_postprocess import write_archive,writenifti
+from fusion import fuse
+from probmaps import write_probmap
+from brainbox import uncrop
+
+# image channels of the 3d model, as linked by DcmStudy.segment with suffixes _0000,_0003
+model_channels_3d = ('t1+','flair')
+
+
+def is_3d(predictor):
+    return predictor.configuration != '2d'
+
+
+# volumes of a case in the form the predictor takes, the 3d model runs on the
+# processed intensities rather than the 8 bit png scaling
+def load_volumes(predictor,niftidir,c):
+    if is_3d(predictor):
+        return load_case_volumes(niftidir,c,channels=model_channels_3d,type=None)
+    return load_case_volumes(niftidir,c)
+
+
+# construct a Case in a worker process. returns (case,ok)
+def prepare_case(case,uploaddir,niftidir,datadir):
+    from DcmCase import Case,RegistrationError
+    try:
+        Case(case,uploaddir,niftidir,datadir)
+    except RegistrationError:
+        print('Registration failure, case {}'.format(case))
+        return case,False
+    return case,True
+
+
+# preprocess cases in parallel, returns the list of cases that succeeded
+def preprocess_cases(cases,uploaddir,niftidir,datadir,nworkers=4):
+    n = len(cases)
+    with ProcessPoolExecutor(max_workers=max(1,min(nworkers,n)),mp_context=multiprocessing.get_context('spawn')) as ex:
+        res = list(ex.map(prepare_case,cases,[uploaddir]*n,[niftidir]*n,[datadir]*n))
+    return [c for c,ok in res if ok]
+
+
+# predict every study of every case. slices of the same shape from all cases are
+# concatenated and predicted together. returns (vols,preds) keyed by case and study,
+# with preds[case][study][orientation] a 3d label volume
+# fusion options are passed on to predict_vols. returns (vols,preds,probs), probs
+# is None unless needed for 'mean' fusion or probability map output.
+# with a 3d predictor, preds[case][study] is the label volume itself
+def predict_cases(predictor,niftidir,cases,orients=('ax','sag','cor'),mirror=None,fusion='or',probmaps=False):
+    vols = {c:load_volumes(predictor,niftidir,c) for c in cases}
+    return (vols,*predict_any(predictor,vols,orients,mirror,fusion,probmaps))
+
+
+# dispatch to the 2d or 3d path. returns (preds,probs)
+def predict_any(predictor,vols,orients=('ax','sag','cor'),mirror=None,fusion='or',probmaps=False):
+    if is_3d(predictor):
+        if probmaps:
+            return predict_vols_3d(predictor,vols,mirror,return_probabilities=True)
+        return predict_vols_3d(predictor,vols,mirror),None
+    if fusion == 'mean' or probmaps:
+        return predict_vols(predictor,vols,orients,mirror,return_probabilities=True)
+    return predict_vols(predictor,vols,orients,mirror),None
+
+
+# sliding window prediction with the 3d model, one study at a time on the processed volumes.
+# returns preds[case][study] label volumes, and probs likewise if return_probabilities
+def predict_vols_3d(predictor,vols,mirror=None,return_probabilities=False):
+    preds = {c:{} for c in vols.keys()}
+    probs = {c:{} for c in vols.keys()}
+    for c in vols.keys():
+        for s in vols[c].keys():
+            img = np.stack([vols[c][s][ik] for ik in model_channels_3d])
+            # MNI grid is 1mm isotropic
+            spacing = np.abs(np.diag(vols[c][s]['affine'])[2::-1])
+            t0 = time.time()
+            res = predictor.predict_volume(img,spacing,return_probabilities=return_probabilities,mirror=mirror)
+            print('3d: {} {} {} in {:.1f} sec'.format(c,s,np.shape(img)[1:],time.time()-t0))
+            if return_probabilities:
+                preds[c][s],probs[c][s] = res[0],res[1].astype(np.float32)
+            else:
+                preds[c][s] = res
+    return (preds,probs) if return_probabilities else preds
+
+
+# predictions for volumes already loaded, {case:{study:{channel:array}}}.
+# slices of the same in-plane shape, from any orientation, case or study, go through the
+# predictor together. shapes aren't padded to a common size, which would change the
+# sliding window tiling. a stacked chunk is still cropped to the nonzero box of all its
+# slices together, see predictor.pointwise_norms, so labels can differ slightly from
+# predicting each slice on its own.
+# orients - subset of 'ax','sag','cor' to predict
+# mirror - test-time mirroring, None for the predictor default
+# returns preds, and probs in the same layout with (nclasses,...) volumes if return_probabilities
+def predict_vols(predictor,vols,orients=('ax','sag','cor'),mirror=None,return_probabilities=False):
+    cases = list(vols.keys())
+    preds = {c:{s:{} for s in vols[c].keys()} for c in cases}
+    probs = {c:{s:{} for s in vols[c].keys()} for c in cases}
+    groups = {}
+    for dim,o in olist:
+        if o not in orients:
+            continue
+        for c in cases:
+            for s in vols[c].keys():
+                sl = get_slices(vols[c][s],dim)
+                groups.setdefault(sl.shape[2:],[]).append((c,s,dim,o,sl))
+
+    for shape,items in groups.items():
+        stack = np.concatenate([sl for *_,sl in items],axis=0)
+        t0 = time.time()
+        res = predictor.predict_slices(stack,return_probabilities=return_probabilities,mirror=mirror)
+        labels,p = res if return_probabilities else (res,None)
+        print('{}: {} slices {} in {:.1f} sec'.format(','.join(sorted(set(o for _,_,_,o,_ in items))),
+                                                     len(stack),shape,time.time()-t0))
+        i0 = 0
+        for c,s,dim,o,sl in items:
+            n = len(sl)
+            preds[c][s][o] = np.moveaxis(labels[i0:i0+n],0,dim)
+            if return_probabilities:
+                probs[c][s][o] = np.moveaxis(p[:,i0:i0+n],1,dim+1)
+            i0 += n
+    return (preds,probs) if return_probabilities else preds
+
+
+# composite volume and archive for each case. returns {case:output_zip}
+# fusion - 'or','vote' or 'mean', the latter needs probs from predict_vols
+# probmaps - also write the quantized per-class probabilities of each study, see probmaps.py
+# outputs go under nnUNet_predictions/batch. nnunet2d_predict_wrapper clears
+# nnUNet_predictions/flask on every /run, which would delete batch archives not yet downloaded
+def write_results(datadir,niftidir,vols,preds,probs=None,fusion='or',probmaps=False):
+    predictiondir = os.path.join(datadir,'nnUNet_predictions','batch')
+    outputs = {}
+    for c in preds.keys():
+        resultsdir = os.path.join(predictiondir,'results',c)
+        shutil.rmtree(resultsdir,ignore_errors=True)
+        os.makedirs(resultsdir,exist_ok=True)
+        for s in preds[c].keys():
+            p = probs[c][s] if probs is not None else None
+            # predictions are on the brain box, the niftis go back on the full grid
+            crop = vols[c][s]['crop']
+            if isinstance(preds[c][s],np.ndarray):
+                # 3d model, its labels are written as they are
+                labels = preds[c][s] if crop is None else uncrop(preds[c][s],*crop)
+                output_fname = os.path.join(resultsdir,'pred_' + c + '_' + s + '_1_3d.nii')
+                writenifti(labels,output_fname,affine=vols[c][s]['affine'],type='uint8')
+                p = {'3d':p} if p is not None else None
+            else:
+                compOR = fuse(preds[c][s],fusion,probs=p)
+                if crop is not None:
+                    compOR = uncrop(compOR,*crop)
+                output_fname = os.path.join(resultsdir,'pred_' + c + '_' + s + '_1_compOR.nii')
+                writenifti(compOR,output_fname,affine=vols[c][s]['affine'])
+            if probmaps and p is not None:
+                write_probmap(os.path.join(resultsdir,'pred_' + c + '_' + s + '_probs.npz'),p,
+                              affine=vols[c][s]['affine'],crop=crop)
+        outputs[c] = write_archive(resultsdir,niftidir,c,os.path.join(predictiondir,c+'_inference.zip'))
+    return outputs
+
+
+# whole batch. returns ({case:output_zip},cases per hour)
+def run_batch(predictor,cases,uploaddir,niftidir,datadir,nworkers=4,orients=('ax','sag','cor'),mirror=None,fusion='or',
+              probmaps=False):
+    t0 = time.time()
+    ok = preprocess_cases(cases,uploaddir,niftidir,datadir,nworkers=nworkers)
+    vols,preds,probs = predict_cases(predictor,niftidir,ok,orients,mirror,fusion,probmaps)
+    outputs = write_results(datadir,niftidir,vols,preds,probs,fusion,probmaps)
+    rate = 3600 * len(outputs) / (time.time()-t0)
+    print('{} cases in {:.1f} sec, {:.1f} cases/hour'.format(len(outputs),time.time()-t0,rate))
+    return outputs,rate
+
+
+# pipelined alternative to run_batch for a stream of cases. case N+1 is preprocessed
+# and loaded while case N is being predicted and case N-1 is reassembled and zipped.
+# nworkers cases are preprocessed at once and at most maxsize cases wait between stages.
+# yields (case,output_zip or Failure) as each case completes. closing the generator
+# stops the pipeline and cancels preprocessing that has not started
+def run_pipelined(predictor,cases,uploaddir,niftidir,datadir,nworkers=2,maxsize=1,
+                  orients=('ax','sag','cor'),mirror=None,fusion='or',probmaps=False):
+    from pipeline import Pipeline,Failure
+    # Case construction is in a process pool, ants and dicom conversion hold the GIL.
+    # spawn rather than fork, the parent has predictor threads and possibly cuda state
+    pool = ProcessPoolExecutor(max_workers=nworkers,mp_context=multiprocessing.get_context('spawn'))
+
+    def prepare(c):
+        if not pool.submit(prepare_case,c,uploaddir,niftidir,datadir).result()[1]:
+            raise RuntimeError('registration failure')
+        return {c:load_volumes(predictor,niftidir,c)}
+
+    def predict(vols):
+        return (vols,*predict_any(predictor,vols,orients,mirror,fusion,probmaps))
+
+    def write(res):
+        return write_results(datadir,niftidir,*res,fusion=fusion,probmaps=probmaps)
+
+    p = Pipeline([('prepare',prepare,nworkers),('predict',predict,1),('write',write,1)],maxsize=maxsize)
+    t0 = time.time()
+    n = 0
+    completed = False
+    try:
+        for c,res in p.run((c,c) for c in cases):
+            if not isinstance(res,Failure):
+                res = res[c]
+                n += 1
+            yield c,res
+        completed = True
+    finally:
+        # on cancellation don't wait for cases still being preprocessed
+        pool.shutdown(wait=completed,cancel_futures=not completed)
+    print('{} cases in {:.1f} sec, {:.1f} cases/hour'.format(n,time.time()-t0,3600*n/(time.time()-t0)))
+    for name,t in p.timings.items():
+        if len(t):
+            print('{}: mean {:.1f} sec'.format(name,np.mean(t)))
+
+
+# latency and peak memory of the three-orientation 2d path against the 3d sliding window
+# path, on cases that have already been preprocessed. predictors - {name:WarmPredictor}
+def benchmark(predictors,niftidir,cases,repeat=2):
+    import resource
+    import torch
+    for name,predictor in predictors.items():
+        vols = {c:load_volumes(predictor,niftidir,c) for c in cases}
+        nstudies = sum(len(v) for v in vols.values())
+        times = []
+        for _ in range(repeat):
+            if torch.cuda.is_available():
+                torch.cuda.reset_peak_memory_stats()
+            t0 = time.time()
+            predict_any(predictor,vols)
+            times.append(time.time()-t0)
+        gpu = torch.cuda.max_memory_allocated() / 1e9 if torch.cuda.is_available() else 0
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e6
+        # the first repeat includes cudnn autotuning
+        print('{}: {} studies, {:.1f} sec/study, peak gpu {:.2f} GB, peak rss {:.2f} GB'.format(
+            name,nstudies,min(times)/nstudies,gpu,rss))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cases", type=str, nargs='+', required=True)
+    parser.add_argument("--uploaddir", type=str, default="/media/jbishop/WD4/brainmets/sunnybrook/radnec2/dicom_upload")
+    parser.add_argument("--niftidir", type=str, default="/media/jbishop/WD4/brainmets/sunnybrook/radnec2/dicom2nifti_upload")
+    parser.add_argument("--datadir", type=str, default="/media/jbishop/WD4/brainmets/sunnybrook/radnec2/")
+    parser.add_argument("--dataset", type=str, default="139")
+    parser.add_argument("--batch_size", type=int, default=256)
+    parser.add_argument("--nworkers", type=int, default=4)
+    parser.add_argument("--pipelined", action="store_true")
+    parser.add_argument("--orients", type=str, nargs='+', default=['ax','sag','cor'])
+    parser.add_argument("--mirror", type=int, default=None) # 0,1 to override the model default
+    parser.add_argument("--fusion", type=str, default='or', choices=['or','vote','mean'])
+    parser.add_argument("--probmaps", action="store_true")
+    parser.add_argument("--configuration", type=str, default='2d', choices=['2d','3d_fullres'])
+    parser.add_argument("--dataset3d", type=str, default="137")
+    parser.add_argument("--tile_step_size", type=float, default=0.5)
+    parser.add_argument("--patch_batch_size", type=int, default=4)
+    parser.add_argument("--benchmark", action="store_true") # 2d against 3d on preprocessed cases
+    args = parser.parse_args()
+    mirror = None if args.mirror is None else bool(args.mirror)
+    opts = {'orients':args.orients,'mirror':mirror,'fusion':args.fusion,'probmaps':args.probmaps}
+
+    from predictor import WarmPredictor
+    def load(configuration):
+        if configuration == '2d':
+            return WarmPredictor(dataset=args.dataset,configuration='2d',batch_size=args.batch_size)
+        return WarmPredictor(dataset=args.dataset3d,configuration=configuration,tile_step_size=args.tile_step_size,
+                             patch_batch_size=args.patch_batch_size)
+
+    if args.benchmark:
+        benchmark({c:load(c) for c in ['2d','3d_fullres']},args.niftidir,args.cases)
+        sys.exit()
+    predictor = load(args.configuration)
+    if args.pipelined:
+        for c,res in run_pipelined(predictor,args.cases,args.uploaddir,args.niftidir,args.datadir,nworkers=args.nworkers,**opts):
+            print(c,res)
+    else:
+        run_batch(predictor,args.cases,args.uploaddir,args.niftidir,args.datadir,nworkers=args.nworkers,**opts)
@@ -0,0 +1,53 @@
+# bounding box of the brain on the MNI grid. after registration every processed
+# volume is on the MNI grid, of which a large share is background outside the atlas
+# brain mask. the box is computed once from the mask and written as crop.json next
+# to the processed volumes of each study, so that slice export, prediction and
+# reassembly work on the cropped sub-volume and only the final nifti write has to
+# put the result back on the full grid.
+
+import os
+import json
+import numpy as np
+
+fname = 'crop.json'
+
+
+# tuple of slices enclosing the non-zero voxels of mask, padded by margin voxels
+def bbox_from_mask(mask,margin=4):
+    m = np.asarray(mask) > 0
+    if not m.any():
+        return tuple(slice(0,n) for n in m.shape)
+    bbox = []
+    for ax in range(m.ndim):
+        idx = np.flatnonzero(m.any(axis=tuple(a for a in range(m.ndim) if a != ax)))
+        bbox.append(slice(int(max(idx[0]-margin,0)),int(min(idx[-1]+1+margin,m.shape[ax]))))
+    return tuple(bbox)
+
+
+def write_bbox(dirname,bbox,shape):
+    with open(os.path.join(dirname,fname),'w') as fp:
+        json.dump({'bbox':[[int(b.start),int(b.stop)] for b in bbox],'shape':[int(n) for n in shape]},fp)
+
+
+# returns (bbox,shape) for the study directory, or None if it was preprocessed
+# without a crop box
+def read_bbox(dirname):
+    try:
+        with open(os.path.join(dirname,fname)) as fp:
+            meta = json.load(fp)
+    except FileNotFoundError:
+        return None
+    return tuple(slice(a,b) for a,b in meta['bbox']),tuple(meta['shape'])
+
+
+def crop(arr,bbox):
+    return arr[tuple(bbox)]
+
+
+# put a cropped volume back on the full grid. leading axes of arr that aren't
+# in bbox, eg classes, are kept
+def uncrop(arr,bbox,shape,fill=0):
+    lead = np.shape(arr)[:np.ndim(arr)-len(bbox)]
+    full = np.full(tuple(lead)+tuple(shape),fill,dtype=np.asarray(arr).dtype)
+    full[(Ellipsis,)+tuple(bbox)] = arr
+    return full
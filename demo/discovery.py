@@ -0,0 +1,118 @@
+# discovery of dicom and nifti image directories in an uploaded case tree.
+# uses os.scandir with precompiled patterns, and stops listing a directory as soon
+# as it is identified as a dicom series dir, so a series of thousands of slices
+# costs one file name check instead of a regex on every file. the result is
+# grouped into case -> study -> series records in the same pass.
+#
+# run as a script to benchmark against the previous os.walk approach on a
+# synthetic tree:
+#   python -m discovery --ncases 4 --nstudies 3 --nseries 6 --nslices 500
+
+import os
+import re
+import time
+import shutil
+import argparse
+import tempfile
+
+dcm_re = re.compile(r'.*\.dcm',re.IGNORECASE)
+nifti_re = re.compile(r'.*(t1|t2|flair).*\.(nii|nii\.gz)',re.IGNORECASE)
+sep_re = re.compile(r'\/|\\')
+
+
+# walk the tree under root.
+# casedir_prefix - tuple of prefixes identifying the root dir of a case
+# returns (records,niftidirs) where records is {case:{studydir:[seriesdirs]}}
+def scan(root,casedir_prefix=('M','DSC')):
+    records = {}
+    niftidirs = []
+    stack = [root]
+    while stack:
+        d = stack.pop()
+        subdirs = []
+        isseries = False
+        isnifti = False
+        try:
+            with os.scandir(d) as it:
+                for e in it:
+                    if e.is_dir(follow_symlinks=False):
+                        subdirs.append(e.path)
+                    elif dcm_re.match(e.name):
+                        # for now assume that a dir of dicom files is a series dir, and the
+                        # parent of the series dir is the study dir. no need to look further
+                        isseries = True
+                        break
+                    elif not isnifti and nifti_re.match(e.name):
+                        isnifti = True
+        except (PermissionError,FileNotFoundError):
+            continue
+
+        if isseries:
+            studydir = os.path.split(d)[0]
+            case = get_casename(studydir,casedir_prefix)
+            records.setdefault(case,{}).setdefault(studydir,[]).append(d)
+            continue
+        if isnifti:
+            niftidirs.append(d)
+        stack.extend(subdirs)
+
+    return records,niftidirs
+
+
+# the first component of the path that matches a case prefix
+def get_casename(path,casedir_prefix=('M','DSC')):
+    for s in sep_re.split(path):
+        if s.startswith(casedir_prefix):
+            return s
+    raise ValueError('Not all directories match a case prefix')
+
+
+# build a synthetic upload tree of empty dicom files, for benchmarking
+def make_synthetic_tree(root,ncases=2,nstudies=3,nseries=6,nslices=200):
+    for c in range(ncases):
+        for st in range(nstudies):
+            for se in range(nseries):
+                sdir = os.path.join(root,'M{:05d}'.format(c),'2024{:02d}01'.format(st+1),'series{}'.format(se))
+                os.makedirs(sdir,exist_ok=True)
+                for i in range(nslices):
+                    open(os.path.join(sdir,'IM{:06d}.dcm'.format(i)),'w').close()
+    return root
+
+
+# previous os.walk implementation from Case.get_imagedirs, for comparison
+def scan_walk(root):
+    dcmdirs = []
+    niftidirs = []
+    for r,dirs,files in os.walk(root,topdown=True):
+        if len(files):
+            dcmfiles = [f for f in files if re.match(r'.*\.dcm',f.lower())]
+            niftifiles = [f for f in files if re.match(r'.*(t1|t2|flair).*\.(nii|nii\.gz)',f.lower())]
+            if len(dcmfiles):
+                dcmdirs.append(os.path.split(r)[0])
+            if len(niftifiles):
+                niftidirs.append(r)
+    return niftidirs,list(set(dcmdirs))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ncases", type=int, default=2)
+    parser.add_argument("--nstudies", type=int, default=3)
+    parser.add_argument("--nseries", type=int, default=6)
+    parser.add_argument("--nslices", type=int, default=500)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp()
+    try:
+        make_synthetic_tree(root,args.ncases,args.nstudies,args.nseries,args.nslices)
+        for name,fn in [('os.walk',scan_walk),('scandir',scan)]:
+            t0 = time.perf_counter()
+            for i in range(args.repeat):
+                fn(root)
+            print('{}: {:.4f} sec'.format(name,(time.perf_counter()-t0)/args.repeat))
+        records,_ = scan(root)
+        nstudies = sum(len(v) for v in records.values())
+        print('{} cases, {} studies'.format(len(records),nstudies))
+    finally:
+        shutil.rmtree(root)
@@ -0,0 +1,71 @@
+# fusion of the 2d predictions from several slice orientations into one 3d label volume.
+#   'or' - a voxel is labelled if any orientation labels it (the original composite)
+#   'vote' - majority vote of the orientation labels
+#   'mean' - argmax of the softmax probabilities averaged over orientations
+# model labels are 0 background, 1 tumour, 2 radiation necrosis. the fused volume
+# uses the output convention of 6 for tumour and 5 for radiation necrosis.
+
+import numpy as np
+
+methods = ('or','vote','mean')
+orientations = ('ax','sag','cor')
+# model label -> output label
+output_labels = {1:6,2:5}
+# tie-break order among model labels, tumour overwrites necrosis overwrites background
+priority = (0,2,1)
+
+
+# preds - {orientation:label volume}. probs - {orientation:(nclasses,...) softmax}, for 'mean'
+def fuse(preds,method='or',probs=None,orients=None):
+    if orients is None:
+        orients = [o for o in orientations if o in preds]
+    if method == 'or':
+        labels = fuse_or(preds,orients)
+    elif method == 'vote':
+        labels = fuse_vote(preds,orients)
+    elif method == 'mean':
+        if probs is None:
+            raise ValueError('mean fusion needs probabilities')
+        labels = fuse_mean(probs,orients)
+    else:
+        raise ValueError('unknown fusion {}'.format(method))
+    return to_output(labels)
+
+
+# model labels, any orientation, tumour overwrites necrosis
+def fuse_or(preds,orients):
+    labels = np.zeros(np.shape(preds[orients[0]]),dtype=np.uint8)
+    for l in priority[1:]:
+        m = np.zeros(labels.shape,dtype=bool)
+        for o in orients:
+            m |= preds[o] == l
+        labels[m] = l
+    return labels
+
+
+def fuse_vote(preds,orients):
+    labels = np.zeros(np.shape(preds[orients[0]]),dtype=np.uint8)
+    best = np.zeros(labels.shape,dtype=np.uint8)
+    # later labels in priority order win ties
+    for l in priority:
+        n = np.zeros(labels.shape,dtype=np.uint8)
+        for o in orients:
+            n += preds[o] == l
+        m = n >= best
+        labels[m] = l
+        best[m] = n[m]
+    return labels
+
+
+def fuse_mean(probs,orients):
+    p = np.zeros(np.shape(probs[orients[0]]),dtype=np.float32)
+    for o in orients:
+        p += probs[o]
+    return np.argmax(p,axis=0).astype(np.uint8)
+
+
+def to_output(labels):
+    out = np.zeros(labels.shape,dtype=np.uint8)
+    for l,v in output_labels.items():
+        out[labels == l] = v
+    return out
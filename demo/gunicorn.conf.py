@@ -0,0 +1,23 @@
+# gunicorn settings for wsgi:app. the light endpoints (index, upload, download) and
+# the heavy pipeline endpoints (preprocess, run) can be run as two separate pools
+# with their own worker counts, behind a proxy routing /run and /preprocess to the heavy pool:
+#   FLASKDEMO_ROLE=light gunicorn -c gunicorn.conf.py -b :5000 wsgi:app
+#   FLASKDEMO_ROLE=heavy gunicorn -c gunicorn.conf.py -b :5001 wsgi:app
+# with FLASKDEMO_ROLE=all (default) one pool serves everything with LIGHT_WORKERS.
+
+import os
+
+role = os.environ.get("FLASKDEMO_ROLE", "all")
+if role == "heavy":
+    workers = int(os.environ.get("FLASKDEMO_HEAVY_WORKERS", 1))
+else:
+    workers = int(os.environ.get("FLASKDEMO_LIGHT_WORKERS", 4))
+
+bind = os.environ.get("FLASKDEMO_BIND", "{}:{}".format(os.environ.get("FLASKDEMO_HOST", "localhost"),
+                                                       os.environ.get("FLASKDEMO_PORT", 5000)))
+# load the app, and the shared reference data in create_app(), once before forking
+preload_app = True
+# the pipeline responses stream for minutes, threads keep a worker from blocking on one client
+worker_class = "gthread"
+threads = int(os.environ.get("FLASKDEMO_THREADS", 4))
+timeout = 0 if role in ("heavy", "all") else 60
@@ -0,0 +1,228 @@
+# server-side store of uploads and pipeline jobs, so that any app worker or host can
+# answer status and download requests instead of relying on the session cookie and
+# the local filesystem of whichever worker ran the job.
+#
+# JobStore defines the interface, SQLiteJobStore is the default backend. sqlite in WAL
+# mode with a busy timeout is safe for several worker processes on one host, a shared
+# backend for multiple hosts can be added by subclassing JobStore and open_jobstore().
+
+import os
+import json
+import time
+import uuid
+import sqlite3
+import contextlib
+import threading
+from abc import ABC, abstractmethod
+
+
+class JobStore(ABC):
+
+    # record an uploaded file
+    @abstractmethod
+    def add_upload(self,filename,path):
+        pass
+
+    @abstractmethod
+    def get_upload(self,filename):
+        pass
+
+    # create a job for a case and return its id
+    @abstractmethod
+    def create_job(self,case,filename=None,output=None):
+        pass
+
+    # update any of state,stage,output,error on a job and its updated time. timings
+    # is a dict of stage durations merged into the stored ones, atomically
+    @abstractmethod
+    def update_job(self,job_id,timings=None,**fields):
+        pass
+
+    # mark a job failed unless it already finished, eg when its client went away
+    @abstractmethod
+    def fail_unfinished(self,job_id,error=None):
+        pass
+
+    @abstractmethod
+    def get_job(self,job_id):
+        pass
+
+    # most recent job for a case, optionally restricted to a state
+    @abstractmethod
+    def latest_job(self,case,state=None):
+        pass
+
+    # context in which a sequence of the calls here is atomic across workers,
+    # for admission decisions. calls made inside it join it
+    @abstractmethod
+    def transaction(self):
+        pass
+
+    # ids of queued jobs, oldest first
+    @abstractmethod
+    def queued_jobs(self):
+        pass
+
+    # drop leases past their expiry, and fail queued jobs not touched since stale_before
+    @abstractmethod
+    def expire(self,now,stale_before):
+        pass
+
+    # leases held against resource budgets, {resource:amount} summed over jobs
+    @abstractmethod
+    def lease_usage(self):
+        pass
+
+    # leases is {resource:amount}, held by the job until expires or released
+    @abstractmethod
+    def add_leases(self,job_id,leases,expires):
+        pass
+
+    # release the leases of a job, on one resource or all of them
+    @abstractmethod
+    def release_leases(self,job_id,resource=None):
+        pass
+
+
+class SQLiteJobStore(JobStore):
+
+    states = ('queued','running','done','failed')
+
+    def __init__(self,fname,timeout=30.0):
+        self.fname = fname
+        self.timeout = timeout
+        self.local = threading.local()
+        d = os.path.dirname(fname)
+        if d:
+            os.makedirs(d,exist_ok=True)
+        con = self._connect()
+        with con:
+            con.execute('''create table if not exists uploads (
+                            filename text primary key, path text, created real)''')
+            con.execute('''create table if not exists jobs (
+                            job_id text primary key, case_name text, filename text, state text,
+                            stage text, output text, error text, timings text,
+                            created real, updated real)''')
+            con.execute('create index if not exists jobs_case on jobs (case_name, created)')
+            con.execute('''create table if not exists leases (
+                            job_id text, resource text, amount real, expires real)''')
+
+    # one connection per thread, sqlite connections aren't shared across threads
+    def _connect(self):
+        con = getattr(self.local,'con',None)
+        if con is None:
+            con = sqlite3.connect(self.fname,timeout=self.timeout)
+            con.row_factory = sqlite3.Row
+            con.execute('pragma journal_mode=wal')
+            con.execute('pragma synchronous=normal')
+            self.local.con = con
+        return con
+
+    # write transaction that takes the database lock up front, for read-modify-write
+    # sequences that have to be atomic across workers. a nested one joins the outer
+    @contextlib.contextmanager
+    def transaction(self):
+        con = self._connect()
+        if con.in_transaction:
+            yield con
+            return
+        con.execute('begin immediate')
+        try:
+            yield con
+        except Exception:
+            con.rollback()
+            raise
+        else:
+            con.commit()
+
+    def add_upload(self,filename,path):
+        with self.transaction() as con:
+            con.execute('insert or replace into uploads values (?,?,?)',(filename,path,time.time()))
+
+    def get_upload(self,filename):
+        row = self._connect().execute('select * from uploads where filename=?',(filename,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def create_job(self,case,filename=None,output=None):
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self.transaction() as con:
+            con.execute('insert into jobs values (?,?,?,?,?,?,?,?,?,?)',
+                        (job_id,case,filename,'queued',None,output,None,'{}',now,now))
+        return job_id
+
+    def update_job(self,job_id,timings=None,**fields):
+        if 'state' in fields and fields['state'] not in self.states:
+            raise ValueError('unknown job state {}'.format(fields['state']))
+        # the timings merge is a read-modify-write, so the lock is taken before the read
+        with self.transaction() as con:
+            if timings is not None:
+                row = con.execute('select timings from jobs where job_id=?',(job_id,)).fetchone()
+                t = json.loads(row['timings']) if row is not None else {}
+                t.update(timings)
+                fields['timings'] = json.dumps(t)
+            # with no fields this only touches the job
+            fields['updated'] = time.time()
+            cols = ','.join('{}=?'.format(k) for k in fields.keys())
+            con.execute('update jobs set {} where job_id=?'.format(cols),(*fields.values(),job_id))
+
+    def fail_unfinished(self,job_id,error=None):
+        with self.transaction() as con:
+            con.execute("update jobs set state='failed',error=coalesce(?,error),updated=? "
+                        "where job_id=? and state not in ('done','failed')",(error,time.time(),job_id))
+
+    def get_job(self,job_id):
+        row = self._connect().execute('select * from jobs where job_id=?',(job_id,)).fetchone()
+        return self._job(row)
+
+    def latest_job(self,case,state=None):
+        if state is None:
+            row = self._connect().execute('select * from jobs where case_name=? order by created desc limit 1',
+                                          (case,)).fetchone()
+        else:
+            row = self._connect().execute('select * from jobs where case_name=? and state=? order by created desc limit 1',
+                                          (case,state)).fetchone()
+        return self._job(row)
+
+    def queued_jobs(self):
+        rows = self._connect().execute("select job_id from jobs where state='queued' order by created").fetchall()
+        return [r['job_id'] for r in rows]
+
+    def expire(self,now,stale_before):
+        with self.transaction() as con:
+            con.execute('delete from leases where expires < ?',(now,))
+            con.execute("update jobs set state='failed',error='abandoned in queue',updated=? "
+                        "where state='queued' and updated < ?",(now,stale_before))
+
+    def lease_usage(self):
+        rows = self._connect().execute('select resource,sum(amount) from leases group by resource').fetchall()
+        return {r[0]:r[1] for r in rows}
+
+    def add_leases(self,job_id,leases,expires):
+        with self.transaction() as con:
+            con.executemany('insert into leases values (?,?,?,?)',
+                            [(job_id,r,a,expires) for r,a in leases.items()])
+
+    def release_leases(self,job_id,resource=None):
+        with self.transaction() as con:
+            if resource is None:
+                con.execute('delete from leases where job_id=?',(job_id,))
+            else:
+                con.execute('delete from leases where job_id=? and resource=?',(job_id,resource))
+
+    def _job(self,row):
+        if row is None:
+            return None
+        job = dict(row)
+        job['case'] = job.pop('case_name')
+        job['timings'] = json.loads(job['timings'])
+        return job
+
+
+# url is 'sqlite:///path/to/jobs.db' or a plain file path
+def open_jobstore(url):
+    if url.startswith('sqlite:///'):
+        return SQLiteJobStore(url[len('sqlite:///'):])
+    elif '://' not in url:
+        return SQLiteJobStore(url)
+    raise ValueError('unsupported job store {}'.format(url))
@@ -20,6 +20,10 @@ import shutil
 import subprocess
 import sys
 
+import fusion
+import brainbox
+from nnunet2d_predict_preprocess import olist
+
 # load a single nifti file
 def loadnifti(t1_file,dir,type=None):
     img_arr_t1 = None
@@ -48,10 +52,21 @@ def writenifti(img_arr,filename,header=None,norm=False,type='float64',affine=Non
     if True:
         os.system('gzip --force "{}"'.format(filename))
 
-def recycle_dims(alist):
-    while True:
-        for item in alist:
-            yield item
+# composite of the ax,sag,cor predictions. a voxel is labelled if any orientation
+# labels it, with tumour (6) overwriting radiation necrosis (5)
+def fuse_or(pred_3d):
+    return fusion.fuse(pred_3d,'or')
+
+# zip the results of one case, along with its nifti input files for reference
+def write_archive(resultsdir,niftidir,case,output_zip):
+    for studydir in glob.glob(os.path.join(niftidir,case, '*')):
+        shutil.copytree(studydir, os.path.join(resultsdir,os.path.basename(studydir)),dirs_exist_ok=True)
+    # zip runs in resultsdir, so a relative output path has to be resolved first
+    output_zip = os.path.abspath(output_zip)
+    if os.path.exists(output_zip):
+        os.remove(output_zip)
+    subprocess.run(['zip','-r','-q',output_zip,'.'],cwd=resultsdir,check=True)
+    return output_zip
 
 def main(datadir):
     niftidir = os.path.join(datadir,'dicom2nifti_upload')
@@ -63,15 +78,13 @@ def main(datadir):
         pass
     os.makedirs(resultsdir,exist_ok=True)
 
-    # hard-coded convention from nnunet_predict_preprocess
-    olist = [(0,'ax'),(1,'sag'),(2,'cor')]
-    orients = recycle_dims(olist)
-
     cases = sorted(set([re.search('(M|DSC)_?[0-9]*',f)[0] for f in os.listdir(niftidir)]))
 
     for case in cases:
 
         print('processing case {}'.format(case))
+        caseresultsdir = os.path.join(resultsdir,case)
+        os.makedirs(caseresultsdir,exist_ok=True)
 
         preds = sorted([f for f in os.listdir(predictiondir) if case in f])
         studies = sorted(set([re.search('[0-9]{8}',f)[0] for f in preds]))
@@ -83,6 +96,7 @@ def main(datadir):
             # try to load original nifti volume for reference
             # image dim, affine should be saved in a json instead during preprocess script
             imgs_nii = {}
+            crop = brainbox.read_bbox(os.path.join(niftidir,case,s))
             for ik in ['flair+','t1+','flair','t1']:
                 filename = glob.glob(os.path.join(niftidir,case,s,ik+'_processed*'))
                 if len(filename):
@@ -90,70 +104,37 @@ def main(datadir):
                     imgs_nii[ik],affine = loadnifti(os.path.split(filename[0])[1],os.path.join(niftidir,case,s),type='uint8')
                     image_dim = np.shape(imgs_nii[ik])
                     break # ie processed images are all resampled to same matrix
+            # slices were exported from the brain box only
+            if crop is not None:
+                image_dim = tuple(b.stop-b.start for b in crop[0])
 
-            pred_3d = {'ax':None,'sag':None,'cor':None,'comp_OR':None,'comp_AND':None}
-
-            for k in pred_3d.keys():
-                pred_3d[k] = np.zeros(image_dim)
-
-            orient = next(recycle_dims(orients))
-            pred_3d[orient[1]] = np.moveaxis(pred_3d[orient[1]],0,orient[0])
-            # since brains aren't currently being extracted, can't easily test for a non-zero slice 
-            # so have to process all slices including air background
-            islice = 0
-            idimold = image_dim[1:] # ie because the images were originally created and labelled starting with 'ax'
+            pred_3d = {}
             study_preds = sorted([f for f in preds if s in f])
 
-            for p in study_preds:
-
-                pfile = os.path.join(predictiondir,p)
-                pred_arr = imageio.v3.imread(pfile)
-                idim = np.array(np.shape(pred_arr))
-
-                if any(idim != idimold):
-                        pred_3d[orient[1]] = np.moveaxis(pred_3d[orient[1]],0,orient[0])
-                        output_fname = os.path.join(predictiondir,'experiment1','pred_3d','pred_' + case + '_' + s + '_' + orient[1] + '.nii')
-                        if False:
-                            writenifti(pred_3d[orient[1]],output_fname,affine=affine)
-                        orient = next(recycle_dims(orients))
-                        pred_3d[orient[1]] = np.moveaxis(pred_3d[orient[1]],orient[0],0)
-                        islice = 0
-                        idimold = np.copy(idim)
-                else:
-                    pass
-
-                if islice >= np.shape(pred_3d[orient[1]])[0]:
-                    raise IndexError
-                pred_3d[orient[1]][islice] = np.copy(pred_arr)
-                islice += 1
-
-            # output the final 'cor' 3d
-            pred_3d[orient[1]] = np.moveaxis(pred_3d[orient[1]],0,orient[0])
-            output_fname = os.path.join(predictiondir,'experiment1','pred_3d','pred_' + case + '_' + s + '_' + orient[1] + '.nii')
-            if False:
-                writenifti(pred_3d[orient[1]],output_fname,affine=affine)
+            # since brains aren't currently being extracted, can't easily test for a non-zero slice
+            # so have to process all slices including air background
+            for dim,o in olist:
+                # slices of one orientation, in export order from the zero-padded image index
+                opreds = [f for f in study_preds if os.path.splitext(f)[0].endswith('_' + o)]
+                if len(opreds) != image_dim[dim]:
+                    raise IndexError('{} {} {}: {} slices, expected {}'.format(case,s,o,len(opreds),image_dim[dim]))
+                pred_arr = np.stack([imageio.v3.imread(os.path.join(predictiondir,p)) for p in opreds])
+                pred_3d[o] = np.moveaxis(pred_arr,0,dim)
+                output_fname = os.path.join(predictiondir,'experiment1','pred_3d','pred_' + case + '_' + s + '_' + o + '.nii')
+                if False:
+                    writenifti(pred_3d[o],output_fname,affine=affine)
 
             if True: # output composite 3d
-                compT_OR = (pred_3d['ax']==1) | (pred_3d['sag']==1) | (pred_3d['cor']==1)
-                compRN_OR = (pred_3d['ax']==2) | (pred_3d['sag']==2) | (pred_3d['cor']==2)
-                pred_3d['compOR'] = np.zeros(image_dim)
-                pred_3d['compOR'][np.where(compRN_OR)] = 5 
-                pred_3d['compOR'][np.where(compT_OR)] = 6 # T overwrites RN
+                pred_3d['compOR'] = fuse_or(pred_3d)
+                if crop is not None:
+                    pred_3d['compOR'] = brainbox.uncrop(pred_3d['compOR'],*crop)
                 # lesion number hard-coded here
-                output_fname = os.path.join(resultsdir,'pred_' + case + '_' + s + '_1_compOR.nii')
+                output_fname = os.path.join(caseresultsdir,'pred_' + case + '_' + s + '_1_compOR.nii')
                 writenifti(pred_3d['compOR'],output_fname,affine=affine)
 
-        # copy all case nifti files to output directory as well for reference
-        for studydir in glob.glob(os.path.join(niftidir,case, '*')):
-            shutil.copytree(studydir, os.path.join(resultsdir,os.path.basename(studydir)))
-
-    # create download zip file
-    # currently not separated if multiple cases, just named for last case processed
-    current_dir = os.getcwd()
-    os.chdir(resultsdir)
-    command = 'zip -r ' + os.path.join(predictiondir,case+'_inference.zip') + ' *'
-    os.system(command)
-    os.chdir(current_dir)
+        # create download zip file for this case, with all case nifti files as well for reference
+        write_archive(caseresultsdir,niftidir,case,os.path.join(predictiondir,case+'_inference.zip'))
+
     return
 
 
@@ -12,6 +12,8 @@ import matplotlib.pyplot as plt
 from skimage.io import imsave
 import glob
 
+import brainbox
+
 # load a single nifti file
 def loadnifti(t1_file,dir,type=None):
     img_arr_t1 = None
@@ -30,6 +32,32 @@ def loadnifti(t1_file,dir,type=None):
     affine = img_nb_t1.affine
     return img_arr_t1,affine
 
+# slice dimension and name of each orientation, in the order the slices are exported
+olist = [(0,'ax'),(1,'sag'),(2,'cor')]
+
+# image channels of the 2d model, in the order of their file suffixes _0001,_0003
+model_channels = ('t1+','flair+')
+
+# load the processed volumes of every study of a case, with the same 8 bit scaling as the png export.
+# type=None keeps the stored intensities, for the 3d model. the volumes are cropped to the
+# brain box of the study if it has one.
+# returns {study:{channel:array,'affine':affine,'crop':(bbox,shape) or None}}
+def load_case_volumes(niidir,c,channels=model_channels,type='uint8'):
+    cdir = os.path.join(niidir,c)
+    vols = {}
+    for s in sorted(os.listdir(cdir)):
+        vols[s] = {'crop':brainbox.read_bbox(os.path.join(cdir,s))}
+        for ik in channels:
+            filename = glob.glob(os.path.join(cdir,s,ik+'_processed*'))[0]
+            vols[s][ik],vols[s]['affine'] = loadnifti(os.path.split(filename)[1],os.path.join(cdir,s),type=type)
+            if vols[s]['crop'] is not None:
+                vols[s][ik] = brainbox.crop(vols[s][ik],vols[s]['crop'][0])
+    return vols
+
+# all slices of a study along one dimension, stacked as (nslices,nchannels,H,W) for the predictor
+def get_slices(vols,dim):
+    return np.stack([np.moveaxis(vols[ik],dim,0) for ik in model_channels],axis=1)
+
 # main
 def main(datadir):
 
@@ -66,19 +94,25 @@ def main(datadir):
             print('study ' + s)
 
             imgs = {}
+            crop = brainbox.read_bbox(os.path.join(cdir,s))
             for ik in ['flair+','t1+']:
                 filename = glob.glob(os.path.join(s,ik+'_processed*'))[0]
                 # will use 8 bit now for png, but could be 32bit tiffs
                 imgs[ik],_ = loadnifti(os.path.split(filename)[1],os.path.join(cdir,s),type='uint8')
+                # only the brain box is exported, postprocess puts it back on the full grid
+                if crop is not None:
+                    imgs[ik] = brainbox.crop(imgs[ik],crop[0])
 
-            for dim in range(3):
+            # the orientation is part of the name, postprocess can't tell orientations
+            # apart by slice shape when two dimensions of the brain box are equal
+            for dim,o in olist:
                 slices = range(np.shape(imgs[ik])[dim])
                 for slice in slices:
                     imgslice = {}
         
                     for ktag,ik in zip(('0003','0001'),('flair+','t1+')):
                         imgslice[ik] = np.moveaxis(imgs[ik],dim,0)[slice]
-                        fname = 'img_' + str(img_idx).zfill(6) + '_' + c + '_' + s + '_' + ktag + '.png'
+                        fname = 'img_' + str(img_idx).zfill(6) + '_' + c + '_' + s + '_' + o + '_' + ktag + '.png'
                         imsave(os.path.join(output_imgdir,fname),imgslice[ik],check_contrast=False)
                     img_idx += 1
             
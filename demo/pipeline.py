@@ -0,0 +1,128 @@
+# pipelined scheduler for running several items (cases) through a chain of stages.
+# each stage has its own worker threads, and the stages are connected by bounded
+# queues, so while case N is on the GPU case N+1 is being preprocessed and case N-1
+# is being written out. a full queue blocks the stage upstream of it, which keeps
+# the number of cases in memory bounded.
+#
+# closing the generator returned by Pipeline.run, eg when a streaming client goes
+# away, stops the pipeline: blocked workers give up on their queue within a poll
+# interval, no new items are started and queued items are dropped.
+
+import time
+import queue
+import threading
+
+_end = object()
+
+
+# stands in for the result of an item that failed at some stage, and is passed
+# through the remaining stages untouched
+class Failure():
+    def __init__(self,stage,error):
+        self.stage = stage
+        self.error = error
+
+    def __repr__(self):
+        return 'Failure({},{!r})'.format(self.stage,self.error)
+
+
+class Pipeline():
+
+    # stages - list of (name,fn,nworkers). fn takes the output of the previous stage
+    # maxsize - capacity of each queue between stages
+    # poll - seconds between checks for a stop while blocked on a queue
+    def __init__(self,stages,maxsize=1,poll=0.5):
+        self.stages = stages
+        self.maxsize = maxsize
+        self.poll = poll
+        self.timings = {name:[] for name,_,_ in stages}
+        self.lock = threading.Lock()
+        self.stop = threading.Event()
+
+    # queue put and get that give up once the pipeline is stopped. put returns False
+    # and get returns the end marker in that case
+    def _put(self,q,item):
+        while not self.stop.is_set():
+            try:
+                q.put(item,timeout=self.poll)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _get(self,q):
+        while not self.stop.is_set():
+            try:
+                return q.get(timeout=self.poll)
+            except queue.Empty:
+                pass
+        return _end
+
+    def _worker(self,name,fn,qin,qout,nleft):
+        while True:
+            item = self._get(qin)
+            if item is _end:
+                if self.stop.is_set():
+                    return
+                # the last worker of a stage passes the end marker downstream
+                with self.lock:
+                    nleft[0] -= 1
+                    last = nleft[0] == 0
+                if last:
+                    self._put(qout,_end)
+                else:
+                    self._put(qin,_end)
+                return
+            key,x = item
+            if not isinstance(x,Failure):
+                t0 = time.time()
+                try:
+                    x = fn(x)
+                except Exception as e:
+                    print('{} failed for {}: {}'.format(name,key,e))
+                    x = Failure(name,e)
+                with self.lock:
+                    self.timings[name].append(time.time()-t0)
+            if not self._put(qout,(key,x)):
+                return
+
+    # run all items through the stages. yields (key,result) in order of completion,
+    # where result is the output of the last stage or a Failure
+    def run(self,items):
+        self.stop.clear()
+        qs = [queue.Queue(maxsize=self.maxsize) for _ in range(len(self.stages)+1)]
+        threads = []
+        for i,(name,fn,nworkers) in enumerate(self.stages):
+            nleft = [nworkers]
+            for _ in range(nworkers):
+                th = threading.Thread(target=self._worker,args=(name,fn,qs[i],qs[i+1],nleft),daemon=True)
+                th.start()
+                threads.append(th)
+
+        def feed():
+            for key,x in items:
+                if not self._put(qs[0],(key,x)):
+                    return
+            self._put(qs[0],_end)
+        threading.Thread(target=feed,daemon=True).start()
+
+        completed = False
+        try:
+            while True:
+                item = self._get(qs[-1])
+                if item is _end:
+                    break
+                yield item
+            completed = True
+        finally:
+            if not completed:
+                # a worker inside fn finishes that item and then exits, it isn't waited for
+                self.stop.set()
+                for q in qs:
+                    while True:
+                        try:
+                            q.get_nowait()
+                        except queue.Empty:
+                            break
+        for th in threads:
+            th.join()
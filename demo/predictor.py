@@ -0,0 +1,128 @@
+# in-process nnU-Net predictor that is loaded once per worker and kept warm, in place
+# of a nnUNetv2_predict subprocess per request which reloads the model and reads and
+# writes a png per slice. slices from any number of cases are fed through it as
+# stacked arrays in large batches.
+
+import time
+import threading
+import numpy as np
+
+# normalizations that act on each voxel independently, so slices from different
+# images can be stacked into one array and normalized the same as on their own.
+# the stack is still not exactly equivalent to predicting each slice alone: nnU-Net
+# crops the stack to the bounding box of its nonzero voxels over all slices, so a
+# slice is tiled on that union box rather than its own, and voxels outside its own
+# nonzero box are predicted by the network instead of being set to background
+pointwise_norms = ('RGBTo0_1','CTNormalization','NoNormalization','RescaleTo01Normalization')
+
+
+class WarmPredictor():
+
+    # dataset - nnU-Net dataset id of the trained model, eg '139'
+    # configuration - '2d' or '3d_fullres'
+    # folds - folds of the ensemble to load
+    # batch_size - slices per chunk, and patches per forward call, for the 2d model
+    # device - 'cuda' or 'cpu', default is cuda if available
+    # tile_step_size - sliding window step of the 3d model as a fraction of the patch size,
+    #                  ie 0.5 is 50% overlap between neighbouring patches
+    # patch_batch_size - sliding window patches per forward call of the 3d model
+    def __init__(self,dataset='139',configuration='2d',folds=(0,),trainer='nnUNetTrainer',plans='nnUNetPlans',
+                 checkpoint='checkpoint_final.pth',batch_size=256,device=None,tile_step_size=0.5,use_mirroring=True,
+                 patch_batch_size=4):
+        import torch
+        from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+        from nnunetv2.utilities.file_path_utilities import get_output_folder
+
+        if device is None:
+            device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self.device = torch.device(device)
+        self.batch_size = batch_size
+        self.configuration = configuration
+        self.use_mirroring = use_mirroring
+        self.tile_step_size = tile_step_size
+        self.patch_batch_size = patch_batch_size
+        self.gaussian = None
+        # the nnUNetPredictor is shared by the threads of a worker, and mirroring and the
+        # tile step are set on it per call, so each prediction holds it for its duration
+        self.lock = threading.Lock()
+        t0 = time.time()
+        self.predictor = nnUNetPredictor(tile_step_size=tile_step_size,use_gaussian=True,use_mirroring=use_mirroring,
+                                         perform_everything_on_device=self.device.type=='cuda',device=self.device,
+                                         verbose=False,verbose_preprocessing=False,allow_tqdm=False)
+        model_dir = get_output_folder(dataset,trainer,plans,configuration)
+        self.predictor.initialize_from_trained_model_folder(model_dir,use_folds=folds,checkpoint_name=checkpoint)
+        self.stackable = all(n in pointwise_norms for n in self.predictor.configuration_manager.normalization_schemes)
+        # patches per forward call. nnU-Net would run them one at a time, for the 2d model
+        # that is one forward call per slice of the chunk
+        self.patch_batch = batch_size if configuration == '2d' else patch_batch_size
+        if self.patch_batch > 1:
+            self.predictor._internal_predict_sliding_window_return_logits = self._sliding_window
+        print('loaded nnU-Net {} {} in {:.1f} sec'.format(dataset,configuration,time.time()-t0))
+
+    # predict a stack of 2d slices.
+    # slices - array (nslices,nchannels,H,W) in the channel order of the model
+    # mirror - test-time mirroring on or off for this call, default is as loaded
+    # returns labels (nslices,H,W), and if return_probabilities also the
+    # softmax (nclasses,nslices,H,W) as float32
+    def predict_slices(self,slices,return_probabilities=False,mirror=None):
+        with self.lock:
+            self.predictor.use_mirroring = self.use_mirroring if mirror is None else mirror
+            return self._predict_slices(slices,return_probabilities)
+
+    def _predict_slices(self,slices,return_probabilities):
+        labels = []
+        probs = []
+        # nnU-Net 2d models take a (c,z,y,x) volume and predict it slice by slice,
+        # with an out of plane spacing that is ignored
+        props = {'spacing':[999,1,1]}
+        if self.stackable:
+            chunks = [slices[i:i+self.batch_size] for i in range(0,len(slices),self.batch_size)]
+        else:
+            # per-image normalization, each slice has to be preprocessed on its own
+            chunks = [slices[i:i+1] for i in range(len(slices))]
+        for c in chunks:
+            img = np.ascontiguousarray(np.moveaxis(c,1,0),dtype=np.float32)
+            res = self.predictor.predict_single_npy_array(img,props,None,None,return_probabilities)
+            if return_probabilities:
+                labels.append(res[0])
+                probs.append(res[1].astype(np.float32))
+            else:
+                labels.append(res)
+        labels = np.concatenate(labels,axis=0)
+        if return_probabilities:
+            return labels,np.concatenate(probs,axis=1)
+        return labels
+
+    # predict a whole volume with the 3d model.
+    # img - array (nchannels,z,y,x). spacing - voxel spacing in the same order
+    # tile_step_size, mirror - override the loaded sliding window step and mirroring for this call
+    def predict_volume(self,img,spacing=(1,1,1),return_probabilities=False,tile_step_size=None,mirror=None):
+        img = np.ascontiguousarray(img,dtype=np.float32)
+        with self.lock:
+            self.predictor.use_mirroring = self.use_mirroring if mirror is None else mirror
+            self.predictor.tile_step_size = self.tile_step_size if tile_step_size is None else tile_step_size
+            return self.predictor.predict_single_npy_array(img,{'spacing':list(spacing)},None,None,return_probabilities)
+
+    # replaces nnUNetPredictor._internal_predict_sliding_window_return_logits, which runs
+    # the patches through the network one at a time, with patch_batch patches per call.
+    # data - preprocessed (nchannels,z,y,x) tensor. slicers - patch locations from nnU-Net,
+    # for the 2d model (slice(None),z,y,x) with a single z, ie 2d patches
+    def _sliding_window(self,data,slicers,do_on_device=True):
+        import torch
+        from nnunetv2.inference.sliding_window_prediction import compute_gaussian
+        p = self.predictor
+        results_device = self.device if do_on_device else torch.device('cpu')
+        if self.gaussian is None or self.gaussian.device != results_device:
+            self.gaussian = compute_gaussian(tuple(p.configuration_manager.patch_size),sigma_scale=1./8,
+                                             value_scaling_factor=10,device=results_device)
+        data = data.to(results_device)
+        logits = torch.zeros((p.label_manager.num_segmentation_heads,*data.shape[1:]),dtype=torch.half,device=results_device)
+        nmap = torch.zeros(data.shape[1:],dtype=torch.half,device=results_device)
+        for i in range(0,len(slicers),self.patch_batch):
+            sls = slicers[i:i+self.patch_batch]
+            x = torch.stack([data[sl] for sl in sls]).to(self.device)
+            pred = p._internal_maybe_mirror_and_predict(x).to(results_device)
+            for sl,y in zip(sls,pred):
+                logits[sl] += y * self.gaussian
+                nmap[sl[1:]] += self.gaussian
+        return logits / nmap
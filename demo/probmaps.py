@@ -0,0 +1,94 @@
+# compact storage of the per-class softmax probabilities of the 2d predictions.
+# float32 probabilities for 3 classes x 3 orientations on the MNI grid are several
+# hundred MB per study, so they are quantized to uint8 (steps of 1/255), cropped to
+# the bounding box of the foreground of any orientation, and written with
+# np.savez_compressed next to the label nifti. the reader only loads and dequantizes
+# the orientation and class that are asked for.
+
+import numpy as np
+
+from brainbox import bbox_from_mask
+
+scale = 255
+
+
+def quantize(p):
+    return np.round(np.clip(p,0,1) * scale).astype(np.uint8)
+
+
+def dequantize(q):
+    return q.astype(np.float32) / scale
+
+
+# voxels that are not labelled background by some orientation.
+# probs - {orientation:(nclasses,...) softmax}
+def foreground(probs):
+    fg = None
+    for p in probs.values():
+        m = np.argmax(p,axis=0) > 0
+        fg = m if fg is None else fg | m
+    return fg
+
+
+# write quantized, cropped probabilities for one study.
+# probs - {orientation:(nclasses,...) softmax}. affine is stored for reference
+# crop - (bbox,shape) if probs are on a sub-volume of the full grid, see brainbox.py
+def write_probmap(fname,probs,affine=None,margin=2,crop=None):
+    orients = list(probs.keys())
+    shape = np.shape(probs[orients[0]])
+    fg = foreground(probs)
+    if fg.any():
+        bbox = bbox_from_mask(fg,margin=margin)
+    else:
+        bbox = tuple(slice(0,0) for _ in shape[1:])
+    arrs = {o:quantize(probs[o][(slice(None),)+bbox]) for o in orients}
+    # bounding box and shape relative to the full grid
+    if crop is not None:
+        bbox = tuple(slice(b.start+c.start,b.stop+c.start) for b,c in zip(bbox,crop[0]))
+        shape = shape[:1] + tuple(crop[1])
+    np.savez_compressed(fname,shape=np.array(shape),bbox=np.array([(b.start,b.stop) for b in bbox]),
+                        affine=np.eye(4) if affine is None else affine,orients=np.array(orients),**arrs)
+    return fname if fname.endswith('.npz') else fname + '.npz'
+
+
+# lazy reader for a file from write_probmap. the npz members are only read and
+# decompressed when accessed.
+#   pm = ProbMap(fname)
+#   p = pm.volume('ax',1)   # full-size tumour probability of the axial model
+#   p = pm.fused(1)         # mean over the stored orientations
+class ProbMap():
+
+    def __init__(self,fname):
+        self.npz = np.load(fname)
+        self.shape = tuple(self.npz['shape'])
+        self.nclasses = self.shape[0]
+        self.bbox = tuple(slice(a,b) for a,b in self.npz['bbox'])
+        self.affine = self.npz['affine']
+        self.orients = [str(o) for o in self.npz['orients']]
+        self._q = {}
+
+    def close(self):
+        self.npz.close()
+
+    def quantized(self,orient):
+        if orient not in self._q:
+            self._q[orient] = self.npz[orient]
+        return self._q[orient]
+
+    # probabilities of one class inside the bounding box, float32
+    def cropped(self,orient,cls):
+        return dequantize(self.quantized(orient)[cls])
+
+    # probabilities of one class on the full grid. outside the bounding box every
+    # orientation predicted background, which is filled in as probability 1
+    def volume(self,orient,cls):
+        vol = np.full(self.shape[1:],1.0 if cls == 0 else 0.0,dtype=np.float32)
+        vol[self.bbox] = self.cropped(orient,cls)
+        return vol
+
+    def fused(self,cls,orients=None):
+        orients = orients or self.orients
+        vol = self.volume(orients[0],cls)
+        for o in orients[1:]:
+            vol += self.volume(o,cls)
+        return vol / len(orients)
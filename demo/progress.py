@@ -0,0 +1,204 @@
+# structured progress stream for the long running flask endpoints.
+# each pipeline stage is run here and reported as events carrying the stage,
+# overall progress fraction, elapsed time and an ETA derived from historical stage
+# timings. subprocess output is read on a separate thread and coalesced to a bounded
+# event rate, so high-volume nnU-Net logs don't swamp the response or the worker.
+#
+# events are formatted as Server-Sent Events ('sse') or newline-delimited json ('ndjson').
+
+import os
+import json
+import time
+import queue
+import signal
+import threading
+import subprocess
+from collections import deque
+
+
+# historical duration of each stage, as an exponential moving average persisted to json
+class StageTimings():
+
+    # nominal durations in seconds until some history has been recorded
+    defaults = {'case':120.0,'preprocess':30.0,'predict':300.0,'postprocess':30.0}
+
+    def __init__(self,fname,alpha=0.3):
+        self.fname = fname
+        self.alpha = alpha
+        self.lock = threading.Lock()
+        self.t = dict(self.defaults)
+        try:
+            with open(self.fname,'r') as fp:
+                self.t.update(json.load(fp))
+        except (IOError,ValueError):
+            pass
+
+    def expected(self,stage):
+        return self.t.get(stage,60.0)
+
+    def record(self,stage,seconds):
+        with self.lock:
+            if stage in self.t:
+                self.t[stage] = (1-self.alpha)*self.t[stage] + self.alpha*seconds
+            else:
+                self.t[stage] = seconds
+            try:
+                with open(self.fname,'w') as fp:
+                    json.dump(self.t,fp)
+            except IOError:
+                pass
+
+
+class ProgressStream():
+
+    # stages - ordered list of stage names for this request
+    # timings - StageTimings
+    # fmt - 'sse' or 'ndjson'
+    # max_rate - upper bound on log events per second
+    # max_lines - most recent output lines kept per log event, the rest are counted as dropped
+    # listener - optional callable given the dict of every event other than log and heartbeat
+    def __init__(self,stages,timings,fmt='sse',max_rate=4.0,max_lines=5,listener=None):
+        self.stages = stages
+        self.timings = timings
+        self.fmt = fmt
+        self.interval = 1.0/max_rate
+        self.max_lines = max_lines
+        self.t0 = time.time()
+        self.stage = None
+        self.tstage = None
+        self.done = []
+        self.tail = deque(maxlen=20)
+        self.returncode = None
+        self.result = None
+        self.listener = listener
+
+    @property
+    def mimetype(self):
+        return 'text/event-stream' if self.fmt == 'sse' else 'application/x-ndjson'
+
+    # overall fraction complete and ETA, weighting stages by their expected durations
+    def progress(self):
+        expected = {s:self.timings.expected(s) for s in self.stages}
+        total = sum(expected.values())
+        remaining = sum(expected[s] for s in self.stages if s not in self.done and s != self.stage)
+        complete = sum(expected[s] for s in self.done)
+        if self.stage is not None:
+            elapsed = time.time() - self.tstage
+            # don't let an over-running stage report complete
+            complete += min(elapsed,0.95*expected[self.stage])
+            remaining += max(expected[self.stage]-elapsed,0.05*expected[self.stage])
+        return complete/total,remaining
+
+    def event(self,etype,**kwargs):
+        frac,eta = self.progress()
+        ev = {'event':etype,'stage':self.stage,'progress':round(frac,3),
+              'elapsed':round(time.time()-self.t0,1),'eta':round(eta,1)}
+        ev.update(kwargs)
+        if self.listener is not None and etype not in ('log','heartbeat'):
+            self.listener(ev)
+        if self.fmt == 'sse':
+            return 'event: {}\ndata: {}\n\n'.format(etype,json.dumps(ev))
+        return json.dumps(ev) + '\n'
+
+    def start(self,stage):
+        self.stage = stage
+        self.tstage = time.time()
+        return self.event('stage_start')
+
+    def end(self,stage,ok=True):
+        dt = time.time() - self.tstage
+        self.done.append(stage)
+        self.stage = None
+        ev = self.event('stage_end',stage=stage,ok=ok,duration=round(dt,1))
+        # update the history only after reporting, so progress is computed with one set of weights
+        if ok:
+            self.timings.record(stage,dt)
+        return ev
+
+    def message(self,msg,etype='log'):
+        return self.event(etype,lines=[msg])
+
+    # run a subprocess as one stage, yielding coalesced log events.
+    # returncode is left in self.returncode
+    def run_stage(self,stage,cmd,cwd=None):
+        yield self.start(stage)
+        lines = queue.Queue()
+        # own process group, so the stage can be killed along with the processes it
+        # starts, eg nnUNetv2_predict under the wrapper script
+        process = subprocess.Popen(cmd,stdout=subprocess.PIPE,stderr=subprocess.STDOUT,
+                                   text=True,bufsize=1,cwd=cwd,start_new_session=True)
+
+        def reader():
+            for line in iter(process.stdout.readline,''):
+                lines.put(line)
+            process.stdout.close()
+            lines.put(None)
+        threading.Thread(target=reader,daemon=True).start()
+
+        # a client disconnect closes this generator (GeneratorExit at the yield), and the
+        # process must not outlive the request that holds its leases and gpu slot
+        try:
+            yield from self._coalesce(lines)
+            self.returncode = process.wait()
+        finally:
+            if process.poll() is None:
+                try:
+                    os.killpg(process.pid,signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+                process.wait()
+        if self.returncode != 0:
+            yield self.event('error',message='{} exited with code {}'.format(stage,self.returncode),
+                             lines=list(self.tail))
+        yield self.end(stage,ok=self.returncode==0)
+
+    # run a python callable as one stage on a worker thread, with heartbeat events
+    # while it runs. its stdout isn't captured. the return value is left in self.result,
+    # an exception is re-raised after the stage_end event
+    def run_callable(self,stage,fn,*args,**kwargs):
+        yield self.start(stage)
+        res = {}
+        def target():
+            try:
+                res['value'] = fn(*args,**kwargs)
+            except Exception as e:
+                res['error'] = e
+        th = threading.Thread(target=target,daemon=True)
+        th.start()
+        while th.is_alive():
+            th.join(timeout=max(self.interval,1.0))
+            if th.is_alive():
+                yield self.event('heartbeat')
+        ok = 'error' not in res
+        if not ok:
+            yield self.event('error',message=str(res['error']))
+        yield self.end(stage,ok=ok)
+        if not ok:
+            raise res['error']
+        self.result = res.get('value')
+
+    # batch lines from the queue into at most one event per interval
+    def _coalesce(self,lines):
+        buf = deque(maxlen=self.max_lines)
+        dropped = 0
+        tlast = time.time()
+        finished = False
+        while not finished:
+            try:
+                line = lines.get(timeout=self.interval)
+                if line is None:
+                    finished = True
+                else:
+                    line = line.rstrip()
+                    print(line,flush=True)
+                    self.tail.append(line)
+                    if len(buf) == buf.maxlen:
+                        dropped += 1
+                    buf.append(line)
+            except queue.Empty:
+                pass
+            if (finished or time.time()-tlast >= self.interval) and (len(buf) or dropped):
+                yield self.event('log',lines=list(buf),dropped=dropped)
+                buf.clear()
+                dropped = 0
+                tlast = time.time()
@@ -0,0 +1,124 @@
+# on-disk store of ANTs registration transforms, keyed by the content of the
+# fixed and moving arrays plus the transform type. repeated runs of the same case
+# re-register identical volumes (flair->t1+ within a study, time point 0 to MNI,
+# later time points to time point 0), so the .mat files from 'fwdtransforms' are
+# kept here instead of being left in temp locations and are looked up before
+# a registration is run.
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import numpy as np
+
+
+# content hash of a numpy array, including shape and dtype so that a reshaped
+# or recast array doesn't collide
+def hash_array(arr):
+    arr = np.ascontiguousarray(arr)
+    h = hashlib.blake2b(digest_size=16)
+    h.update(str(arr.shape).encode())
+    h.update(str(arr.dtype).encode())
+    h.update(memoryview(arr).cast('B'))
+    return h.hexdigest()
+
+
+class TxCache():
+
+    # cachedir - root directory of the store, one sub-directory per entry
+    # max_bytes - total size of stored transforms before oldest entries are evicted
+    # max_age - seconds since last use after which an entry is evicted
+    # grace - seconds an entry without meta.json is left alone, it may still
+    #   be being written by another worker
+    def __init__(self,cachedir,max_bytes=1e9,max_age=30*24*3600,grace=600):
+        self.cachedir = cachedir
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.grace = grace
+        os.makedirs(self.cachedir,exist_ok=True)
+
+    def key(self,img_arr_fixed,img_arr_moving,transform):
+        h = hashlib.blake2b(digest_size=16)
+        h.update(hash_array(img_arr_fixed).encode())
+        h.update(hash_array(img_arr_moving).encode())
+        h.update(transform.encode())
+        return h.hexdigest()
+
+    # return the list of cached transform files for this key, or None
+    def get(self,key):
+        edir = os.path.join(self.cachedir,key)
+        mfile = os.path.join(edir,'meta.json')
+        if not os.path.exists(mfile):
+            return None
+        with open(mfile,'r') as fp:
+            meta = json.load(fp)
+        txfiles = [os.path.join(edir,f) for f in meta['files']]
+        if not all(os.path.exists(f) for f in txfiles):
+            shutil.rmtree(edir,ignore_errors=True)
+            return None
+        # touch the entry so age-based eviction is by last use
+        meta['atime'] = time.time()
+        self.write_meta(edir,meta)
+        return txfiles
+
+    # meta.json is written to a temp file and renamed into place, so other
+    # workers never read a partial one, and an entry is only complete once
+    # its meta.json exists
+    def write_meta(self,edir,meta):
+        tmpfile = os.path.join(edir,'meta.json.{}.tmp'.format(os.getpid()))
+        with open(tmpfile,'w') as fp:
+            json.dump(meta,fp)
+        os.replace(tmpfile,os.path.join(edir,'meta.json'))
+
+    # copy the transform files out of their temp location into the store
+    # and return the persisted paths
+    def put(self,key,txfiles):
+        edir = os.path.join(self.cachedir,key)
+        os.makedirs(edir,exist_ok=True)
+        files = []
+        for i,f in enumerate(txfiles):
+            # keep the order of the transform list, ants applies them in sequence
+            fname = '{}_{}'.format(i,os.path.basename(f))
+            shutil.copy2(f,os.path.join(edir,fname))
+            files.append(fname)
+        nbytes = sum(os.path.getsize(os.path.join(edir,f)) for f in files)
+        self.write_meta(edir,{'files':files,'bytes':nbytes,'atime':time.time()})
+        self.evict()
+        return [os.path.join(edir,f) for f in files]
+
+    # drop entries older than max_age, then the least recently used ones
+    # until the store is under max_bytes
+    def evict(self):
+        entries = []
+        now = time.time()
+        for k in os.listdir(self.cachedir):
+            mfile = os.path.join(self.cachedir,k,'meta.json')
+            try:
+                with open(mfile,'r') as fp:
+                    meta = json.load(fp)
+            except (IOError,ValueError):
+                # incomplete entry, only removed once it is clearly abandoned
+                try:
+                    age = now - os.path.getmtime(os.path.join(self.cachedir,k))
+                except OSError:
+                    continue
+                if age > self.grace:
+                    shutil.rmtree(os.path.join(self.cachedir,k),ignore_errors=True)
+                continue
+            if now - meta['atime'] > self.max_age:
+                shutil.rmtree(os.path.join(self.cachedir,k),ignore_errors=True)
+                continue
+            entries.append((meta['atime'],meta['bytes'],k))
+
+        total = sum(e[1] for e in entries)
+        for atime,nbytes,k in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(os.path.join(self.cachedir,k),ignore_errors=True)
+            total -= nbytes
+        return
+
+    def clear(self):
+        shutil.rmtree(self.cachedir,ignore_errors=True)
+        os.makedirs(self.cachedir,exist_ok=True)
@@ -0,0 +1,15 @@
+# production entry point for the flask app
+#   gunicorn -c gunicorn.conf.py wsgi:app
+# or for an ASGI server, if asgiref is installed
+#   uvicorn --interface asgi3 wsgi:asgi_app
+# configuration is by FLASKDEMO_* environment variables, see app.Config
+
+from app import create_app
+
+app = create_app()
+
+try:
+    from asgiref.wsgi import WsgiToAsgi
+    asgi_app = WsgiToAsgi(app)
+except ImportError:
+    asgi_app = None
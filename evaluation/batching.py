@@ -0,0 +1,100 @@
+"""Batching of point clouds for evaluation.
+
+Only clouds with the same number of points share a batch, so a batch is a
+plain stack and the model sees exactly the points it would see one cloud at a
+time. Padding to a common size is not an option: repeated points fill kNN
+neighbour slots and take part in prompt sampling, and far-away filler points
+would be picked as FPS centers. The grouper settings depend on the cloud size
+too, and are the same for every cloud of a batch.
+
+With ``max_points``, larger clouds are subsampled to exactly that many points,
+by the same seeded draw in the single-cloud and the batched path, so results
+of the two stay comparable and the large clouds, all of the same size, can be
+batched together.
+"""
+
+import numpy as np
+
+
+def grouper_settings(num_points):
+    """(num_groups, group_size) of pc_encoder.patch_embed.grouper for a cloud size."""
+    if num_points > 30000:
+        return 2048, 256
+    if num_points < 256:
+        return min(num_points, 2048), 2
+    return min(num_points, 2048), 256
+
+
+def capped_size(num_points, max_points=None):
+    return num_points if max_points is None else min(num_points, max_points)
+
+
+def make_batches(sizes, batch_size, max_batch_points=None):
+    """Group cloud indices into batches of clouds with the same number of points.
+
+    Parameters
+    ----------
+    sizes : list
+        number of points of each cloud, after `capped_size`.
+    batch_size : int
+        maximum clouds per batch.
+    max_batch_points : int, optional
+        maximum of batch size x cloud size, to bound memory for large clouds.
+
+    Returns
+    -------
+    batches : list
+        lists of indices into ``sizes``.
+    """
+    sizes = np.asarray(sizes)
+    order = sorted(range(len(sizes)), key=lambda i: (sizes[i], i))
+    batches = []
+    batch = []
+    for i in order:
+        if batch:
+            full = len(batch) >= batch_size
+            other_size = sizes[i] != sizes[batch[0]]
+            too_many = (
+                max_batch_points is not None
+                and (len(batch) + 1) * sizes[i] > max_batch_points
+            )
+            if full or other_size or too_many:
+                batches.append(batch)
+                batch = []
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def subsample(coords, colors, labels, max_points=None, seed=0):
+    """Random subset of max_points points of a larger cloud, in the original order.
+
+    ``seed`` is the index of the cloud, so that a cloud gets the same subset
+    whichever path evaluates it.
+    """
+    if max_points is None or len(coords) <= max_points:
+        return coords, colors, labels
+    rng = np.random.default_rng(seed)
+    idx = np.sort(rng.choice(len(coords), max_points, replace=False))
+    return coords[idx], colors[idx], labels[idx]
+
+
+def collate(clouds):
+    """Stack (coords, colors, labels) of clouds with the same number of points.
+
+    Returns
+    -------
+    batch : dict
+        'coords' [B, N, 3] and 'features' [B, N, 3] float32, 'labels' [B, N]
+        int32 and 'num_points' N.
+    """
+    sizes = set(len(c[0]) for c in clouds)
+    if len(sizes) != 1:
+        raise ValueError(f"Clouds of different sizes {sorted(sizes)} in one batch")
+    return {
+        "coords": np.stack([c[0] for c in clouds]).astype(np.float32),
+        "features": np.stack([c[1] for c in clouds]).astype(np.float32),
+        "labels": np.stack([c[2] for c in clouds]).astype(np.int32),
+        "num_points": sizes.pop(),
+    }
@@ -0,0 +1,152 @@
+"""Reuse of point cloud embeddings across prompts.
+
+`PointCloudSAM.set_pointcloud` runs the point cloud encoder and keeps its
+outputs (patch embeddings, FPS centers and kNN groups) as attributes of the
+model, listed in ``pointcloud_state``, which `predict_masks` then decodes
+prompts against. Encoding dominates
+the cost, while a prompt set is a small decoder pass, so an interactive session
+that clicks repeatedly on the same cloud should encode once. This module keeps
+those attributes per cloud, keyed by the content of the coords and colors, in
+an LRU of at most ``max_clouds`` entries, and swaps them back into the model
+when a cached cloud is selected again.
+"""
+
+import hashlib
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+
+
+def content_key(*arrays):
+    """blake2b hash of arrays, including shape and dtype."""
+    h = hashlib.blake2b(digest_size=16)
+    for arr in arrays:
+        arr = np.ascontiguousarray(arr)
+        h.update(str(arr.shape).encode())
+        h.update(str(arr.dtype).encode())
+        h.update(memoryview(arr).cast("B"))
+    return h.hexdigest()
+
+
+# attributes that PointCloudSAM.set_pointcloud sets and predict_masks reads: the
+# patch embeddings, the patches (FPS centers, kNN groups) and their positional
+# encoding. dotted names reach into submodules
+pointcloud_state = ("pc_embeddings", "patches", "pc_pe")
+
+
+def _owner(model, name):
+    *path, attr = name.split(".")
+    for p in path:
+        model = getattr(model, p)
+    return model, attr
+
+
+def capture_state(model, encode, names=pointcloud_state):
+    """Run ``encode()`` and return the per-cloud attributes ``names`` it set.
+
+    Raises if one of them is missing or unchanged afterwards, since decoding
+    against a stale embedding would give wrong masks without any other error.
+    """
+    missing = object()
+    before = {name: getattr(*_owner(model, name), missing) for name in names}
+    encode()
+    state = {}
+    for name in names:
+        value = getattr(*_owner(model, name), missing)
+        # still absent, or the object left by the previous cloud
+        if value is missing or value is before[name]:
+            raise RuntimeError(
+                f"set_pointcloud did not set {name}, check pointcloud_state"
+            )
+        state[name] = value
+    return state
+
+
+def restore_state(model, state):
+    # setattr, so that a name that is a registered buffer is updated as one
+    for name, value in state.items():
+        setattr(*_owner(model, name), value)
+
+
+class EmbeddingCache:
+    """LRU of encoded clouds.
+
+    Parameters
+    ----------
+    max_clouds : int
+        number of clouds kept. Entries hold device tensors, so this bounds the
+        memory used by cached embeddings.
+    """
+
+    def __init__(self, max_clouds=4):
+        self.max_clouds = max_clouds
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_clouds:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+
+class LatencyStats:
+    """Wall-clock timings per kind of call, eg 'encode' and 'decode'.
+
+    On CUDA the device is synchronized before reading the clock, so the times
+    include the kernels and not just their launch.
+    """
+
+    def __init__(self, device="cpu"):
+        self.device = torch.device(device)
+        self.times = {}
+
+    def _sync(self):
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+
+    @contextmanager
+    def timer(self, kind):
+        self._sync()
+        tic = time.perf_counter()
+        yield
+        self._sync()
+        self.times.setdefault(kind, []).append(time.perf_counter() - tic)
+
+    def last(self, kind):
+        return self.times[kind][-1]
+
+    def summary(self):
+        """{kind: {'count', 'mean', 'p50', 'p95'}} in seconds."""
+        out = {}
+        for kind, t in self.times.items():
+            t = np.asarray(t)
+            out[kind] = {
+                "count": len(t),
+                "mean": float(t.mean()),
+                "p50": float(np.percentile(t, 50)),
+                "p95": float(np.percentile(t, 95)),
+            }
+        return out
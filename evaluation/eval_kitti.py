@@ -2,6 +2,8 @@ import sys
 
 sys.path.append(".")
 import glob
+import time
+from functools import partial
 
 import torch
 from datasets import Dataset
@@ -15,80 +17,33 @@ from pc_sam.model.loss import compute_iou
 from safetensors.torch import load_model
 import numpy as np
 from scipy.spatial.transform import Rotation as R
+from ply_io import parse_ply_header, ply_fields, read_ply
+from transforms import normalize_colors, normalize_points
+from pc_cache import open_cache
+from batching import capped_size, collate, grouper_settings, make_batches, subsample
+from prefetch import DevicePrefetcher, make_loader
+from metrics import IoUAccumulator
 
 r = R.from_euler("xyz", [-90, 180, 0], degrees=True)
+# preprocessing applied by load_kitti_ply, a cache built with anything else is rebuilt
+cache_key = "rotation xyz [-90, 180, 0]; normalize_points; normalize_colors(0.5, 0.5)"
 
-valid_formats = {"ascii": "", "binary_big_endian": ">", "binary_little_endian": "<"}
-
-ply_dtypes = dict(
-    [
-        (b"int8", "i1"),
-        (b"char", "i1"),
-        (b"uint8", "u1"),
-        (b"uchar", "u1"),
-        (b"int16", "i2"),
-        (b"short", "i2"),
-        (b"uint16", "u2"),
-        (b"ushort", "u2"),
-        (b"int32", "i4"),
-        (b"int", "i4"),
-        (b"uint32", "u4"),
-        (b"uint", "u4"),
-        (b"float32", "f4"),
-        (b"float", "f4"),
-        (b"float64", "f8"),
-        (b"double", "f8"),
-    ]
-)
-
-
-def save_colored_pc(file_name, xyz, rgb):
-    # rgb is [0, 1]
-    n = xyz.shape[0]
-    f = open(file_name, "w")
-    f.write("ply\n")
-    f.write("format ascii 1.0\n")
-    f.write("element vertex %d\n" % n)
-    f.write("property float x\n")
-    f.write("property float y\n")
-    f.write("property float z\n")
-    f.write("property uchar red\n")
-    f.write("property uchar green\n")
-    f.write("property uchar blue\n")
-    f.write("end_header\n")
-    rgb = rgb * 255
-    for i in range(n):
-        if rgb.shape[1] == 3:
-            f.write(
-                "%f %f %f %d %d %d\n"
-                % (xyz[i][0], xyz[i][1], xyz[i][2], rgb[i][0], rgb[i][1], rgb[i][2])
-            )
-        else:
-            f.write(
-                "%f %f %f %d %d %d\n"
-                % (xyz[i][0], xyz[i][1], xyz[i][2], rgb[i][0], rgb[i][0], rgb[i][0])
-            )
 
+def object_name_of(filename):
+    return filename.split("/")[-1].split("_")[0]
 
-def normalize_colors(features, mean=0.5, std=0.5):
-    features = features / 255
-    if mean is not None:
-        features = features - mean
-    if std is not None:
-        features = features / std
-    return features
 
+def load_kitti_ply(filename):
+    """Read a KITTI-360 crop, rotated and normalized as the model expects."""
+    point_cloud = read_ply(filename, mmap=True)
+    coords = ply_fields(point_cloud, ("x", "y", "z"), contiguous=True)
+    coords = normalize_points(np.float32(r.apply(coords)))
+    colors = normalize_colors(ply_fields(point_cloud, ("R", "G", "B"), contiguous=True))
+    labels = point_cloud["label"].astype(np.int32)
+    return coords.astype(np.float32), colors.astype(np.float32), labels
 
-def normalize_points(points: np.ndarray):
-    """Normalize the point cloud into a unit sphere."""
-    assert points.ndim == 2 and points.shape[1] == 3, points.shape
-    centroid = np.mean(points, axis=0)
-    points = points - centroid
-    norm = np.max(np.linalg.norm(points, ord=2, axis=1))
-    return points / norm
 
-
-def transform_fn(x):
+def transform_fn(x, normalize=True, device=None):
     xyz = np.array(x["xyz"])
     rgb = np.array(x["rgb"])
     mask = np.array(x["mask"])
@@ -98,13 +53,16 @@ def transform_fn(x):
     # exit()
 
     # normalize
-    xyz = normalize_points(xyz)
-    rgb = normalize_colors(rgb)
+    if normalize:
+        xyz = normalize_points(xyz)
+        rgb = normalize_colors(rgb)
 
     # to tensor
-    xyz = torch.tensor(xyz, dtype=torch.float).cuda()
-    rgb = torch.tensor(rgb, dtype=torch.float).cuda()
-    mask = torch.tensor(mask, dtype=torch.bool).cuda()
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    xyz = torch.tensor(xyz, dtype=torch.float, device=device)
+    rgb = torch.tensor(rgb, dtype=torch.float, device=device)
+    mask = torch.tensor(mask, dtype=torch.bool, device=device)
 
     data = {
         "coords": xyz[None, ...],
@@ -114,173 +72,133 @@ def transform_fn(x):
     return data
 
 
-def parse_header(plyfile, ext):
-    # Variables
-    line = []
-    properties = []
-    num_points = None
-
-    while b"end_header" not in line and line != b"":
-        line = plyfile.readline()
+def _dataset_sample(x):
+    xyz = np.array(x["xyz"])
+    rgb = np.array(x["rgb"])
+    mask = np.array(x["mask"])
+    mask = np.stack(
+        [
+            mask[i]
+            for i in range(mask.shape[0])
+            if mask[i].sum() >= 25 and mask[i].sum() < 0.9 * mask.shape[1]
+        ]
+    )
 
-        if b"element" in line:
-            line = line.split()
-            num_points = int(line[2])
+    # normalize
+    xyz = normalize_points(xyz).astype(np.float32)
+    rgb = normalize_colors(rgb).astype(np.float32)
+
+    return [
+        {
+            "coords": xyz[None, ...],
+            "features": rgb[None, ...],
+            "gt_masks": mask[i][None, None, ...].astype(bool),
+        }
+        for i in range(mask.shape[0])
+    ]
 
-        elif b"property" in line:
-            line = line.split()
-            properties.append((line[2].decode(), ext + ply_dtypes[line[1]]))
 
-    return num_points, properties
+def build_dataloader(dataset: Dataset, num_workers=4, prefetch=2, device=None):
+    """Stream the dataset through CPU workers, a few samples ahead of the model."""
+    loader = make_loader(
+        dataset, _dataset_sample, num_workers=num_workers, prefetch=prefetch
+    )
+    return DevicePrefetcher(loader, device=device, depth=prefetch)
 
 
-def parse_mesh_header(plyfile, ext):
-    # Variables
-    line = []
-    vertex_properties = []
-    num_points = None
-    num_faces = None
-    current_element = None
+class KittiFiles:
+    """(object_name, coords, colors, labels) of the crops, read on access.
 
-    while b"end_header" not in line and line != b"":
-        line = plyfile.readline()
+    Same interface as pc_cache.PointCloudCache.
+    """
 
-        # Find point element
-        if b"element vertex" in line:
-            current_element = "vertex"
-            line = line.split()
-            num_points = int(line[2])
+    def __init__(self, files):
+        self.files = files
 
-        elif b"element face" in line:
-            current_element = "face"
-            line = line.split()
-            num_faces = int(line[2])
+    def __len__(self):
+        return len(self.files)
 
-        elif b"property" in line:
-            if current_element == "vertex":
-                line = line.split()
-                vertex_properties.append((line[2].decode(), ext + ply_dtypes[line[1]]))
-            elif current_element == "vertex":
-                if not line.startswith("property list uchar int"):
-                    raise ValueError("Unsupported faces property : " + line)
+    def __getitem__(self, i):
+        return (object_name_of(self.files[i]), *load_kitti_ply(self.files[i]))
 
-    return num_points, num_faces, vertex_properties
+    def num_points(self, i):
+        # vertex count from the header, without reading the data
+        with open(self.files[i], "rb") as plyfile:
+            _, elements, _ = parse_ply_header(plyfile)
+        return dict((name, count) for name, count, _ in elements)["vertex"]
 
 
-def read_ply(filename, triangular_mesh=False):
-    """
-    Read ".ply" files
-    Parameters
-    ----------
-    filename : string
-        the name of the file to read.
-    Returns
-    -------
-    result : array
-        data stored in the file
-    Examples
-    --------
-    Store data in file
-    >>> points = np.random.rand(5, 3)
-    >>> values = np.random.randint(2, size=10)
-    >>> write_ply('example.ply', [points, values], ['x', 'y', 'z', 'values'])
-    Read the file
-    >>> data = read_ply('example.ply')
-    >>> values = data['values']
-    array([0, 0, 1, 1, 0])
-
-    >>> points = np.vstack((data['x'], data['y'], data['z'])).T
-    array([[ 0.466  0.595  0.324]
-           [ 0.538  0.407  0.654]
-           [ 0.850  0.018  0.988]
-           [ 0.395  0.394  0.363]
-           [ 0.873  0.996  0.092]])
-    """
+def single_sample(samples, max_points, i):
+    object_name, *cloud = samples[i]
+    coords, colors, labels = subsample(*cloud, max_points=max_points, seed=i)
+    return {
+        "name": object_name,
+        "coords": np.array(coords, dtype=np.float32)[None, ...],
+        "features": np.array(colors, dtype=np.float32)[None, ...],
+        "gt_masks": np.array(labels, dtype=bool)[None, None, ...],
+    }
 
-    with open(filename, "rb") as plyfile:
-        # Check if the file start with ply
-        if b"ply" not in plyfile.readline():
-            raise ValueError("The file does not start whith the word ply")
-
-        # get binary_little/big or ascii
-        fmt = plyfile.readline().split()[1].decode()
-        if fmt == "ascii":
-            raise ValueError("The file is not binary")
-
-        # get extension for building the numpy dtypes
-        ext = valid_formats[fmt]
-
-        # PointCloud reader vs mesh reader
-        if triangular_mesh:
-            # Parse header
-            num_points, num_faces, properties = parse_mesh_header(plyfile, ext)
-
-            # Get point data
-            vertex_data = np.fromfile(plyfile, dtype=properties, count=num_points)
-
-            # Get face data
-            face_properties = [
-                ("k", ext + "u1"),
-                ("v1", ext + "i4"),
-                ("v2", ext + "i4"),
-                ("v3", ext + "i4"),
-            ]
-            faces_data = np.fromfile(plyfile, dtype=face_properties, count=num_faces)
 
-            # Return vertex data and concatenated faces
-            faces = np.vstack((faces_data["v1"], faces_data["v2"], faces_data["v3"])).T
-            data = [vertex_data, faces]
+def batch_sample(samples, max_points, indices):
+    clouds = [samples[i] for i in indices]
+    batch = collate(
+        [
+            subsample(*c[1:], max_points=max_points, seed=i)
+            for i, c in zip(indices, clouds)
+        ]
+    )
+    batch["names"] = [c[0] for c in clouds]
+    return batch
 
-        else:
-            # Parse header
-            num_points, properties = parse_header(plyfile, ext)
 
-            # Get data
-            data = np.fromfile(plyfile, dtype=properties, count=num_points)
+def set_grouper(model, num_points):
+    grouper = model.pc_encoder.patch_embed.grouper
+    grouper.num_groups, grouper.group_size = grouper_settings(num_points)
 
-    return data
 
+def evaluate_single(model, loader):
+    """One forward pass per cloud.
 
-def build_dataloader(dataset: Dataset):
-    def transform_fn(x):
-        xyz = np.array(x["xyz"])
-        rgb = np.array(x["rgb"])
-        mask = np.array(x["mask"])
-        mask = np.stack(
+    Yields ([object_name], ious [1, prompt_iters]) per cloud, on the device.
+    """
+    for sample in loader:
+        object_name = sample.pop("name")
+        data = sample
+        point_number = data["coords"].shape[1]
+        # change fps number
+        set_grouper(model, point_number)
+        outputs = model(**data, is_eval=True)
+        gt_masks = data["gt_masks"].flatten(0, 1)
+        ious = torch.stack(
             [
-                mask[i]
-                for i in range(mask.shape[0])
-                if mask[i].sum() >= 25 and mask[i].sum() < 0.9 * mask.shape[1]
+                compute_iou(outputs[i_iter]["prompt_masks"], gt_masks).float().mean()
+                for i_iter in range(len(outputs))
             ]
         )
+        yield [object_name], ious[None]
 
-        # rgb[mask[1]] = [255, 0, 0]
-        # save_colored_pc("test.ply", xyz, rgb / 255)
-        # exit()
 
-        # normalize
-        xyz = normalize_points(xyz)
-        rgb = normalize_colors(rgb)
+def evaluate_batched(model, loader):
+    """Clouds with the same number of points in one forward pass, see batching.py.
 
-        # to tensor
-        xyz = torch.tensor(xyz, dtype=torch.float).cuda()
-        rgb = torch.tensor(rgb, dtype=torch.float).cuda()
-        mask = torch.tensor(mask, dtype=torch.bool).cuda()
-
-        data = [
-            {
-                "coords": xyz[None, ...],
-                "features": rgb[None, ...],
-                "gt_masks": mask[i][None, None, ...],
-            }
-            for i in range(mask.shape[0])
-        ]
-        return data
-
-    dataloader = []
-    for x in dataset:
-        dataloader.append(transform_fn(x))
-    return dataloader
+    Yields (object_names, ious [B, prompt_iters]) per batch, on the device.
+    """
+    for batch in loader:
+        gt_masks = batch["labels"].bool()
+
+        # every cloud of the batch has the same size, and so the same settings
+        set_grouper(model, int(batch["num_points"]))
+        outputs = model(
+            coords=batch["coords"],
+            features=batch["features"],
+            gt_masks=gt_masks[:, None],
+            is_eval=True,
+        )
+        ious = []
+        for i_iter in range(len(outputs)):
+            pred = outputs[i_iter]["prompt_masks"].reshape(gt_masks.shape)
+            ious.append(compute_iou(pred, gt_masks).float())
+        yield batch["names"], torch.stack(ious, dim=1)  # [B, prompt_iters]
 
 
 def main():
@@ -294,6 +212,53 @@ def main():
         type=str,
         default="./pretrained/ours/mixture_10k_giant/model.safetensors",
     )
+    parser.add_argument(
+        "--data_glob", type=str, default="/yuchen_slow/KITTI360/single/crops/*/*.ply"
+    )
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default=None,
+        help="packed preprocessed clouds, built on the first run",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=1,
+        help="clouds per forward pass. only clouds with the same number of points "
+        "share a batch, so this usually needs --max_points to have an effect",
+    )
+    parser.add_argument("--max_batch_points", type=int, default=None)
+    parser.add_argument(
+        "--max_points",
+        type=int,
+        default=None,
+        help="subsample larger clouds, the same way with and without batching",
+    )
+    parser.add_argument(
+        "--num_workers", type=int, default=4, help="CPU workers reading clouds"
+    )
+    parser.add_argument(
+        "--prefetch", type=int, default=2, help="samples prepared ahead of the model"
+    )
+    parser.add_argument(
+        "--num_shards", type=int, default=1, help="split the dataset for separate runs"
+    )
+    parser.add_argument(
+        "--shard", type=int, default=0, help="shard evaluated by this run"
+    )
+    parser.add_argument(
+        "--sync_every",
+        type=int,
+        default=100,
+        help="batches between host copies of the running mean IoU",
+    )
+    parser.add_argument(
+        "--metrics_out",
+        type=str,
+        default=None,
+        help="prefix of the .json and .csv metrics, merge shards with metrics.py",
+    )
     args, unknown_args = parser.parse_known_args()
 
     # ---------------------------------------------------------------------------- #
@@ -310,8 +275,11 @@ def main():
     # Setup model
     # ---------------------------------------------------------------------------- #
     set_seed(seed)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     model: PointCloudSAM = hydra.utils.instantiate(cfg.model)
-    model.apply(replace_with_fused_layernorm)
+    # apex fused layernorm is CUDA only
+    if device.type == "cuda":
+        model.apply(replace_with_fused_layernorm)
 
     # ---------------------------------------------------------------------------- #
     # Load pre-trained model
@@ -321,73 +289,73 @@ def main():
     # ---------------------------------------------------------------------------- #
     # Setup dataloader
     # ---------------------------------------------------------------------------- #
-    partnet_mobility_dataset = glob.glob("/yuchen_slow/KITTI360/single/crops/*/*.ply")
-    pbar = tqdm(total=len(partnet_mobility_dataset), miniters=10, maxinterval=60)
+    partnet_mobility_dataset = sorted(glob.glob(args.data_glob))
+    if args.cache_dir is not None:
+        # (object_name, coords, colors, labels), memory-mapped from the cache
+        samples = open_cache(
+            partnet_mobility_dataset,
+            args.cache_dir,
+            load_kitti_ply,
+            name_fn=object_name_of,
+            key=cache_key,
+        )
+    else:
+        samples = KittiFiles(partnet_mobility_dataset)
+    # clouds are read and normalized by the loader workers, and copied to the
+    # device a few at a time ahead of the model
+    indices = list(range(len(samples)))[args.shard :: args.num_shards]
+    if args.batch_size > 1:
+        sizes = [capped_size(samples.num_points(i), args.max_points) for i in indices]
+        batches = make_batches(sizes, args.batch_size, args.max_batch_points)
+        batches = [[indices[j] for j in batch] for batch in batches]
+        if len(batches) > 1 and all(len(batch) == 1 for batch in batches):
+            print(
+                f"No two clouds have the same number of points, --batch_size "
+                f"{args.batch_size} evaluates one cloud at a time. Set --max_points "
+                f"to batch the clouds larger than it."
+            )
+        loader = make_loader(
+            batches,
+            partial(batch_sample, samples, args.max_points),
+            num_workers=args.num_workers,
+            prefetch=args.prefetch,
+        )
+    else:
+        loader = make_loader(
+            indices,
+            partial(single_sample, samples, args.max_points),
+            num_workers=args.num_workers,
+            prefetch=args.prefetch,
+        )
+    loader = DevicePrefetcher(loader, device=device, depth=args.prefetch)
+    pbar = tqdm(total=len(indices), miniters=10, maxinterval=60)
 
     # ---------------------------------------------------------------------------- #
     # Evaluate
     # ---------------------------------------------------------------------------- #
     model.eval()
-    model.cuda()
+    model.to(device)
     with torch.no_grad():
-        total_ious = []
-        object_ious = {}
-        for pc in partnet_mobility_dataset:
-            object_name = pc.split("/")[-1].split("_")[0]
-            point_cloud = read_ply(pc)
-            coords_full = np.column_stack(
-                [point_cloud["x"], point_cloud["y"], point_cloud["z"]]
-            ).astype(np.float32)
-            coords_full = np.float32(r.apply(coords_full))
-            colors_full = (
-                np.column_stack([point_cloud["R"], point_cloud["G"], point_cloud["B"]])
-            ).astype(np.float32)
-            labels_full = point_cloud["label"].astype(np.int32)
-            data = {"xyz": coords_full, "rgb": colors_full, "mask": labels_full}
-
-            data = transform_fn(data)
-            ious = [[] for _ in range(model.prompt_iters)]
-            point_number = data["coords"].shape[1]
-            # change fps number
-            if point_number > 30000:
-                model.pc_encoder.patch_embed.grouper.num_groups = 2048
-                model.pc_encoder.patch_embed.grouper.group_size = 256
-            else:
-                model.pc_encoder.patch_embed.grouper.num_groups = min(
-                    point_number, 2048
-                )
-                # model.pc_encoder.patch_embed.grouper.num_groups = 2048
-                model.pc_encoder.patch_embed.grouper.group_size = 256
-                if point_number < 256:
-                    model.pc_encoder.patch_embed.grouper.group_size = 2
-            outputs = model(**data, is_eval=True)
-            gt_masks = data["gt_masks"].flatten(0, 1)
-            for i_iter in range(len(outputs)):
-                iou = (
-                    compute_iou(outputs[i_iter]["prompt_masks"], gt_masks)
-                    .detach()
-                    .cpu()
-                    .numpy()
-                )
-                ious[i_iter].append(iou)
-            pbar.update(1)
-            ious = np.array(ious).mean(axis=1)  # [prompt_iters]
-            if object_ious.get(object_name) is None:
-                object_ious[object_name] = []
-            object_ious[object_name].append(ious)
-            total_ious.append(ious)
-            current_iou_mean = np.array(total_ious).mean(axis=0)
-            print(f"Current mean IoU: {current_iou_mean}")
-        total_ious = np.array(total_ious).mean(axis=0)
-        print(f"Total mean IoU: {total_ious}")
-
-        # average for each object
-        for object_name, ious in object_ious.items():
-            object_ious[object_name] = np.array(ious).mean(axis=0)
-
-        # average for objects
-        object_ious_mean = np.array(list(object_ious.values())).mean(axis=0)
-        print(f"Object mean IoU: {object_ious_mean}")
+        metrics = IoUAccumulator(device, sync_every=args.sync_every)
+        tic = time.perf_counter()
+        if args.batch_size > 1:
+            results = evaluate_batched(model, loader)
+        else:
+            results = evaluate_single(model, loader)
+        for object_names, ious in results:
+            pbar.update(len(object_names))
+            if metrics.update(object_names, ious):
+                print(f"Current mean IoU: {metrics.mean}")
+        summary = metrics.summary()
+        elapsed = time.perf_counter() - tic
+        num_clouds = summary["num_clouds"]
+        rate = num_clouds / elapsed
+        print(f"{num_clouds} clouds in {elapsed:.1f}s, {rate:.2f} clouds/s")
+        print(f"Total mean IoU: {np.array(summary['mean_iou'])}")
+        # average for each object, then over objects
+        print(f"Object mean IoU: {np.array(summary['object_mean_iou'])}")
+        if args.metrics_out is not None:
+            metrics.save(args.metrics_out)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,238 @@
+"""Farthest point sampling and kNN grouping on the CPU.
+
+The patch grouper of the point cloud encoder picks ``num_groups`` centers by
+farthest point sampling (FPS) and gathers the ``group_size`` nearest points of
+each center. The CUDA kernels of torkit3d do this on the GPU. This module does
+it on the CPU with the same tensor interface:
+
+* FPS keeps a running [B, N] min-distance buffer that is updated in place,
+  batched over clouds. For very large clouds, ``voxel_size`` first reduces the
+  candidates to one point per occupied voxel.
+* kNN queries a KD-tree (scipy cKDTree, multi-threaded) instead of a full
+  [num_groups, N] distance matrix.
+
+Benchmark against brute-force distance matrices::
+
+    python evaluation/grouping.py --num_points 10000 100000 1000000
+"""
+
+import argparse
+import time
+
+import numpy as np
+import torch
+from scipy.spatial import cKDTree
+
+
+def voxel_downsample(coords, voxel_size):
+    """Index of the first point in each occupied voxel of a [N, 3] array."""
+    keys = np.floor((coords - coords.min(axis=0)) / voxel_size).astype(np.int64)
+    _, first = np.unique(keys, axis=0, return_index=True)
+    return np.sort(first)
+
+
+def furthest_point_sample(coords, num_samples, voxel_size=None):
+    """Farthest point sampling.
+
+    Parameters
+    ----------
+    coords : tensor or array
+        [B, N, 3] points.
+    num_samples : int
+        centers per cloud.
+    voxel_size : float, optional
+        sample among one point per voxel of this size, an approximation for
+        large clouds. Falls back to all points if there are too few voxels.
+
+    Returns
+    -------
+    idx : tensor
+        [B, num_samples] int64 indices into the N points.
+    """
+    coords = torch.as_tensor(coords).float().cpu()
+    B, N, _ = coords.shape
+    if voxel_size is not None:
+        idx = []
+        for b in range(B):
+            candidates = voxel_downsample(coords[b].numpy(), voxel_size)
+            if len(candidates) < num_samples:
+                candidates = np.arange(N)
+            sub = furthest_point_sample(coords[b, candidates][None], num_samples)[0]
+            idx.append(torch.from_numpy(candidates)[sub])
+        return torch.stack(idx)
+
+    idx = torch.empty((B, num_samples), dtype=torch.long)
+    min_dist = torch.full((B, N), float("inf"))
+    dist = torch.empty((B, N))
+    diff = torch.empty((B, N, 3))
+    batch = torch.arange(B)
+    # same start as the CUDA kernel, the first point
+    farthest = torch.zeros(B, dtype=torch.long)
+    for i in range(num_samples):
+        idx[:, i] = farthest
+        center = coords[batch, farthest][:, None, :]
+        torch.sub(coords, center, out=diff)
+        diff.square_()
+        torch.sum(diff, dim=-1, out=dist)
+        torch.minimum(min_dist, dist, out=min_dist)
+        farthest = min_dist.argmax(dim=-1)
+    return idx
+
+
+def knn_points(query, points, k, workers=-1):
+    """k nearest neighbours of each query point.
+
+    Parameters
+    ----------
+    query : tensor or array
+        [B, S, 3] query points, eg the FPS centers.
+    points : tensor or array
+        [B, N, 3] points to search.
+
+    Returns
+    -------
+    dist : tensor
+        [B, S, k] squared distances, ascending.
+    idx : tensor
+        [B, S, k] int64 indices into the N points.
+    """
+    query = torch.as_tensor(query).float().cpu().numpy()
+    points = torch.as_tensor(points).float().cpu().numpy()
+    dists, idxs = [], []
+    for b in range(len(points)):
+        d, i = cKDTree(points[b]).query(query[b], k=k, workers=workers)
+        d, i = np.asarray(d).reshape(len(query[b]), k), np.asarray(i).reshape(
+            len(query[b]), k
+        )
+        dists.append(d**2)
+        idxs.append(i)
+    return (
+        torch.from_numpy(np.stack(dists)).float(),
+        torch.from_numpy(np.stack(idxs)).long(),
+    )
+
+
+def group_points(coords, num_groups, group_size, voxel_size=None, workers=-1):
+    """FPS centers and their kNN groups, as consumed by the patch embedding.
+
+    ``workers`` is the number of threads of the kNN query, -1 for all cores.
+
+    Returns
+    -------
+    dict
+        'fps_idx' [B, G], 'centers' [B, G, 3] and 'knn_idx' [B, G, K].
+    """
+    coords = torch.as_tensor(coords).float().cpu()
+    fps_idx = furthest_point_sample(coords, num_groups, voxel_size)
+    centers = torch.gather(coords, 1, fps_idx[..., None].expand(-1, -1, 3))
+    _, knn_idx = knn_points(centers, coords, group_size, workers=workers)
+    return {"fps_idx": fps_idx, "centers": centers, "knn_idx": knn_idx}
+
+
+def brute_force_fps(coords, num_samples):
+    # reference FPS with a per-step [B, N] distance from scratch, no in-place buffers
+    B = coords.shape[0]
+    idx = torch.zeros((B, num_samples), dtype=torch.long)
+    min_dist = torch.full(coords.shape[:2], float("inf"))
+    for i in range(1, num_samples):
+        center = coords[torch.arange(B), idx[:, i - 1]][:, None]
+        min_dist = torch.minimum(min_dist, torch.cdist(coords, center)[..., 0] ** 2)
+        idx[:, i] = min_dist.argmax(dim=-1)
+    return idx
+
+
+def brute_force_knn(query, points, k, chunk=64):
+    # full distance matrix, in chunks of query points to bound memory
+    dists, idxs = [], []
+    for s in range(0, query.shape[1], chunk):
+        d = torch.cdist(query[:, s : s + chunk], points) ** 2
+        d, i = d.topk(k, dim=-1, largest=False)
+        dists.append(d)
+        idxs.append(i)
+    return torch.cat(dists, dim=1), torch.cat(idxs, dim=1)
+
+
+def benchmark(
+    num_points,
+    num_groups=2048,
+    group_size=256,
+    brute_limit=1_000_000,
+    seed=0,
+    workers=-1,
+):
+    rng = np.random.default_rng(seed)
+    for n in num_points:
+        # points on a noisy surface, like a lidar crop
+        uv = rng.random((n, 2)).astype(np.float32)
+        coords = np.stack(
+            [
+                uv[:, 0],
+                uv[:, 1],
+                0.1 * np.sin(6 * uv[:, 0]) + 0.01 * rng.standard_normal(n),
+            ],
+            axis=1,
+        )
+        coords = torch.from_numpy(coords.astype(np.float32))[None]
+        g = min(num_groups, n)
+        k = min(group_size, n)
+
+        tic = time.perf_counter()
+        fps_idx = furthest_point_sample(coords, g)
+        t_fps = time.perf_counter() - tic
+        tic = time.perf_counter()
+        furthest_point_sample(coords, g, voxel_size=0.005)
+        t_fps_voxel = time.perf_counter() - tic
+        centers = coords[0, fps_idx[0]][None]
+        tic = time.perf_counter()
+        dist, _ = knn_points(centers, coords, k, workers=workers)
+        t_knn = time.perf_counter() - tic
+        line = (
+            f"{n:>8d} points: fps {t_fps:6.2f}s, voxel fps {t_fps_voxel:6.2f}s, "
+            f"kdtree knn {t_knn:6.2f}s"
+        )
+
+        if n <= brute_limit:
+            tic = time.perf_counter()
+            ref_idx = brute_force_fps(coords, g)
+            t_bfps = time.perf_counter() - tic
+            tic = time.perf_counter()
+            ref_dist, _ = brute_force_knn(centers, coords, k)
+            t_bknn = time.perf_counter() - tic
+            same_fps = (ref_idx == fps_idx).float().mean().item()
+            knn_err = (ref_dist - dist).abs().max().item()
+            line += (
+                f" | brute fps {t_bfps:6.2f}s, brute knn {t_bknn:6.2f}s, "
+                f"fps agreement {same_fps:.3f}, knn max err {knn_err:.1e}"
+            )
+        print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--num_points", type=int, nargs="+", default=[10000, 100000, 1000000]
+    )
+    parser.add_argument("--num_groups", type=int, default=2048)
+    parser.add_argument("--group_size", type=int, default=256)
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=None,
+        help="threads of torch and of the KD-tree queries, default all cores",
+    )
+    parser.add_argument(
+        "--brute_limit",
+        type=int,
+        default=1000000,
+        help="skip brute force above this size",
+    )
+    args = parser.parse_args()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    benchmark(
+        args.num_points,
+        args.num_groups,
+        args.group_size,
+        args.brute_limit,
+        workers=-1 if args.threads is None else args.threads,
+    )
@@ -3,13 +3,259 @@ import sys
 sys.path.append(".")
 
 import argparse
+import os
+import time
+from contextlib import nullcontext
+
 import hydra
+import numpy as np
+import torch
 from omegaconf import OmegaConf
 from accelerate.utils import set_seed
 from pc_sam.model.pc_sam import PointCloudSAM
 from pc_sam.utils.torch_utils import replace_with_fused_layernorm
 from safetensors.torch import load_model
 
+from embedding_cache import (
+    EmbeddingCache,
+    LatencyStats,
+    capture_state,
+    content_key,
+    pointcloud_state,
+    restore_state,
+)
+from ply_io import ply_fields, read_ply, save_colored_pc
+from transforms import normalization_params, normalize_colors
+from volume_pc import (
+    load_volume,
+    points_to_volume,
+    save_label_volume,
+    strategies,
+    volume_to_points,
+)
+
+precisions = {"fp32": None, "bf16": torch.bfloat16, "fp16": torch.float16}
+
+
+def is_volume(path):
+    return path.endswith(".nii") or path.endswith(".nii.gz")
+
+
+def load_point_cloud(
+    path, threshold=0.0, mask=None, num_points=None, strategy="uniform"
+):
+    """Read a point cloud as (coords [N, 3] float32, colors [N, 3] float32 in [0, 255]).
+
+    Supported inputs are PLY files with x/y/z and optionally red/green/blue (or
+    R/G/B), ``.npy`` arrays of [N, 3] coords or [N, 6] coords and colors, and
+    NIfTI gray-scale volumes, converted by `volume_pc.volume_to_points` with
+    the optional brain ``mask`` path, point budget and sampling strategy.
+    """
+    if path.endswith(".ply"):
+        data = read_ply(path, mmap=True)
+        coords = ply_fields(data, ("x", "y", "z"), contiguous=True)
+        names = data.dtype.names
+        for rgb in (("red", "green", "blue"), ("R", "G", "B")):
+            if all(c in names for c in rgb):
+                return coords, ply_fields(data, rgb, contiguous=True)
+        return coords, np.full_like(coords, 127.5)
+    if path.endswith(".npy"):
+        arr = np.load(path).astype(np.float32)
+        if arr.shape[1] >= 6:
+            return np.ascontiguousarray(arr[:, :3]), np.ascontiguousarray(arr[:, 3:6])
+        return np.ascontiguousarray(arr[:, :3]), np.full_like(arr[:, :3], 127.5)
+    if is_volume(path):
+        vol, affine = load_volume(path)
+        region = load_volume(mask)[0] if mask is not None else None
+        coords, colors, _ = volume_to_points(
+            vol, affine, region, threshold, num_points, strategy
+        )
+        return coords, colors
+    raise ValueError(f"Unsupported input {path}")
+
+
+def load_pretrained(
+    config="large", config_dir="../configs", ckpt_path=None, device="cpu", overrides=()
+):
+    """Instantiate Point-SAM from a hydra config and load its weights."""
+    with hydra.initialize(config_dir, version_base=None):
+        cfg = hydra.compose(config_name=config, overrides=list(overrides))
+        OmegaConf.resolve(cfg)
+
+    set_seed(cfg.get("seed", 42))
+    model: PointCloudSAM = hydra.utils.instantiate(cfg.model)
+    # apex fused layernorm is CUDA only
+    if torch.device(device).type == "cuda":
+        model.apply(replace_with_fused_layernorm)
+    if ckpt_path is not None:
+        load_model(model, ckpt_path)
+    model.eval()
+    return model.to(device)
+
+
+class PointSAMPredictor:
+    """Prompted segmentation of point clouds, encoding each cloud once.
+
+    The encoder output of the last ``cache_size`` clouds is kept, keyed by
+    content, so selecting a cloud again and every prompt set after the first
+    only run the mask decoder. Encode and decode times are recorded separately
+    in ``latency``.
+
+    >>> predictor = PointSAMPredictor(load_pretrained(ckpt_path=...), device="cpu")
+    >>> predictor.set_point_cloud(*load_point_cloud("scan.ply"))
+    >>> masks, scores, logits = predictor.predict([100], prompt_labels=[1])
+    >>> masks, scores, logits = predictor.predict(
+    ...     [100, 2000], prompt_labels=[1, 0], prev_masks=logits
+    ... )
+
+    Parameters
+    ----------
+    device : str
+        'cpu' or 'cuda'.
+    precision : str
+        'fp32', or 'bf16' / 'fp16' to run under autocast. bf16 is the faster
+        choice on CPUs that support it.
+    num_threads : int, optional
+        torch intra-op threads for CPU inference.
+    cache_size : int
+        number of encoded clouds kept.
+    state_names : tuple
+        model attributes set by ``set_pointcloud`` that make up an encoded cloud.
+    """
+
+    def __init__(
+        self,
+        model,
+        device="cpu",
+        precision="fp32",
+        num_threads=None,
+        cache_size=4,
+        state_names=pointcloud_state,
+    ):
+        self.model = model
+        self.device = torch.device(device)
+        self.dtype = precisions[precision]
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+        self.cache = EmbeddingCache(cache_size)
+        self.state_names = state_names
+        self.latency = LatencyStats(self.device)
+        self.key = None
+        self.coords = None
+
+    def autocast(self):
+        if self.dtype is None:
+            return nullcontext()
+        return torch.autocast(self.device.type, dtype=self.dtype)
+
+    @torch.no_grad()
+    def encode(self, coords, colors):
+        """Normalize a cloud as in evaluation and run the point cloud encoder.
+
+        Returns the content key of the cloud, and whether it was already cached.
+        """
+        coords = np.asarray(coords, dtype=np.float32)
+        colors = np.asarray(colors, dtype=np.float32)
+        key = content_key(coords, colors)
+        entry = self.cache.get(key)
+        if entry is not None:
+            self.select(key, entry)
+            return key, True
+
+        with self.latency.timer("encode"):
+            centroid, norm = normalization_params(coords)
+            xyz = torch.as_tensor(
+                (coords - centroid) / norm, dtype=torch.float, device=self.device
+            )
+            rgb = torch.as_tensor(
+                normalize_colors(colors), dtype=torch.float, device=self.device
+            )
+
+            def run():
+                with self.autocast():
+                    self.model.set_pointcloud(xyz[None], rgb[None])
+
+            state = capture_state(self.model, run, self.state_names)
+        entry = {"state": state, "coords": coords, "centroid": centroid, "norm": norm}
+        self.cache.put(key, entry)
+        self.select(key, entry)
+        return key, False
+
+    def set_point_cloud(self, coords, colors):
+        """Make a cloud the target of `predict`, encoding it unless cached."""
+        return self.encode(coords, colors)[1]
+
+    def select(self, key, entry=None):
+        """Switch to a cached cloud by its key, without encoding."""
+        if entry is None:
+            entry = self.cache.get(key)
+            if entry is None:
+                raise KeyError(f"Point cloud {key} is not cached")
+        if key != self.key:
+            restore_state(self.model, entry["state"])
+        self.key = key
+        self.coords = entry["coords"]
+        self.centroid, self.norm = entry["centroid"], entry["norm"]
+
+    @torch.no_grad()
+    def predict(
+        self,
+        prompt_indices=None,
+        prompt_coords=None,
+        prompt_labels=None,
+        prev_masks=None,
+        multimask=False,
+    ):
+        """Per-point masks for a set of prompts.
+
+        Parameters
+        ----------
+        prompt_indices : list, optional
+            indices of prompted points in the cloud.
+        prompt_coords : array, optional
+            [P, 3] prompt positions in the input coordinates.
+        prompt_labels : list, optional
+            1 for positive and 0 for negative prompts, default all positive.
+        prev_masks : tensor, optional
+            mask logits of a previous prediction, to refine it.
+
+        Returns
+        -------
+        masks : array
+            [M, N] bool, M is 3 with multimask, else 1.
+        scores : array
+            [M] predicted IoU of each mask.
+        logits : tensor
+            [1, M, N] mask logits, to pass back as prev_masks.
+        """
+        if self.coords is None:
+            raise RuntimeError("set_point_cloud has to be called first")
+        points = []
+        if prompt_indices is not None:
+            points.append(self.coords[np.asarray(prompt_indices, dtype=np.int64)])
+        if prompt_coords is not None:
+            points.append(np.asarray(prompt_coords, dtype=np.float32).reshape(-1, 3))
+        if not points:
+            raise ValueError("No prompts given")
+        points = (np.concatenate(points) - self.centroid) / self.norm
+        if prompt_labels is None:
+            prompt_labels = np.ones(len(points))
+        prompt_points = torch.as_tensor(points, dtype=torch.float, device=self.device)[
+            None
+        ]
+        labels = torch.as_tensor(
+            np.asarray(prompt_labels), dtype=torch.bool, device=self.device
+        )[None]
+        with self.latency.timer("decode"):
+            with self.autocast():
+                logits, scores = self.model.predict_masks(
+                    prompt_points, labels, prev_masks, multimask
+                )
+            logits = logits.float()
+            masks = (logits[0] > 0).cpu().numpy()
+        return masks, scores[0].float().cpu().numpy(), logits
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -21,51 +267,123 @@ def main():
         type=str,
         default="./pretrained/ours/mixture_10k_giant/model.safetensors",
     )
+    parser.add_argument(
+        "--input", type=str, required=True, help=".ply, .npy or NIfTI volume"
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.0,
+        help="NIfTI voxels above this become points",
+    )
+    parser.add_argument(
+        "--mask",
+        type=str,
+        default=None,
+        help="NIfTI brain mask, instead of the threshold",
+    )
+    parser.add_argument(
+        "--num_points", type=int, default=None, help="point budget for NIfTI input"
+    )
+    parser.add_argument("--strategy", type=str, default="uniform", choices=strategies)
+    parser.add_argument("--prompt_indices", type=int, nargs="*", default=None)
+    parser.add_argument(
+        "--prompt_coords",
+        type=float,
+        nargs="*",
+        default=None,
+        help="x y z of each prompt",
+    )
+    parser.add_argument(
+        "--prompt_labels",
+        type=int,
+        nargs="*",
+        default=None,
+        help="1 positive, 0 negative",
+    )
+    parser.add_argument("--multimask", action="store_true")
+    parser.add_argument(
+        "--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu"
+    )
+    parser.add_argument(
+        "--precision", type=str, default="fp32", choices=list(precisions)
+    )
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument(
+        "--clicks",
+        type=int,
+        default=1,
+        help="repeat the prompts, refining the mask, to time decoding",
+    )
+    parser.add_argument("--cache_size", type=int, default=4, help="encoded clouds kept")
+    parser.add_argument(
+        "--output",
+        type=str,
+        default="masks.npy",
+        help=".npy masks, .ply with a mask property, or .nii.gz label volume "
+        "for NIfTI input",
+    )
     args, unknown_args = parser.parse_known_args()
 
-    # ---------------------------------------------------------------------------- #
-    # Load configuration
-    # ---------------------------------------------------------------------------- #
-    with hydra.initialize(args.config_dir, version_base=None):
-        cfg = hydra.compose(config_name=args.config, overrides=unknown_args)
-        OmegaConf.resolve(cfg)
-        # print(OmegaConf.to_yaml(cfg))
-
-    seed = cfg.get("seed", 42)
-
     # ---------------------------------------------------------------------------- #
     # Setup model
     # ---------------------------------------------------------------------------- #
-    set_seed(seed)
-    model: PointCloudSAM = hydra.utils.instantiate(cfg.model)
-    model.apply(replace_with_fused_layernorm)
-
-    # ---------------------------------------------------------------------------- #
-    # Load pre-trained model
-    # ---------------------------------------------------------------------------- #
-    load_model(model, args.ckpt_path)
+    model = load_pretrained(
+        args.config, args.config_dir, args.ckpt_path, args.device, unknown_args
+    )
+    predictor = PointSAMPredictor(
+        model, args.device, args.precision, args.threads, args.cache_size
+    )
 
     # ---------------------------------------------------------------------------- #
     # Inference
     # ---------------------------------------------------------------------------- #
-    model.eval()
-    model.cuda()
-    coords = ...
-    colors = ...
-    labels = ...
-
-    # normalize coords
-    coords = coords - coords.mean(dim=1, keepdim=True)
-    coords = coords / coords.norm(dim=2, keepdim=True).max()
-
-    # normalize colors
-    colors = colors / 255
-
-    # coords: [B, N, 3]
-    # colors: [B, N, 3]
-    # labels: [B, N]
-    data = {"xyz": coords, "rgb": colors, "mask": labels}
-    outputs = model(**data, is_eval=True)
+    if is_volume(args.input):
+        vol, affine = load_volume(args.input)
+        region = load_volume(args.mask)[0] > 0 if args.mask else vol > args.threshold
+        coords, colors, ijk = volume_to_points(
+            vol, affine, region, num_points=args.num_points, strategy=args.strategy
+        )
+    else:
+        coords, colors = load_point_cloud(args.input)
+    predictor.set_point_cloud(coords, colors)
+    # a second selection of the same cloud is a cache hit and skips the encoder
+    tic = time.perf_counter()
+    predictor.set_point_cloud(coords, colors)
+    hit_time = time.perf_counter() - tic
+    logits = None
+    for _ in range(args.clicks):
+        masks, scores, logits = predictor.predict(
+            args.prompt_indices,
+            args.prompt_coords,
+            args.prompt_labels,
+            logits,
+            args.multimask,
+        )
+    stats = predictor.latency.summary()
+    print(
+        f"{len(coords)} points, encode {stats['encode']['mean']:.2f}s, "
+        f"cached select {hit_time * 1e3:.1f}ms, "
+        f"decode mean {stats['decode']['mean'] * 1e3:.1f}ms "
+        f"p95 {stats['decode']['p95'] * 1e3:.1f}ms "
+        f"over {stats['decode']['count']} clicks, scores {scores}"
+    )
+
+    best = masks[np.argmax(scores)]
+    if args.output.endswith(".ply"):
+        save_colored_pc(args.output, coords, colors / 255, mask=best)
+    elif is_volume(args.output):
+        # unsampled voxels of the region take the label of the nearest point
+        save_label_volume(
+            args.output, points_to_volume(best, ijk, vol.shape, region), affine
+        )
+    else:
+        np.save(args.output, masks)
+    print(
+        f"{best.sum()} of {len(best)} points in the mask, "
+        f"saved to {os.path.abspath(args.output)}"
+    )
+
 
 if __name__ == "__main__":
     main()
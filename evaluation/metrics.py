@@ -0,0 +1,253 @@
+"""Streaming IoU metrics.
+
+Per-iteration IoU sums over clouds and per-object sums are kept as tensors on
+the evaluation device, so an update is an in-place add with no host transfer.
+The running means are copied to the host every ``sync_every`` updates, for
+progress output, and at the end. Sums and counts rather than means are stored,
+so shards of a dataset evaluated separately merge exactly::
+
+    python evaluation/eval_kitti.py --num_shards 4 --shard 0 --metrics_out shard0
+    ...
+    python evaluation/metrics.py shard*.json --output kitti360
+"""
+
+import argparse
+import csv
+import json
+
+import numpy as np
+import torch
+
+
+class IoUAccumulator:
+    """Running mean IoU, per prompt iteration and per object.
+
+    Parameters
+    ----------
+    device : str, optional
+        device of the running sums, the device of the IoUs passed to `update`.
+    sync_every : int
+        updates between copies of the running means to the host.
+    """
+
+    def __init__(self, device="cpu", sync_every=100):
+        self.device = torch.device(device)
+        self.sync_every = sync_every
+        self.num_clouds = 0
+        self.num_updates = 0
+        self.total = None  # [T] sum over clouds
+        self.object_index = {}
+        self.object_sums = None  # [K, T], rows beyond len(object_index) unused
+        self.object_counts = None  # [K]
+        self.host = None
+
+    def _allocate(self, num_iters, capacity=64):
+        self.total = torch.zeros(num_iters, dtype=torch.float64, device=self.device)
+        self.object_sums = torch.zeros(
+            (capacity, num_iters), dtype=torch.float64, device=self.device
+        )
+        self.object_counts = torch.zeros(
+            capacity, dtype=torch.float64, device=self.device
+        )
+
+    def _object_rows(self, names):
+        for name in names:
+            if name not in self.object_index:
+                self.object_index[name] = len(self.object_index)
+        capacity = len(self.object_sums)
+        if len(self.object_index) > capacity:
+            # doubling keeps the growth amortized O(1) per object
+            grow = max(capacity, len(self.object_index) - capacity)
+            self.object_sums = torch.cat(
+                [
+                    self.object_sums,
+                    self.object_sums.new_zeros((grow, self.object_sums.shape[1])),
+                ]
+            )
+            self.object_counts = torch.cat(
+                [self.object_counts, self.object_counts.new_zeros(grow)]
+            )
+        return torch.tensor([self.object_index[n] for n in names], device=self.device)
+
+    @torch.no_grad()
+    def update(self, names, ious):
+        """Add the IoUs of a batch of clouds.
+
+        Parameters
+        ----------
+        names : list
+            object name of each cloud.
+        ious : tensor
+            [B, T] IoU of each cloud at each prompt iteration.
+
+        Returns
+        -------
+        bool
+            whether the host copy was refreshed by this update.
+        """
+        ious = (
+            torch.as_tensor(ious, device=self.device)
+            .to(torch.float64)
+            .reshape(len(names), -1)
+        )
+        if self.total is None:
+            self._allocate(ious.shape[1])
+        rows = self._object_rows(names)
+        self.total += ious.sum(dim=0)
+        self.object_sums.index_add_(0, rows, ious)
+        self.object_counts.index_add_(
+            0, rows, torch.ones_like(rows, dtype=torch.float64)
+        )
+        self.num_clouds += len(names)
+        self.num_updates += 1
+        if self.num_updates % self.sync_every == 0:
+            self.sync()
+            return True
+        return False
+
+    def sync(self):
+        """Copy the sums to the host, one transfer per tensor."""
+        if self.total is None:
+            self.host = {
+                "num_clouds": 0,
+                "total": np.zeros(0),
+                "object_sums": np.zeros((0, 0)),
+                "object_counts": np.zeros(0),
+            }
+            return self.host
+        num_objects = len(self.object_index)
+        self.host = {
+            "num_clouds": self.num_clouds,
+            "total": self.total.cpu().numpy(),
+            "object_sums": self.object_sums[:num_objects].cpu().numpy(),
+            "object_counts": self.object_counts[:num_objects].cpu().numpy(),
+        }
+        return self.host
+
+    @property
+    def mean(self):
+        """[T] mean IoU over clouds, as of the last sync."""
+        if self.host is None or self.host["num_clouds"] == 0:
+            return np.zeros(0)
+        return self.host["total"] / self.host["num_clouds"]
+
+    def state_dict(self):
+        """Sums and counts, JSON serializable, for saving and merging shards."""
+        host = self.sync()
+        return {
+            "num_clouds": int(host["num_clouds"]),
+            "total": host["total"].tolist(),
+            "objects": {
+                name: {
+                    "count": int(host["object_counts"][i]),
+                    "sum": host["object_sums"][i].tolist(),
+                }
+                for name, i in self.object_index.items()
+            },
+        }
+
+    def load_state_dict(self, state):
+        self.object_index = {}
+        self.total = None
+        self.num_clouds = 0
+        self.merge_state(state)
+
+    def merge_state(self, state):
+        """Add the sums of another accumulator, eg of another shard."""
+        if not state["objects"]:
+            return
+        if self.total is None:
+            self._allocate(len(state["total"]))
+        names = list(state["objects"])
+        rows = self._object_rows(names)
+        sums = torch.tensor(
+            [state["objects"][n]["sum"] for n in names],
+            dtype=torch.float64,
+            device=self.device,
+        )
+        counts = torch.tensor(
+            [state["objects"][n]["count"] for n in names],
+            dtype=torch.float64,
+            device=self.device,
+        )
+        self.total += torch.tensor(
+            state["total"], dtype=torch.float64, device=self.device
+        )
+        self.object_sums.index_add_(0, rows, sums)
+        self.object_counts.index_add_(0, rows, counts)
+        self.num_clouds += state["num_clouds"]
+        self.sync()
+
+    def summary(self):
+        """Mean IoU over clouds, over objects, and of each object."""
+        host = self.sync()
+        object_means = (
+            host["object_sums"] / np.maximum(host["object_counts"], 1)[:, None]
+        )
+        return {
+            "num_clouds": int(host["num_clouds"]),
+            "num_objects": len(self.object_index),
+            "mean_iou": self.mean.tolist(),
+            "object_mean_iou": (
+                object_means.mean(axis=0).tolist() if len(object_means) else []
+            ),
+            "objects": {
+                name: {
+                    "count": int(host["object_counts"][i]),
+                    "mean_iou": object_means[i].tolist(),
+                }
+                for name, i in self.object_index.items()
+            },
+        }
+
+    def save(self, prefix):
+        """Write prefix.json, summary and mergeable sums, and prefix.csv per object."""
+        summary = self.summary()
+        summary["state"] = self.state_dict()
+        with open(prefix + ".json", "w") as fp:
+            json.dump(summary, fp, indent=2)
+        with open(prefix + ".csv", "w", newline="") as fp:
+            writer = csv.writer(fp)
+            num_iters = len(summary["mean_iou"])
+            writer.writerow(
+                ["object", "count"] + [f"iou_{t}" for t in range(num_iters)]
+            )
+            for name, obj in summary["objects"].items():
+                writer.writerow([name, obj["count"]] + obj["mean_iou"])
+            writer.writerow(["all_clouds", summary["num_clouds"]] + summary["mean_iou"])
+            writer.writerow(
+                ["all_objects", summary["num_objects"]] + summary["object_mean_iou"]
+            )
+
+
+def merge_files(paths, device="cpu"):
+    """One accumulator from the JSON files written by `IoUAccumulator.save`."""
+    metrics = IoUAccumulator(device)
+    for path in paths:
+        with open(path) as fp:
+            metrics.merge_state(json.load(fp)["state"])
+    return metrics
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("shards", type=str, nargs="+", help="JSON files of the shards")
+    parser.add_argument(
+        "--output", type=str, default=None, help="prefix of the merged .json and .csv"
+    )
+    args = parser.parse_args()
+
+    metrics = merge_files(args.shards)
+    summary = metrics.summary()
+    print(
+        f"{summary['num_clouds']} clouds, {summary['num_objects']} objects "
+        f"from {len(args.shards)} shards"
+    )
+    print(f"Total mean IoU: {np.array(summary['mean_iou'])}")
+    print(f"Object mean IoU: {np.array(summary['object_mean_iou'])}")
+    if args.output is not None:
+        metrics.save(args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+"""Packed, sharded store of preprocessed point clouds.
+
+Parsing, rotating and normalizing every KITTI-360 crop on each evaluation run
+is done once instead: the clouds are packed into a few shards, each with one
+contiguous coords, colors and labels array, plus an offsets index. Later runs
+memory-map the shards, and a cloud is a slice of them.
+
+Layout of the cache directory::
+
+    index.json               source files, object names and the cache key
+    offsets.npy              [num_clouds, 3] int64 of (shard, start, count)
+    shard_0000_coords.npy    [n, 3] float32, rotated and normalized
+    shard_0000_colors.npy    [n, 3] float32, normalized
+    shard_0000_labels.npy    [n] int32
+"""
+
+import json
+import os
+import shutil
+
+import numpy as np
+
+version = 1
+
+
+class PointCloudCache:
+    """Read-only access to a cache written by `build_cache`."""
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        with open(os.path.join(cache_dir, "index.json")) as f:
+            self.index = json.load(f)
+        self.files = self.index["files"]
+        self.names = self.index["names"]
+        self.offsets = np.load(os.path.join(cache_dir, "offsets.npy"))
+        self._shards = {}
+
+    def __len__(self):
+        return len(self.files)
+
+    def shard(self, k):
+        if k not in self._shards:
+            self._shards[k] = tuple(
+                np.load(
+                    os.path.join(self.cache_dir, f"shard_{k:04d}_{name}.npy"),
+                    mmap_mode="r",
+                )
+                for name in ("coords", "colors", "labels")
+            )
+        return self._shards[k]
+
+    def num_points(self, i):
+        return int(self.offsets[i, 2])
+
+    def __getitem__(self, i):
+        """Returns (name, coords, colors, labels), as read-only views of the shard."""
+        k, start, count = self.offsets[i]
+        coords, colors, labels = self.shard(int(k))
+        return (
+            self.names[i],
+            coords[start : start + count],
+            colors[start : start + count],
+            labels[start : start + count],
+        )
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def is_valid(cache_dir, files, key=""):
+    try:
+        with open(os.path.join(cache_dir, "index.json")) as f:
+            index = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return False
+    return (
+        index.get("version") == version
+        and index.get("key") == key
+        and index.get("files") == list(files)
+    )
+
+
+def build_cache(
+    files, cache_dir, load_fn, name_fn=os.path.basename, key="", shard_points=8_000_000
+):
+    """Preprocess ``files`` with ``load_fn`` and pack them into ``cache_dir``.
+
+    Parameters
+    ----------
+    files : list
+        source files, in the order of the cache.
+    load_fn : callable
+        filename -> (coords [N, 3], colors [N, 3], labels [N]), already
+        rotated and normalized.
+    name_fn : callable
+        filename -> name stored with each cloud, eg the object class.
+    key : str
+        description of the preprocessing. A cache built with a different key
+        is rebuilt by `open_cache`.
+    shard_points : int
+        points per shard, a shard is closed once it has at least this many.
+    """
+    files = list(files)
+    tmp_dir = cache_dir.rstrip("/") + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    offsets = np.zeros((len(files), 3), dtype=np.int64)
+    buffers = ([], [], [])
+    shard, start = 0, 0
+
+    def flush():
+        for name, buf, dtype in zip(
+            ("coords", "colors", "labels"), buffers, (np.float32, np.float32, np.int32)
+        ):
+            arr = (
+                np.concatenate(buf).astype(dtype, copy=False)
+                if buf
+                else np.zeros((0,), dtype=dtype)
+            )
+            np.save(os.path.join(tmp_dir, f"shard_{shard:04d}_{name}.npy"), arr)
+            buf.clear()
+
+    for i, filename in enumerate(files):
+        coords, colors, labels = load_fn(filename)
+        offsets[i] = (shard, start, len(coords))
+        for buf, arr in zip(buffers, (coords, colors, labels)):
+            buf.append(np.asarray(arr))
+        start += len(coords)
+        if start >= shard_points:
+            flush()
+            shard, start = shard + 1, 0
+    if start > 0 or shard == 0:
+        flush()
+
+    np.save(os.path.join(tmp_dir, "offsets.npy"), offsets)
+    with open(os.path.join(tmp_dir, "index.json"), "w") as f:
+        json.dump(
+            {
+                "version": version,
+                "key": key,
+                "files": files,
+                "names": [name_fn(f) for f in files],
+            },
+            f,
+        )
+
+    # replace any previous cache only once the new one is complete
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    os.rename(tmp_dir, cache_dir)
+    return PointCloudCache(cache_dir)
+
+
+def open_cache(files, cache_dir, load_fn, key="", **kwargs):
+    """Open the cache in ``cache_dir``, building it first if it is missing or stale."""
+    if not is_valid(cache_dir, files, key):
+        print(f"Building point cloud cache in {cache_dir}")
+        return build_cache(files, cache_dir, load_fn, key=key, **kwargs)
+    return PointCloudCache(cache_dir)
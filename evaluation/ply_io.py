@@ -0,0 +1,473 @@
+"""PLY reading and writing for the evaluation scripts.
+
+Point clouds are written as binary little-endian PLY from a NumPy structured
+array in a single ``tofile`` call, instead of formatting one ASCII line per
+point. Binary files are read as a ``np.memmap`` at the data offset, so only
+the properties that are used are ever read from disk. Run this module to
+compare against the previous ASCII writer and ``np.fromfile`` reader::
+
+    python evaluation/ply_io.py --num_points 100000
+"""
+
+import argparse
+import itertools
+import os
+import tempfile
+import time
+
+import numpy as np
+
+valid_formats = {"ascii": "", "binary_big_endian": ">", "binary_little_endian": "<"}
+
+ply_dtypes = dict(
+    [
+        (b"int8", "i1"),
+        (b"char", "i1"),
+        (b"uint8", "u1"),
+        (b"uchar", "u1"),
+        (b"int16", "i2"),
+        (b"short", "i2"),
+        (b"uint16", "u2"),
+        (b"ushort", "u2"),
+        (b"int32", "i4"),
+        (b"int", "i4"),
+        (b"uint32", "u4"),
+        (b"uint", "u4"),
+        (b"float32", "f4"),
+        (b"float", "f4"),
+        (b"float64", "f8"),
+        (b"double", "f8"),
+    ]
+)
+
+# numpy dtype -> ply type name, for writing
+ply_names = {
+    "i1": "char",
+    "u1": "uchar",
+    "i2": "short",
+    "u2": "ushort",
+    "i4": "int",
+    "u4": "uint",
+    "f4": "float",
+    "f8": "double",
+}
+
+# dtypes that PLY has no type for, and what they are written as
+_cast = {"b1": "u1", "i8": "i4", "u8": "u4", "f2": "f4"}
+
+
+def parse_ply_header(plyfile):
+    """Parse the header of an open PLY file.
+
+    Returns
+    -------
+    fmt : str
+        'ascii', 'binary_little_endian' or 'binary_big_endian'
+    elements : list
+        (name, count, properties) per element, in file order. properties are
+        (name, dtype) for scalars and (name, (count_dtype, item_dtype)) for lists.
+    offset : int
+        byte offset of the data
+    """
+    if b"ply" not in plyfile.readline():
+        raise ValueError("The file does not start whith the word ply")
+    fmt = None
+    elements = []
+    line = b""
+    while not line.startswith(b"end_header"):
+        line = plyfile.readline()
+        if line == b"":
+            raise ValueError("The file has no end_header")
+        words = line.split()
+        if not words or words[0] in (b"comment", b"obj_info"):
+            continue
+        if words[0] == b"format":
+            fmt = words[1].decode()
+            if fmt not in valid_formats:
+                raise ValueError(f"Unknown PLY format {fmt}")
+        elif words[0] == b"element":
+            elements.append((words[1].decode(), int(words[2]), []))
+        elif words[0] == b"property":
+            ext = valid_formats[fmt]
+            if words[1] == b"list":
+                elements[-1][2].append(
+                    (
+                        words[4].decode(),
+                        (ext + ply_dtypes[words[2]], ext + ply_dtypes[words[3]]),
+                    )
+                )
+            else:
+                elements[-1][2].append((words[2].decode(), ext + ply_dtypes[words[1]]))
+    return fmt, elements, plyfile.tell()
+
+
+def _triangles(properties):
+    # fixed size record for faces that are all triangles,
+    # eg 'property list uchar int vertex_indices'
+    ((name, types),) = properties
+    if not isinstance(types, tuple):
+        raise ValueError(f"Unsupported face property {name}")
+    return [("k", types[0]), ("v1", types[1]), ("v2", types[1]), ("v3", types[1])]
+
+
+def load_ply(filename, mmap=True):
+    """Read all elements of a PLY file.
+
+    Binary files are memory-mapped (unless ``mmap=False``), so nothing is read
+    until a property is accessed. ASCII files are parsed into memory.
+
+    Returns
+    -------
+    data : dict
+        element name -> structured array, eg ``data['vertex']['x']``. faces are
+        returned as an [M, 3] int array under 'face'.
+    """
+    with open(filename, "rb") as plyfile:
+        fmt, elements, offset = parse_ply_header(plyfile)
+        data = {}
+        if fmt == "ascii":
+            # the data follows on the same binary handle, decoded line by line
+            for name, count, properties in elements:
+                # islice so that each element consumes exactly its own lines
+                lines = (
+                    line.decode("ascii") for line in itertools.islice(plyfile, count)
+                )
+                if name == "face":
+                    rows = (
+                        np.loadtxt(lines, dtype=np.int64, ndmin=2)
+                        if count
+                        else np.zeros((0, 4), np.int64)
+                    )
+                    if count and not np.all(rows[:, 0] == 3):
+                        raise ValueError("Only triangular faces are supported")
+                    data[name] = rows[:, 1:4].astype(np.int32)
+                else:
+                    if any(isinstance(t, tuple) for _, t in properties):
+                        raise ValueError(f"Unsupported list property in element {name}")
+                    rows = (
+                        np.loadtxt(lines, dtype=np.float64, ndmin=2) if count else None
+                    )
+                    arr = np.empty(count, dtype=properties)
+                    for i, (prop, _) in enumerate(properties if count else []):
+                        arr[prop] = rows[:, i]
+                    data[name] = arr
+            return data
+
+    for name, count, properties in elements:
+        if name != "face" and any(isinstance(t, tuple) for _, t in properties):
+            raise ValueError(f"Unsupported list property in element {name}")
+        dtype = _triangles(properties) if name == "face" else properties
+        dtype = np.dtype(dtype)
+        if mmap and count:
+            arr = np.memmap(
+                filename, dtype=dtype, mode="r", offset=offset, shape=(count,)
+            )
+        else:
+            arr = np.fromfile(filename, dtype=dtype, count=count, offset=offset)
+        offset += count * dtype.itemsize
+        if name == "face":
+            if count and not np.all(arr["k"] == 3):
+                raise ValueError("Only triangular faces are supported")
+            arr = np.stack([arr["v1"], arr["v2"], arr["v3"]], axis=1)
+        data[name] = arr
+    return data
+
+
+def ply_fields(data, names=("x", "y", "z"), contiguous=False, dtype=np.float32):
+    """Select properties of a structured vertex array as an [N, len(names)] array.
+
+    With ``contiguous=False`` the result is a strided view into ``data``, with
+    no copy, if the properties have the same type and are adjacent in the
+    record, as x/y/z and red/green/blue usually are. Otherwise, or with
+    ``contiguous=True``, the properties are copied once into a contiguous
+    array of ``dtype``.
+    """
+    fields = data.dtype.fields
+    types = [fields[name][0] for name in names]
+    offsets = [fields[name][1] for name in names]
+    adjacent = all(t == types[0] for t in types) and all(
+        o == offsets[0] + i * types[0].itemsize for i, o in enumerate(offsets)
+    )
+    if adjacent and not contiguous:
+        first = data[names[0]]
+        return np.lib.stride_tricks.as_strided(
+            first,
+            shape=(len(data), len(names)),
+            strides=(data.strides[0], types[0].itemsize),
+            writeable=False,
+        )
+    out = np.empty((len(data), len(names)), dtype=dtype)
+    for i, name in enumerate(names):
+        out[:, i] = data[name]
+    return out
+
+
+def read_ply(filename, triangular_mesh=False, mmap=False):
+    """
+    Read ".ply" files
+    Parameters
+    ----------
+    filename : string
+        the name of the file to read.
+    triangular_mesh : bool
+        also return the faces.
+    mmap : bool
+        memory-map the vertex data of binary files instead of reading it.
+    Returns
+    -------
+    result : array
+        data stored in the file
+    Examples
+    --------
+    Store data in file
+    >>> points = np.random.rand(5, 3)
+    >>> values = np.random.randint(2, size=10)
+    >>> write_ply('example.ply', [points, values], ['x', 'y', 'z', 'values'])
+    Read the file
+    >>> data = read_ply('example.ply')
+    >>> values = data['values']
+    array([0, 0, 1, 1, 0])
+
+    >>> points = np.vstack((data['x'], data['y'], data['z'])).T
+    array([[ 0.466  0.595  0.324]
+           [ 0.538  0.407  0.654]
+           [ 0.850  0.018  0.988]
+           [ 0.395  0.394  0.363]
+           [ 0.873  0.996  0.092]])
+    """
+
+    data = load_ply(filename, mmap=mmap)
+    if triangular_mesh:
+        return [data["vertex"], data.get("face", np.zeros((0, 3), dtype=np.int32))]
+    return data["vertex"]
+
+
+def _ply_dtype(dtype):
+    code = np.dtype(dtype).str[1:]
+    code = _cast.get(code, code)
+    if code not in ply_names:
+        raise ValueError(f"Unsupported PLY property type: {dtype}")
+    return "<" + code
+
+
+def write_ply(filename, field_list, field_names, triangular_faces=None):
+    """
+    Write ".ply" files as binary little-endian.
+
+    Parameters
+    ----------
+    filename : string
+        the name of the file to which the data is saved. A '.ply' extension
+        is added if not already there.
+    field_list : list, tuple, numpy array
+        the fields to be saved in the ply file. Either a numpy array, a list
+        of numpy arrays or a tuple of numpy arrays. Each 1D numpy array and
+        each column of 2D numpy arrays are considered as one field.
+    field_names : list
+        the name of each field as a list of strings. Has to be the same
+        length as the number of fields.
+    triangular_faces : array, optional
+        [M, 3] vertex indices of a triangle mesh.
+
+    Returns
+    -------
+    success : bool
+
+    Examples
+    --------
+    >>> points = np.random.rand(10, 3)
+    >>> write_ply('example1.ply', points, ['x', 'y', 'z'])
+
+    >>> values = np.random.randint(2, size=10)
+    >>> write_ply('example2.ply', [points, values], ['x', 'y', 'z', 'values'])
+
+    >>> colors = np.random.randint(255, size=(10, 3), dtype=np.uint8)
+    >>> field_names = ['x', 'y', 'z', 'red', 'green', 'blue', 'values']
+    >>> write_ply('example3.ply', [points, colors, values], field_names)
+    """
+
+    # Format list input to the right form
+    field_list = (
+        list(field_list)
+        if isinstance(field_list, (list, tuple))
+        else list((field_list,))
+    )
+    field_list = [np.asarray(field) for field in field_list]
+    for i, field in enumerate(field_list):
+        if field.ndim < 2:
+            field_list[i] = field.reshape(-1, 1)
+        if field.ndim > 2:
+            print("fields have more than 2 dimensions")
+            return False
+
+    # check all fields have the same number of data
+    n_points = [field.shape[0] for field in field_list]
+    if not np.all(np.equal(n_points, n_points[0])):
+        print("wrong field dimensions")
+        return False
+
+    # Check if field_names and field_list have same nb of column
+    n_fields = np.sum([field.shape[1] for field in field_list])
+    if n_fields != len(field_names):
+        print("wrong number of field names")
+        return False
+
+    if not filename.endswith(".ply"):
+        filename += ".ply"
+
+    # one record per point, each field column becomes a property
+    dtype = []
+    columns = []
+    i = 0
+    for field in field_list:
+        for j in range(field.shape[1]):
+            dtype.append((field_names[i], _ply_dtype(field.dtype)))
+            columns.append(field[:, j])
+            i += 1
+    data = np.empty(n_points[0], dtype=dtype)
+    for (name, _), column in zip(dtype, columns):
+        data[name] = column
+
+    header = ["ply", "format binary_little_endian 1.0"]
+    header.append(f"element vertex {n_points[0]}")
+    for name, code in dtype:
+        header.append(f"property {ply_names[code[1:]]} {name}")
+    if triangular_faces is not None:
+        triangular_faces = np.asarray(triangular_faces)
+        header.append(f"element face {triangular_faces.shape[0]}")
+        header.append("property list uchar int vertex_indices")
+    header.append("end_header")
+
+    with open(filename, "wb") as plyfile:
+        plyfile.write(("\n".join(header) + "\n").encode("ascii"))
+        data.tofile(plyfile)
+        if triangular_faces is not None:
+            faces = np.empty(
+                triangular_faces.shape[0],
+                dtype=[("k", "u1"), ("v1", "<i4"), ("v2", "<i4"), ("v3", "<i4")],
+            )
+            faces["k"] = 3
+            faces["v1"] = triangular_faces[:, 0]
+            faces["v2"] = triangular_faces[:, 1]
+            faces["v3"] = triangular_faces[:, 2]
+            faces.tofile(plyfile)
+
+    return True
+
+
+def save_colored_pc(file_name, xyz, rgb, **extra):
+    """Save a colored point cloud as binary PLY.
+
+    ``rgb`` is in [0, 1], with 3 channels or 1 gray-scale channel. Extra
+    per-point properties, eg ``label=labels`` or ``mask=pred_mask``, are
+    written as additional vertex properties.
+    """
+    rgb = np.asarray(rgb)
+    if rgb.ndim == 1:
+        rgb = rgb[:, None]
+    if rgb.shape[1] != 3:
+        rgb = np.repeat(rgb[:, :1], 3, axis=1)
+    # truncation as the previous %d formatting
+    rgb = np.clip(rgb * 255, 0, 255).astype(np.uint8)
+    fields = [np.asarray(xyz, dtype=np.float32), rgb]
+    names = ["x", "y", "z", "red", "green", "blue"]
+    for name, value in extra.items():
+        fields.append(np.asarray(value))
+        names.append(name)
+    return write_ply(file_name, fields, names)
+
+
+def save_colored_pc_ascii(file_name, xyz, rgb):
+    # previous per-point ASCII writer, kept for the benchmark below
+    # rgb is [0, 1]
+    n = xyz.shape[0]
+    f = open(file_name, "w")
+    f.write("ply\n")
+    f.write("format ascii 1.0\n")
+    f.write("element vertex %d\n" % n)
+    f.write("property float x\n")
+    f.write("property float y\n")
+    f.write("property float z\n")
+    f.write("property uchar red\n")
+    f.write("property uchar green\n")
+    f.write("property uchar blue\n")
+    f.write("end_header\n")
+    rgb = rgb * 255
+    for i in range(n):
+        if rgb.shape[1] == 3:
+            f.write(
+                "%f %f %f %d %d %d\n"
+                % (xyz[i][0], xyz[i][1], xyz[i][2], rgb[i][0], rgb[i][1], rgb[i][2])
+            )
+        else:
+            f.write(
+                "%f %f %f %d %d %d\n"
+                % (xyz[i][0], xyz[i][1], xyz[i][2], rgb[i][0], rgb[i][0], rgb[i][0])
+            )
+    f.close()
+
+
+def benchmark(num_points=100000, repeat=3):
+    rng = np.random.default_rng(0)
+    xyz = rng.standard_normal((num_points, 3)).astype(np.float32)
+    rgb = rng.random((num_points, 3)).astype(np.float32)
+    label = rng.integers(0, 20, num_points).astype(np.int32)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for name, fn, kwargs in [
+            ("ascii loop", save_colored_pc_ascii, {}),
+            ("binary tofile", save_colored_pc, {}),
+            ("binary tofile + label", save_colored_pc, {"label": label}),
+        ]:
+            filename = os.path.join(tmpdir, "bench.ply")
+            times = []
+            for _ in range(repeat):
+                tic = time.perf_counter()
+                fn(filename, xyz, rgb, **kwargs)
+                times.append(time.perf_counter() - tic)
+            size = os.path.getsize(filename) / 1e6
+            print(f"{name:24s} {min(times) * 1e3:9.1f} ms {size:8.2f} MB")
+
+        # reading xyz and rgb as float32, as the evaluation loop does
+        save_colored_pc(filename, xyz, rgb, label=label)
+
+        def fromfile_column_stack():
+            data = read_ply(filename)
+            return np.column_stack([data["x"], data["y"], data["z"]]).astype(
+                np.float32
+            ), np.column_stack([data["red"], data["green"], data["blue"]]).astype(
+                np.float32
+            )
+
+        def mmap_fields():
+            data = load_ply(filename)["vertex"]
+            return ply_fields(data, ("x", "y", "z"), contiguous=True), ply_fields(
+                data, ("red", "green", "blue"), contiguous=True
+            )
+
+        for name, fn in [
+            ("fromfile + column_stack", fromfile_column_stack),
+            ("memmap + ply_fields", mmap_fields),
+        ]:
+            times = []
+            for _ in range(repeat):
+                tic = time.perf_counter()
+                res = fn()
+                times.append(time.perf_counter() - tic)
+            print(f"{name:24s} {min(times) * 1e3:9.1f} ms")
+            assert np.array_equal(res[0], xyz)
+
+        # zero-copy view, and ascii files
+        data = load_ply(filename)["vertex"]
+        assert np.shares_memory(ply_fields(data), data)
+        assert np.array_equal(data["label"], label)
+        save_colored_pc_ascii(filename, xyz[:1000], rgb[:1000])
+        data = read_ply(filename)
+        assert np.allclose(ply_fields(data), xyz[:1000], atol=1e-5)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_points", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    benchmark(args.num_points, args.repeat)
@@ -0,0 +1,112 @@
+"""Streaming evaluation loader.
+
+Samples are produced by CPU workers ahead of the model: parsing, rotation and
+normalization run in DataLoader worker processes, the results are pinned, and
+`DevicePrefetcher` copies the next few samples to the GPU on a side stream
+while the current one is being evaluated. Only ``depth`` samples are on the
+device at any time. Without a GPU the samples stay as CPU tensors.
+"""
+
+from collections import deque
+
+import torch
+from torch.utils.data import DataLoader, Dataset
+
+
+class MapDataset(Dataset):
+    """``fn(item)`` for each of ``items``, evaluated lazily in the loader workers."""
+
+    def __init__(self, items, fn):
+        self.items = items
+        self.fn = fn
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getitem__(self, i):
+        return self.fn(self.items[i])
+
+
+def make_loader(items, fn, num_workers=4, prefetch=2, pin_memory=None):
+    """Unbatched DataLoader over ``fn(item)``. numpy arrays are returned as tensors.
+
+    ``prefetch`` is the number of samples each worker prepares in advance.
+    """
+    if pin_memory is None:
+        pin_memory = torch.cuda.is_available()
+    return DataLoader(
+        MapDataset(items, fn),
+        batch_size=None,
+        shuffle=False,
+        num_workers=num_workers,
+        pin_memory=pin_memory,
+        prefetch_factor=prefetch if num_workers > 0 else None,
+    )
+
+
+def to_device(x, device, non_blocking=False):
+    if torch.is_tensor(x):
+        return x.to(device, non_blocking=non_blocking)
+    if isinstance(x, dict):
+        return {k: to_device(v, device, non_blocking) for k, v in x.items()}
+    if isinstance(x, (list, tuple)):
+        return type(x)(to_device(v, device, non_blocking) for v in x)
+    return x
+
+
+def _record_stream(x, stream):
+    # keep the caching allocator from reusing the memory while the main stream uses it
+    if torch.is_tensor(x):
+        if x.is_cuda:
+            x.record_stream(stream)
+    elif isinstance(x, dict):
+        for v in x.values():
+            _record_stream(v, stream)
+    elif isinstance(x, (list, tuple)):
+        for v in x:
+            _record_stream(v, stream)
+
+
+class DevicePrefetcher:
+    """Iterate a loader with its outputs on ``device``, ``depth`` samples ahead."""
+
+    def __init__(self, loader, device=None, depth=2):
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.loader = loader
+        self.device = torch.device(device)
+        self.depth = depth
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        if self.device.type != "cuda":
+            for x in self.loader:
+                yield to_device(x, self.device)
+            return
+
+        stream = torch.cuda.Stream(device=self.device)
+        queue = deque()
+        it = iter(self.loader)
+
+        def preload():
+            try:
+                x = next(it)
+            except StopIteration:
+                return
+            with torch.cuda.stream(stream):
+                x = to_device(x, self.device, non_blocking=True)
+                event = torch.cuda.Event()
+                event.record(stream)
+            queue.append((x, event))
+
+        for _ in range(self.depth):
+            preload()
+        while queue:
+            x, event = queue.popleft()
+            current = torch.cuda.current_stream(self.device)
+            current.wait_event(event)
+            _record_stream(x, current)
+            preload()
+            yield x
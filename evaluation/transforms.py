@@ -0,0 +1,26 @@
+"""Point cloud normalization shared by evaluation and inference."""
+
+import numpy as np
+
+
+def normalize_colors(features, mean=0.5, std=0.5):
+    features = features / 255
+    if mean is not None:
+        features = features - mean
+    if std is not None:
+        features = features / std
+    return features
+
+
+def normalize_points(points: np.ndarray):
+    """Normalize the point cloud into a unit sphere."""
+    centroid, norm = normalization_params(points)
+    return (points - centroid) / norm
+
+
+def normalization_params(points: np.ndarray):
+    """Centroid and scale used by `normalize_points`, to map prompts the same way."""
+    assert points.ndim == 2 and points.shape[1] == 3, points.shape
+    centroid = np.mean(points, axis=0)
+    norm = np.max(np.linalg.norm(points - centroid, ord=2, axis=1))
+    return centroid, norm
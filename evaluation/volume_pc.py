@@ -0,0 +1,174 @@
+"""Gray-scale volume to point cloud, and point masks back to a label volume.
+
+The ``_processed`` NIfTI volumes written by ``Case.write_all`` become point
+clouds in the form `inference.py` expects: voxels inside the brain mask (or
+above a threshold) are points at their world coordinates from the affine, and
+the intensity, scaled to [0, 255], is replicated into the three color
+channels. A point budget is met by subsampling, uniformly or weighted towards
+bright voxels or edges. The voxel index of every point is kept, so per-point
+masks can be scattered back into a label volume on the original grid::
+
+    python evaluation/volume_pc.py --input flair+_processed.nii.gz --num_points 50000 \\
+        --strategy gradient --output flair.ply
+"""
+
+import argparse
+
+import numpy as np
+
+strategies = ("uniform", "intensity", "gradient")
+
+
+def load_volume(path):
+    """(volume, affine) of a NIfTI file, in nibabel (i, j, k) order."""
+    import nibabel as nb
+
+    img = nb.load(path)
+    return np.asarray(img.dataobj, dtype=np.float32), img.affine
+
+
+def voxel_to_world(ijk, affine):
+    return (
+        np.asarray(ijk, dtype=np.float64) @ affine[:3, :3].T + affine[:3, 3]
+    ).astype(np.float32)
+
+
+def scale_intensity(values, lo=1.0, hi=99.0):
+    """Percentile window of the values to [0, 255]."""
+    vmin, vmax = np.percentile(values, [lo, hi]) if len(values) else (0.0, 1.0)
+    return np.clip(255 * (values - vmin) / max(vmax - vmin, 1e-6), 0, 255).astype(
+        np.float32
+    )
+
+
+def sampling_weights(vol, ijk, strategy, floor=0.1):
+    """Per-voxel sampling probabilities.
+
+    'intensity' and 'gradient' weight by intensity or gradient magnitude, plus
+    ``floor`` times the mean weight so that homogeneous regions still get points.
+    """
+    if strategy == "uniform":
+        return None
+    if strategy == "intensity":
+        w = np.maximum(vol[tuple(ijk.T)], 0).astype(np.float64)
+    elif strategy == "gradient":
+        grad = np.gradient(vol)
+        w = np.sqrt(sum(g[tuple(ijk.T)].astype(np.float64) ** 2 for g in grad))
+    else:
+        raise ValueError(f"Unknown strategy {strategy}")
+    w = w + floor * max(w.mean(), 1e-12)
+    return w / w.sum()
+
+
+def volume_to_points(
+    vol, affine, mask=None, threshold=0.0, num_points=None, strategy="uniform", seed=0
+):
+    """Convert a volume to a point cloud.
+
+    Parameters
+    ----------
+    vol : array
+        [I, J, K] gray-scale volume.
+    affine : array
+        4x4 voxel to world transform.
+    mask : array, optional
+        voxels to convert, eg a brain mask. Default is ``vol > threshold``.
+    num_points : int, optional
+        point budget, reached by subsampling with ``strategy``.
+
+    Returns
+    -------
+    coords : array
+        [N, 3] float32 world coordinates.
+    colors : array
+        [N, 3] float32 intensity in [0, 255], replicated.
+    ijk : array
+        [N, 3] voxel index of each point, for `points_to_volume`.
+    """
+    region = vol > threshold if mask is None else np.asarray(mask) > 0
+    ijk = np.argwhere(region)
+    if num_points is not None and len(ijk) > num_points:
+        rng = np.random.default_rng(seed)
+        p = sampling_weights(vol, ijk, strategy)
+        keep = rng.choice(len(ijk), num_points, replace=False, p=p)
+        # keep the points in voxel order
+        ijk = ijk[np.sort(keep)]
+    gray = scale_intensity(vol[tuple(ijk.T)])
+    return voxel_to_world(ijk, affine), np.repeat(gray[:, None], 3, axis=1), ijk
+
+
+def points_to_volume(masks, ijk, shape, region=None):
+    """Scatter per-point masks into a label volume.
+
+    Parameters
+    ----------
+    masks : array
+        [N] or [M, N] bool masks, mask m is written as label m + 1 with later
+        masks overwriting earlier ones.
+    ijk : array
+        [N, 3] voxel indices from `volume_to_points`.
+    region : array, optional
+        the region that was converted. If given, voxels of the region that
+        were not sampled take the label of the nearest sampled voxel.
+
+    Returns
+    -------
+    labels : array
+        uint8 volume of ``shape``.
+    """
+    masks = np.atleast_2d(np.asarray(masks, dtype=bool))
+    labels = np.zeros(shape, dtype=np.uint8)
+    index = tuple(np.asarray(ijk).T)
+    for m, mask in enumerate(masks):
+        labels[tuple(i[mask] for i in index)] = m + 1
+    if region is not None:
+        from scipy.ndimage import distance_transform_edt
+
+        sampled = np.zeros(shape, dtype=bool)
+        sampled[index] = True
+        nearest = distance_transform_edt(
+            ~sampled, return_distances=False, return_indices=True
+        )
+        region = np.asarray(region) > 0
+        labels[region] = labels[tuple(n[region] for n in nearest)]
+    return labels
+
+
+def save_label_volume(path, labels, affine):
+    import nibabel as nb
+
+    nb.save(nb.Nifti1Image(labels.astype(np.uint8), affine), path)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--input", type=str, required=True, help="NIfTI gray-scale volume"
+    )
+    parser.add_argument(
+        "--mask", type=str, default=None, help="NIfTI brain mask on the same grid"
+    )
+    parser.add_argument("--threshold", type=float, default=0.0)
+    parser.add_argument("--num_points", type=int, default=None)
+    parser.add_argument("--strategy", type=str, default="uniform", choices=strategies)
+    parser.add_argument("--output", type=str, default="volume.ply", help=".ply or .npy")
+    args = parser.parse_args()
+
+    vol, affine = load_volume(args.input)
+    mask = load_volume(args.mask)[0] if args.mask else None
+    coords, colors, ijk = volume_to_points(
+        vol, affine, mask, args.threshold, args.num_points, args.strategy
+    )
+    if args.output.endswith(".ply"):
+        from ply_io import save_colored_pc
+
+        save_colored_pc(
+            args.output, coords, colors / 255, i=ijk[:, 0], j=ijk[:, 1], k=ijk[:, 2]
+        )
+    else:
+        np.save(args.output, np.concatenate([coords, colors], axis=1))
+    print(f"{len(coords)} points written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
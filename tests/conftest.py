@@ -0,0 +1,7 @@
+import os
+import sys
+
+# the demo and evaluation scripts import their modules as top-level names
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for d in ("demo", "evaluation"):
+    sys.path.insert(0, os.path.join(root, d))
@@ -0,0 +1,94 @@
+import pytest
+
+from admission import AdmissionControl
+from jobstore import SQLiteJobStore
+
+
+@pytest.fixture
+def jobs(tmp_path):
+    return SQLiteJobStore(str(tmp_path / "jobs.db"))
+
+
+def test_admits_within_budget_and_waits_beyond_it(jobs):
+    adm = AdmissionControl(jobs, max_cases=2, max_ram=100)
+    a, b = jobs.create_job("a"), jobs.create_job("b")
+    assert adm.admit(a, ram=60) == (True, 0)
+    assert jobs.get_job(a)["state"] == "running"
+    # the case budget has room, the ram budget doesn't
+    assert adm.admit(b, ram=60) == (False, 1)
+    assert jobs.get_job(b)["state"] == "queued"
+    adm.release(a)
+    assert adm.admit(b, ram=60) == (True, 0)
+
+
+def test_queue_is_fifo(jobs):
+    adm = AdmissionControl(jobs, max_cases=1)
+    a, b, c = (jobs.create_job(n) for n in "abc")
+    assert adm.admit(a, ram=0)[0]
+    adm.release(a)
+    jobs.update_job(a, state="done")
+    # c fits, but b is ahead of it
+    assert adm.admit(c, ram=0) == (False, 2)
+    assert adm.admit(b, ram=0) == (True, 0)
+    assert adm.queue_depth() == 1
+
+
+def test_oversized_request_runs_on_idle_server(jobs):
+    adm = AdmissionControl(jobs, max_cases=1, max_ram=100)
+    a, b = jobs.create_job("a"), jobs.create_job("b")
+    assert adm.admit(a, ram=1000, ncases=3) == (True, 0)
+    assert jobs.lease_usage() == {"case": 3, "ram": 1000}
+    assert adm.admit(b, ram=1) == (False, 1)
+
+
+def test_job_that_is_not_queued_gets_no_leases(jobs):
+    adm = AdmissionControl(jobs, max_cases=4, max_ram=100)
+    a = jobs.create_job("a")
+    assert adm.admit(a, ram=10)[0]
+    assert adm.admit(a, ram=10) == (False, 1)
+    assert jobs.lease_usage() == {"case": 1, "ram": 10}
+    jobs.update_job(a, state="done")
+    adm.release(a)
+    assert adm.admit(a, ram=10) == (False, 1)
+    assert jobs.lease_usage() == {}
+
+
+def test_expired_leases_free_the_budget(jobs):
+    adm = AdmissionControl(jobs, max_cases=1, lease_ttl=-1)
+    a, b = jobs.create_job("a"), jobs.create_job("b")
+    assert adm.admit(a, ram=0)[0]
+    # a's leases expired as soon as they were taken, as if its worker had died
+    assert adm.admit(b, ram=0) == (True, 0)
+
+
+def test_abandoned_queue_entries_are_dropped(jobs):
+    adm = AdmissionControl(jobs, max_cases=1, queue_ttl=60)
+    a, b = jobs.create_job("a"), jobs.create_job("b")
+    # a's client stopped retrying long ago
+    with jobs.transaction() as con:
+        con.execute("update jobs set updated=0 where job_id=?", (a,))
+    assert adm.admit(b, ram=0) == (True, 0)
+    assert jobs.get_job(a)["state"] == "failed"
+
+
+def test_gpu_slots(jobs):
+    adm = AdmissionControl(jobs, gpu_slots=1)
+    a, b = jobs.create_job("a"), jobs.create_job("b")
+    assert list(adm.acquire_gpu(a)) == []
+    wait = adm.acquire_gpu(b, poll=0)
+    assert next(wait) >= 0
+    adm.release_gpu(a)
+    with pytest.raises(StopIteration):
+        next(wait)
+    assert jobs.lease_usage() == {"gpu": 1}
+
+
+def test_metrics(jobs):
+    adm = AdmissionControl(jobs, max_cases=1)
+    a = jobs.create_job("a")
+    jobs.create_job("b")
+    adm.admit(a, ram=5)
+    text = adm.metrics()
+    assert "flaskdemo_queue_depth 1\n" in text
+    assert "flaskdemo_case_used 1.0\n" in text
+    assert "flaskdemo_case_budget 1\n" in text
@@ -0,0 +1,43 @@
+import numpy as np
+
+from brainbox import bbox_from_mask, crop, read_bbox, uncrop, write_bbox
+
+
+def test_bbox_from_mask():
+    mask = np.zeros((10, 12, 14), dtype=np.uint8)
+    mask[3:5, 0:2, 10:14] = 1
+    bbox = bbox_from_mask(mask, margin=2)
+    # padded by the margin, clipped to the grid
+    assert bbox == (slice(1, 7), slice(0, 4), slice(8, 14))
+    assert bbox_from_mask(mask, margin=0) == (slice(3, 5), slice(0, 2), slice(10, 14))
+
+
+def test_empty_mask_is_the_whole_grid():
+    assert bbox_from_mask(np.zeros((3, 4))) == (slice(0, 3), slice(0, 4))
+
+
+def test_crop_uncrop():
+    rng = np.random.default_rng(0)
+    shape = (10, 12, 14)
+    vol = np.zeros(shape, dtype=np.float32)
+    vol[2:6, 3:9, 4:10] = rng.random((4, 6, 6))
+    bbox = bbox_from_mask(vol, margin=1)
+    cropped = crop(vol, bbox)
+    assert cropped.shape == (6, 8, 8)
+    assert np.array_equal(uncrop(cropped, bbox, shape), vol)
+
+
+def test_uncrop_keeps_leading_axes_and_fill():
+    bbox = (slice(1, 3), slice(2, 4))
+    arr = np.ones((3, 2, 2), dtype=np.uint8)
+    full = uncrop(arr, bbox, (5, 5), fill=7)
+    assert full.shape == (3, 5, 5) and full.dtype == np.uint8
+    assert np.all(full[:, 1:3, 2:4] == 1)
+    assert full.sum() == 3 * 4 + 7 * 3 * (25 - 4)
+
+
+def test_bbox_file(tmp_path):
+    assert read_bbox(str(tmp_path)) is None
+    bbox = bbox_from_mask(np.pad(np.ones((2, 2, 2)), 3), margin=1)
+    write_bbox(str(tmp_path), bbox, np.int64([8, 8, 8]))
+    assert read_bbox(str(tmp_path)) == (bbox, (8, 8, 8))
@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+from fusion import fuse
+
+
+def labels(*values):
+    return np.array(values, dtype=np.uint8)
+
+
+def test_or():
+    preds = {
+        "ax": labels(0, 1, 2, 0),
+        "sag": labels(0, 2, 0, 0),
+        "cor": labels(0, 0, 2, 2),
+    }
+    # tumour overwrites necrosis, written as 6 and 5
+    assert np.array_equal(fuse(preds, "or"), labels(0, 6, 5, 5))
+
+
+def test_vote():
+    preds = {
+        "ax": labels(0, 1, 2, 0),
+        "sag": labels(0, 1, 2, 2),
+        "cor": labels(1, 0, 0, 0),
+    }
+    assert np.array_equal(fuse(preds, "vote"), labels(0, 6, 5, 0))
+    # a three-way tie goes to tumour, then necrosis
+    preds = {"ax": labels(0, 0), "sag": labels(1, 2), "cor": labels(2, 2)}
+    assert np.array_equal(fuse(preds, "vote", orients=["ax", "sag"]), labels(6, 5))
+    assert np.array_equal(fuse(preds, "vote"), labels(6, 5))
+
+
+def test_mean():
+    probs = {
+        "ax": np.array([[0.6, 0.2], [0.3, 0.1], [0.1, 0.7]]),
+        "sag": np.array([[0.2, 0.9], [0.7, 0.05], [0.1, 0.05]]),
+    }
+    preds = {o: np.argmax(p, axis=0).astype(np.uint8) for o, p in probs.items()}
+    # the mean of (0.4, 0.5, 0.1) is tumour, of (0.55, 0.075, 0.375) background
+    assert np.array_equal(fuse(preds, "mean", probs=probs), labels(6, 0))
+
+
+def test_only_given_orientations_are_fused():
+    preds = {"ax": labels(1, 0), "cor": labels(0, 2)}
+    assert np.array_equal(fuse(preds, "or"), labels(6, 5))
+    assert np.array_equal(fuse(preds, "or", orients=["ax"]), labels(6, 0))
+
+
+def test_errors():
+    preds = {"ax": labels(0, 1)}
+    with pytest.raises(ValueError):
+        fuse(preds, "mean")
+    with pytest.raises(ValueError):
+        fuse(preds, "max")
@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+
+from histquantile import HistQuantile, batch_quantiles
+
+qs = np.array([0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99, 1.0])
+
+
+def foreground(vol, thresh=0):
+    v = vol.ravel()
+    return v[v > thresh]
+
+
+def test_integer_volume_matches_np_quantile():
+    rng = np.random.default_rng(0)
+    vol = rng.integers(0, 500, (20, 30, 40)).astype(np.int16)
+    h = HistQuantile()
+    h.update(vol)
+    # the first value at which the cumulative density reaches q
+    expected = np.quantile(foreground(vol), qs, method="inverted_cdf")
+    assert np.array_equal(h.quantile(qs), expected)
+    assert h.quantile(0.5) == expected[3]
+
+
+@pytest.mark.parametrize("binwidth", [1.0, 0.25])
+def test_float_volume_within_half_a_bin(binwidth):
+    rng = np.random.default_rng(1)
+    vol = rng.gamma(2.0, 100.0, (16, 32, 32))
+    h = HistQuantile(binwidth=binwidth)
+    h.update(vol)
+    expected = np.quantile(foreground(vol), qs, method="inverted_cdf")
+    assert np.all(np.abs(h.quantile(qs) - expected) <= binwidth / 2 + 1e-9)
+
+
+def test_threshold_excludes_background():
+    vol = np.zeros((10, 10, 10))
+    vol[:2] = 100
+    vol[2:4] = 200
+    h = HistQuantile()
+    h.update(vol, thresh=0)
+    assert h.n == 400
+    assert h.quantile(0.5) == 100 and h.quantile(0.51) == 200
+
+
+def test_chunked_and_memmap(tmp_path):
+    rng = np.random.default_rng(2)
+    vol = rng.normal(300, 80, (33, 20, 20)).astype(np.float32)
+    mm = np.memmap(
+        str(tmp_path / "vol.dat"), dtype=np.float32, mode="w+", shape=vol.shape
+    )
+    mm[:] = vol
+    whole = HistQuantile()
+    whole.update(vol)
+    chunked = HistQuantile()
+    chunked.update_chunked(mm, chunk=4)
+    assert chunked.n == whole.n
+    assert np.array_equal(chunked.quantile(qs), whole.quantile(qs))
+
+
+def test_batch_quantiles():
+    rng = np.random.default_rng(3)
+    arrs = {c: rng.integers(1, 100 * (i + 1), (8, 8, 8)) for i, c in enumerate("ab")}
+    res = batch_quantiles(arrs, qs)
+    for c, arr in arrs.items():
+        expected = np.quantile(foreground(arr), qs, method="inverted_cdf")
+        assert np.array_equal(res[c], expected)
+
+
+def test_empty():
+    h = HistQuantile()
+    h.update(np.zeros(10))
+    with pytest.raises(ValueError):
+        h.quantile(0.5)
@@ -0,0 +1,96 @@
+import numpy as np
+import pytest
+
+from ply_io import (
+    load_ply,
+    ply_fields,
+    read_ply,
+    save_colored_pc,
+    save_colored_pc_ascii,
+    write_ply,
+)
+
+
+def test_binary_round_trip(tmp_path):
+    rng = np.random.default_rng(0)
+    xyz = rng.standard_normal((50, 3)).astype(np.float32)
+    rgb = rng.integers(0, 256, (50, 3)).astype(np.uint8)
+    label = rng.integers(0, 10, 50).astype(np.int32)
+    faces = rng.integers(0, 50, (20, 3))
+    filename = str(tmp_path / "cloud")
+    names = ["x", "y", "z", "red", "green", "blue", "label"]
+    assert write_ply(filename, [xyz, rgb, label], names, triangular_faces=faces)
+
+    vertex, tri = read_ply(filename + ".ply", triangular_mesh=True)
+    assert vertex.dtype.names == tuple(names)
+    assert np.array_equal(ply_fields(vertex), xyz)
+    assert np.array_equal(
+        ply_fields(vertex, ("red", "green", "blue"), dtype=np.uint8), rgb
+    )
+    assert np.array_equal(vertex["label"], label)
+    assert np.array_equal(tri, faces)
+
+
+def test_types_without_ply_equivalent_are_cast(tmp_path):
+    filename = str(tmp_path / "cast.ply")
+    values = np.arange(5, dtype=np.int64)
+    mask = np.array([True, False, True, False, True])
+    assert write_ply(filename, [values, mask], ["values", "mask"])
+    data = read_ply(filename)
+    assert data.dtype["values"] == np.dtype("<i4")
+    assert data.dtype["mask"] == np.dtype("u1")
+    assert np.array_equal(data["values"], values)
+    assert np.array_equal(data["mask"], mask)
+
+
+def test_memmap_and_views(tmp_path):
+    filename = str(tmp_path / "cloud.ply")
+    xyz = np.arange(30, dtype=np.float32).reshape(10, 3)
+    save_colored_pc(filename, xyz, np.full((10, 3), 0.5))
+    data = load_ply(filename)["vertex"]
+    assert isinstance(data, np.memmap)
+    # x, y, z are adjacent float32 properties, selected without a copy
+    assert np.shares_memory(ply_fields(data), data)
+    assert not np.shares_memory(ply_fields(data, contiguous=True), data)
+    assert np.array_equal(ply_fields(data, ("red",))[:, 0], np.full(10, 127))
+
+
+def test_ascii(tmp_path):
+    filename = str(tmp_path / "cloud.ply")
+    rng = np.random.default_rng(0)
+    xyz = rng.random((20, 3)).astype(np.float32)
+    save_colored_pc_ascii(filename, xyz, rng.random((20, 3)))
+    assert np.allclose(ply_fields(read_ply(filename)), xyz, atol=1e-5)
+
+
+def test_ascii_mesh(tmp_path):
+    filename = tmp_path / "mesh.ply"
+    filename.write_text(
+        "ply\n"
+        "format ascii 1.0\n"
+        "comment élément, not ascii\n"
+        "element vertex 3\n"
+        "property float x\n"
+        "property float y\n"
+        "property float z\n"
+        "element face 1\n"
+        "property list uchar int vertex_indices\n"
+        "end_header\n"
+        "0 0 0\n"
+        "1 0 0\n"
+        "0 1 0\n"
+        "3 0 1 2\n",
+        encoding="utf-8",
+    )
+    vertex, faces = read_ply(str(filename), triangular_mesh=True)
+    assert np.array_equal(ply_fields(vertex), [[0, 0, 0], [1, 0, 0], [0, 1, 0]])
+    assert np.array_equal(faces, [[0, 1, 2]])
+
+
+def test_bad_input(tmp_path):
+    filename = str(tmp_path / "bad.ply")
+    assert not write_ply(filename, np.zeros((4, 3)), ["x", "y"])
+    with open(filename, "wb") as fp:
+        fp.write(b"not a ply file\n")
+    with pytest.raises(ValueError):
+        load_ply(filename)